@@ -17,6 +17,15 @@ type MeasurementPlan = Array<{ offset: number; duration: number }>;
 
 interface DetuningScanControlState {
 	measurementPlan: string;
+	scan: {
+		running: boolean;
+		segment: number;
+		segments: number;
+		startedAt: number | null;
+		plannedDuration: number;
+		cancelled: boolean;
+		error: string | null;
+	};
 }
 
 export function useDetuningScanComponent() {
@@ -65,6 +74,10 @@ export function useDetuningScanComponent() {
 		setIsVisible(false);
 	};
 
+	const cancelScan = () => action('cancelScan');
+
+	const scan = state?.scan;
+
 	return {
 		invoke: () => {
 			if (!state) return;
@@ -149,6 +162,17 @@ export function useDetuningScanComponent() {
 							onBlur={updateEditingMeasurementPlan}
 							classNames={{ input: 'text-sm/[1.1]' }}
 						/>
+						{scan?.running && (
+							<div className="text-center">
+								Scanning segment {scan.segment + 1} of{' '}
+								{scan.segments}
+							</div>
+						)}
+						{scan?.error && (
+							<div className="text-center text-red-500">
+								Scan failed: {scan.error}
+							</div>
+						)}
 					</ModalBody>
 					<ModalFooter className="flex flex-row justify-between">
 						<Button variant="bordered" onPress={save}>
@@ -158,9 +182,15 @@ export function useDetuningScanComponent() {
 							<Button onPress={() => setIsVisible(false)}>
 								Cancel
 							</Button>
-							<Button color="primary" onPress={startScan}>
-								Start Scan
-							</Button>
+							{scan?.running ? (
+								<Button color="danger" onPress={cancelScan}>
+									Cancel Scan
+								</Button>
+							) : (
+								<Button color="primary" onPress={startScan}>
+									Start Scan
+								</Button>
+							)}
 						</div>
 					</ModalFooter>
 				</ModalContent>
@@ -12,6 +12,16 @@ import { useSignalRHub } from './signalR';
 
 const StateContext = createContext<Record<string, any>>({});
 
+type StatePatch = [path: (string | number)[], value: any];
+
+function setIn(target: any, path: StatePatch[0], value: any): any {
+	if (path.length === 0) return value;
+	const [key, ...rest] = path;
+	const copy = Array.isArray(target) ? [...target] : { ...target };
+	copy[key] = setIn(target?.[key], rest, value);
+	return copy;
+}
+
 export function ControlStateProvider({ children }: PropsWithChildren) {
 	const [state, setState] = useState<Record<string, any>>({});
 	const partialStateUpdate = useCallback(
@@ -30,9 +40,28 @@ export function ControlStateProvider({ children }: PropsWithChildren) {
 			}),
 		[],
 	);
+	const statePatch = useCallback(
+		(deviceId: string, patches: StatePatch[]) =>
+			setState((oldState) => {
+				if (!(deviceId in oldState)) return oldState;
+				let deviceState = oldState[deviceId];
+				patches.forEach(([path, value]) => {
+					deviceState = setIn(deviceState, path, value);
+				});
+				return { ...oldState, [deviceId]: deviceState };
+			}),
+		[],
+	);
+	const onDataReceived = useMemo(
+		() => ({
+			PartialStateUpdate: partialStateUpdate,
+			StatePatch: statePatch,
+		}),
+		[partialStateUpdate, statePatch],
+	);
 	const { isConnected, invoke } = useSignalRHub({
 		url: controlHubUrl,
-		onDataReceived: { PartialStateUpdate: partialStateUpdate },
+		onDataReceived,
 	});
 	useEffect(() => {
 		if (!isConnected) {
@@ -1,4 +1,5 @@
 using System.Collections.Concurrent;
+using System.Diagnostics;
 using System.IO.Compression;
 using System.Text;
 using System.Text.Json;
@@ -8,22 +9,57 @@ using YamlDotNet.Serialization;
 using YamlDotNet.Serialization.NamingConventions;
 using YamlDotNet.System.Text.Json;
 
-public record DeviceAction(string DeviceId, string? ChannelId, string ActionName, object[]? Parameters);
+public record DeviceAction(string DeviceId, string? ChannelId, string ActionName, object[]? Parameters)
+{
+	private static readonly JsonSerializerOptions ParameterSerializerOptions = new() { Converters = { new NaturalObjectConverter() } };
+
+	// Parses `[deviceId, channelId, actionName, parameters]`, as sent by the Python devices.
+	public static DeviceAction FromJson(JsonElement args)
+	{
+		return new DeviceAction(
+			args[0].GetString()!,
+			args[1].ValueKind == JsonValueKind.Null ? null : args[1].GetString(),
+			args[2].GetString()!,
+			args[3].ValueKind == JsonValueKind.Null ? null : args[3].Deserialize<object[]>(ParameterSerializerOptions)
+		);
+	}
+}
+
+// An action of DeviceManager.ActionBatch, optionally with the action reverting it.
+public record BatchedAction(DeviceAction Action, DeviceAction? Undo = null)
+{
+	// Parses a list of `[deviceId, channelId, actionName, parameters, undo?]`, with `undo` being of the same form.
+	public static List<BatchedAction> ListFromJson(JsonElement actions)
+	{
+		return actions.EnumerateArray().Select(entry => new BatchedAction(
+			DeviceAction.FromJson(entry),
+			entry.GetArrayLength() > 4 && entry[4].ValueKind != JsonValueKind.Null ? DeviceAction.FromJson(entry[4]) : null
+		)).ToList();
+	}
+}
 
 public class DeviceManager : IDisposable
 {
 	private bool useSystemTempFolder = false;
 	private bool SaveToNpz = false;
+	// runs the scripts of instruments with slow I/O in worker processes, see PythonWorkerDevice
+	private bool UsePythonWorkers = false;
 
 	private readonly IHubContext<ControlHub> ControlHub;
 	private readonly IHubContext<StreamingHub> StreamingHub;
 	public Dictionary<string, IDeviceHandler> Devices = new();
+	// collected for all devices, published by the "metrics" device and /api/metrics
+	public ConcurrentDictionary<string, DeviceMetrics> Metrics = new();
 	private List<string> UpdateQueue = new();
 	private Timer? UpdateTimer = null;
 	private const float MaxUpdateDelay = 0.05f;
 	internal ConcurrentDictionary<string, Dictionary<string, Dictionary<object, object>>> StreamingContexts = new();
 	private MainDevice MainDevice = new();
+	// Raised for every state update sent to the clients, with the hub method ("PartialStateUpdate" or "StatePatch") and its payload
+	public event Action<string, string, object>? StateChanged;
 	private CancellationTokenSource GlobalCancellationTokenSource = new();
+	// time a driver gets to find its hardware before the demo driver is used instead
+	private static readonly TimeSpan ProbeTimeout = TimeSpan.FromSeconds(5);
 
 	private ISerializer yamlSerializer = new SerializerBuilder()
 			.WithTypeConverter(new SystemTextJsonYamlTypeConverter())
@@ -35,87 +71,72 @@ public class DeviceManager : IDisposable
 		ControlHub = controlHub;
 		StreamingHub = streamingHub;
 		RegisterDevice("constants", new CoherentScatteringConstantsDevice());
-		try
-		{
-			RegisterDevice("het", new Picoscope5000aOscilloscope());
-		}
-		catch
-		{
-			Console.WriteLine("Falling back to DemoOscilloscope");
-			RegisterDevice("het", new DemoOscilloscope());
-		}
-		try
-		{
-			RegisterDevice("split", new Picoscope4000aOscilloscope());
-		}
-		catch
-		{ }
-		try
-		{
-			RegisterDevice("cavity_detuning", new PythonDevice("Devices/RS_SMA100B.py", new { ipAddress = "192.168.0.23" }));
-		}
-		catch
-		{
-			Console.WriteLine("Falling back to DemoRFGen");
-			RegisterDevice("cavity_detuning", new PythonDevice("Devices/DemoRFGen.py"));
-		}
-		try
-		{
-			RegisterDevice("pressure", new PythonDevice("Devices/PfeifferPressureSensor.py", new { port = "COM4" }));
-		}
-		catch
-		{
-			Console.WriteLine("Falling back to DemoPressureSensor");
-			RegisterDevice("pressure", new PythonDevice("Devices/DemoPressureSensor.py"));
-		}
-		try
-		{
-			RegisterDevice("elliptec", new PythonDevice("Devices/Elliptec.py", new { port = "COM3", channels = new object[] { new { type = "rotation", address = "A" }, new { type = "rotation", address = "B" }, new { type = "slider", address = "9" } } }));
-		}
-		catch
-		{
-			Console.WriteLine("Falling back to DemoElliptec");
-			RegisterDevice("elliptec", new PythonDevice("Devices/DemoElliptec.py"));
-		}
-		try
-		{
-			RegisterDevice("smaract", new PythonDevice("Devices/SmaractDevice.py", new { device = "network:sn:MCS2-00002614" }));
-		}
-		catch
-		{
-			Console.WriteLine("Falling back to DemoSmaract");
-			RegisterDevice("smaract", new PythonDevice("Devices/DemoSmaract.py"));
-		}
-		try
-		{
-			RegisterDevice("tweezerPolarization", new PythonDevice("Devices/ThorlabsPolarimeter.py", new { device = "USB0::0x1313::0x8031::M00503241::INSTR" }));
-		}
-		catch
-		{
-			Console.WriteLine("Falling back to DemoPolarimeter");
-			RegisterDevice("tweezerPolarization", new PythonDevice("Devices/DemoPolarimeter.py"));
-		}
+		// the hardware is probed in the background, falling back to the demo drivers if it's not available
+		RegisterDeferredDevice("het",
+			new("Picoscope5000aOscilloscope", () => new Picoscope5000aOscilloscope(), TimeSpan.FromSeconds(10)),
+			new("DemoOscilloscope", () => new DemoOscilloscope()));
+		RegisterDeferredDevice("split",
+			new("Picoscope4000aOscilloscope", () => new Picoscope4000aOscilloscope(), TimeSpan.FromSeconds(10)));
+		RegisterDeferredDevice("cavity_detuning",
+			new("RS_SMA100B", () => new PythonDevice("Devices/RS_SMA100B.py", new { ipAddress = "192.168.0.23" }), ProbeTimeout),
+			new("DemoRFGen", () => new PythonDevice("Devices/DemoRFGen.py")));
+		RegisterDeferredDevice("pressure",
+			new("PfeifferPressureSensor", () => CreatePythonDevice("Devices/PfeifferPressureSensor.py", new { port = "COM4" }, maxStatusUpdateRate: 10, inWorker: UsePythonWorkers), ProbeTimeout),
+			new("DemoPressureSensor", () => new PythonDevice("Devices/DemoPressureSensor.py")));
+		RegisterDeferredDevice("elliptec",
+			new("Elliptec", () => new PythonDevice("Devices/Elliptec.py", new { port = "COM3", channels = new object[] { new { type = "rotation", address = "A" }, new { type = "rotation", address = "B" }, new { type = "slider", address = "9" } } }), ProbeTimeout),
+			new("DemoElliptec", () => new PythonDevice("Devices/DemoElliptec.py")));
+		RegisterDeferredDevice("smaract",
+			new("SmaractDevice", () => new PythonDevice("Devices/SmaractDevice.py", new { device = "network:sn:MCS2-00002614" }, maxStatusUpdateRate: 10), ProbeTimeout),
+			new("DemoSmaract", () => new PythonDevice("Devices/DemoSmaract.py", maxStatusUpdateRate: 10)));
+		RegisterDeferredDevice("tweezerPolarization",
+			new("ThorlabsPolarimeter", () => CreatePythonDevice("Devices/ThorlabsPolarimeter.py", new { device = "USB0::0x1313::0x8031::M00503241::INSTR", mode = "buffered" }, maxStatusUpdateRate: 10, inWorker: UsePythonWorkers), ProbeTimeout),
+			new("DemoPolarimeter", () => new PythonDevice("Devices/DemoPolarimeter.py")));
 		RegisterDevice("detuningScanControl", new PythonDevice("Devices/DetuningScanControl.py"));
 		RegisterDevice("particleName", new PythonDevice("Devices/ParticleName.py", new { openai_api_key = Environment.GetEnvironmentVariable("OPENAI_API_KEY"), slack_token = Environment.GetEnvironmentVariable("SLACK_TOKEN"), slack_channel = Environment.GetEnvironmentVariable("SLACK_CHANNEL") }));
 		RegisterDevice("pressureUploader", new PythonDevice("Devices/PressureUploader.py", new { deviceName = "pressure", selectedChannel = 1, uploadUrl = "https://pressure.cavity.at/api/uploadSensorData", apiKey = Environment.GetEnvironmentVariable("SENSE_API_KEY") }));
 		RegisterDevice("polarizationLock", new PythonDevice("Devices/PolarizationLock.py", new { polarizationDeviceName = "tweezerPolarization", waveplateDeviceName = "elliptec", waveplateQWPChannel = 0, waveplateHWPChannel = 1 }));
-		RegisterDevice("smaractLock", new PythonDevice("Devices/SmaractLock.py"));
+		RegisterDevice("smaractLock", new PythonDevice("Devices/SmaractLock.py", new { osciChannel = 0, smaractZChannel = 0 }));
 		RegisterDevice("main", MainDevice);
+		RegisterDevice("metrics", new MetricsDevice());
+		// the devices with numeric slow-control values (not e.g. the oscilloscopes' traces or the metrics)
+		RegisterDevice("history", new PythonDevice("Devices/HistoryLogger.py", new { devices = new[] { "pressure", "cavity_detuning", "elliptec", "smaract", "tweezerPolarization", "polarizationLock", "smaractLock" }, directory = "history" }));
 
 		LoadSettings();
 
 		accessControlService.Passphrase = MainDevice.Passphrase;
 	}
 
+	private void RegisterDeferredDevice(string deviceId, params DeferredDevice.Candidate[] candidates)
+	{
+		RegisterDevice(deviceId, new DeferredDevice(deviceId, MainDevice, candidates));
+	}
+
+	private static IDeviceHandler CreatePythonDevice(string filename, object? arguments = null, double maxStatusUpdateRate = 0, bool inWorker = false)
+	{
+		return inWorker ? new PythonWorkerDevice(filename, arguments, maxStatusUpdateRate) : new PythonDevice(filename, arguments, maxStatusUpdateRate);
+	}
+
 	public void RegisterDevice(string deviceId, IDeviceHandler deviceHandler)
 	{
 		Devices.Add(deviceId, deviceHandler);
+		Metrics[deviceId] = DeviceMetrics.Of(deviceHandler) ?? new();
+		if (PythonStartupProfile.Of(deviceHandler) is PythonStartupProfile profile)
+		{
+			MainDevice.SetDeviceInitialization(deviceId, new DeviceInitialization { Status = "ready", Seconds = profile.Total, Profile = profile });
+		}
 		deviceHandler.SetDeviceManager(this);
 		deviceHandler.SubscribeToStateUpdates(state =>
 		{
 			var stateUpdate = new Dictionary<string, object>();
 			stateUpdate[deviceId] = state;
 			SendPartialStateUpdateAsync(stateUpdate);
+			StateChanged?.Invoke(deviceId, "PartialStateUpdate", state);
+		});
+		deviceHandler.SubscribeToStatePatches(patches =>
+		{
+			SendStatePatchAsync(deviceId, patches);
+			StateChanged?.Invoke(deviceId, "StatePatch", patches);
 		});
 		deviceHandler.SubscribeToStreamEvents(data =>
 		{
@@ -127,14 +148,69 @@ public class DeviceManager : IDisposable
 	{
 		var deviceId = GetDeviceId(deviceHandler);
 		if (deviceId == null) return;
-		Devices.Remove(deviceId);
-		deviceHandler.Dispose();
+		// a driver wrapped by a DeferredDevice is unregistered (and disposed) along with its placeholder
+		Devices.Remove(deviceId, out var registeredDevice);
+		Metrics.TryRemove(deviceId, out _);
+		registeredDevice?.Dispose();
 	}
 
 	public void Action(DeviceAction action)
 	{
-		Devices[action.DeviceId].HandleActionAsync(action);
-		UpdateQueue.Add(action.DeviceId);
+		HandleAction(action);
+		QueueUpdate([action.DeviceId]);
+	}
+
+	// Runs the actions in order, the states of the affected devices are published once afterwards.
+	// The first failing action ends the batch; if `atomic`, the preceding actions are reverted first (in reverse order, by their undo actions).
+	// If `bestEffort` (e.g. for cleanups), the remaining actions run regardless and the errors are raised afterwards as AggregateException.
+	public void ActionBatch(IReadOnlyList<BatchedAction> actions, bool atomic = false, bool bestEffort = false)
+	{
+		if (atomic && bestEffort) throw new ArgumentException("A batch can't be both atomic and best-effort.");
+		var completed = new List<BatchedAction>();
+		var errors = new List<Exception>();
+		try
+		{
+			foreach (var entry in actions)
+			{
+				try
+				{
+					HandleAction(entry.Action);
+				}
+				catch (Exception e) when (bestEffort)
+				{
+					errors.Add(e);
+					continue;
+				}
+				completed.Add(entry);
+			}
+			if (errors.Count > 0) throw new AggregateException($"{errors.Count} of {actions.Count} batched actions failed.", errors);
+		}
+		catch (Exception) when (atomic)
+		{
+			completed.Reverse();
+			foreach (var entry in completed)
+			{
+				if (entry.Undo == null) continue;
+				try
+				{
+					HandleAction(entry.Undo);
+				}
+				catch (Exception e)
+				{
+					Console.WriteLine($"Error reverting {entry.Action.DeviceId}.{entry.Action.ActionName}: {e.Message}");
+				}
+			}
+			throw;
+		}
+		finally
+		{
+			QueueUpdate(actions.Select(entry => entry.Action.DeviceId).Distinct());
+		}
+	}
+
+	private void QueueUpdate(IEnumerable<string> deviceIds)
+	{
+		UpdateQueue.AddRange(deviceIds);
 		if (UpdateTimer == null)
 		{
 			UpdateTimer = new Timer(UpdateDevices, null, TimeSpan.FromSeconds(MaxUpdateDelay), TimeSpan.Zero);
@@ -143,7 +219,20 @@ public class DeviceManager : IDisposable
 
 	public object Request(DeviceAction action)
 	{
-		return Devices[action.DeviceId].HandleActionAsync(action);
+		return HandleAction(action);
+	}
+
+	private object HandleAction(DeviceAction action)
+	{
+		var start = Stopwatch.GetTimestamp();
+		try
+		{
+			return Devices[action.DeviceId].HandleActionAsync(action);
+		}
+		finally
+		{
+			if (Metrics.TryGetValue(action.DeviceId, out var metrics)) metrics.ActionLatency.RecordSince(start);
+		}
 	}
 
 	public Dictionary<string, object> GetFullState()
@@ -151,6 +240,8 @@ public class DeviceManager : IDisposable
 		var state = new Dictionary<string, object>();
 		foreach (var (deviceId, device) in Devices)
 		{
+			// devices still being initialized are sent once they're ready
+			if (device is DeferredDevice { IsReady: false }) continue;
 			state[deviceId] = device.GetState();
 		}
 		return state;
@@ -161,6 +252,11 @@ public class DeviceManager : IDisposable
 		ControlHub.Clients.All.SendAsync("PartialStateUpdate", partialState);
 	}
 
+	public void SendStatePatchAsync(string deviceId, object patches)
+	{
+		ControlHub.Clients.All.SendAsync("StatePatch", deviceId, patches);
+	}
+
 	public void SendStreamData(string deviceId, object data)
 	{
 		StreamingHub.Clients.All.SendAsync("StreamData", deviceId, data);
@@ -168,7 +264,8 @@ public class DeviceManager : IDisposable
 
 	public string GetDeviceId(IDeviceHandler deviceHandler)
 	{
-		return Devices.FirstOrDefault(x => x.Value == deviceHandler).Key;
+		// drivers of a DeferredDevice are known by the id of their placeholder
+		return Devices.FirstOrDefault(x => x.Value == deviceHandler || (x.Value is DeferredDevice deferredDevice && deferredDevice.Current == deviceHandler)).Key;
 	}
 
 	public void SendStreamData<T>(string deviceId, Func<T, Dictionary<object, object>?, object> filter, T data)
@@ -201,10 +298,15 @@ public class DeviceManager : IDisposable
 		var state = new Dictionary<string, object>();
 		foreach (var deviceId in UpdateQueue)
 		{
+			if (Devices[deviceId] is DeferredDevice { IsReady: false }) continue;
 			state[deviceId] = Devices[deviceId].GetState();
 		}
 		UpdateQueue.Clear();
 		SendPartialStateUpdateAsync(state);
+		foreach (var (deviceId, deviceState) in state)
+		{
+			StateChanged?.Invoke(deviceId, "PartialStateUpdate", deviceState);
+		}
 	}
 
 	private ConcurrentDictionary<string, object> GetSnapshot(Func<string, Stream>? getStream = null)
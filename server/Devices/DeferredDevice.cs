@@ -0,0 +1,169 @@
+using System.Diagnostics;
+using System.Text.Json;
+
+// Placeholder for a device whose driver is being created in the background, such that the server doesn't wait for slow hardware probes.
+// The candidates are tried in order (e.g. the real driver, then its demo), each for at most its probe timeout; the first one constructed replaces the placeholder.
+public class DeferredDevice : IDeviceHandler
+{
+	public record Candidate(string Name, Func<IDeviceHandler> Create, TimeSpan? ProbeTimeout = null);
+
+	private readonly string DeviceId;
+	private volatile IDeviceHandler? Device;
+	private bool IsDisposed = false;
+	private JsonElement? PendingSettings;
+	private event Action<object>? OnStateUpdate;
+	private event Action<object>? OnStatePatch;
+	private event Action<object>? OnStreamEvent;
+	private DeviceManager? DeviceManager;
+	private readonly MainDevice MainDevice;
+
+	public DeferredDevice(string deviceId, MainDevice mainDevice, params Candidate[] candidates)
+	{
+		DeviceId = deviceId;
+		MainDevice = mainDevice;
+		MainDevice.SetDeviceInitialization(DeviceId, new DeviceInitialization { Status = "initializing" });
+		Task.Run(() => InitializeAsync(candidates));
+	}
+
+	// The driver, once it's initialized.
+	public IDeviceHandler? Current => Device;
+
+	public bool IsReady => Device != null;
+
+	public DeviceMetrics Metrics { get; } = new();
+
+	private async Task InitializeAsync(Candidate[] candidates)
+	{
+		var stopwatch = Stopwatch.StartNew();
+		for (var i = 0; i < candidates.Length; i++)
+		{
+			var candidate = candidates[i];
+			var creation = Task.Run(candidate.Create);
+			try
+			{
+				var device = candidate.ProbeTimeout is TimeSpan timeout ? await creation.WaitAsync(timeout) : await creation;
+				var seconds = stopwatch.Elapsed.TotalSeconds;
+				Console.WriteLine($"Initialized {DeviceId} with {candidate.Name} in {seconds:F2} s");
+				Activate(device);
+				MainDevice.SetDeviceInitialization(DeviceId, new DeviceInitialization { Status = i == 0 ? "ready" : "fallback", Driver = candidate.Name, Seconds = seconds, Profile = PythonStartupProfile.Of(device) });
+				return;
+			}
+			catch (Exception e)
+			{
+				if (e is TimeoutException)
+				{
+					Console.WriteLine($"{candidate.Name} for {DeviceId} didn't respond within {candidate.ProbeTimeout!.Value.TotalSeconds} s");
+					// the constructor can't be interrupted, so a late driver gets disposed once it's done
+					_ = creation.ContinueWith(t => t.Result.Dispose(), TaskContinuationOptions.OnlyOnRanToCompletion);
+				}
+				if (i + 1 < candidates.Length)
+				{
+					Console.WriteLine($"Falling back to {candidates[i + 1].Name}");
+				}
+			}
+		}
+		MainDevice.SetDeviceInitialization(DeviceId, new DeviceInitialization { Status = "failed", Seconds = stopwatch.Elapsed.TotalSeconds });
+	}
+
+	private void Activate(IDeviceHandler device)
+	{
+		lock (this)
+		{
+			if (IsDisposed)
+			{
+				device.Dispose();
+				return;
+			}
+			if (DeviceManager != null) device.SetDeviceManager(DeviceManager);
+			DeviceMetrics.Attach(device, Metrics);
+			device.SubscribeToStateUpdates(state => OnStateUpdate?.Invoke(state));
+			device.SubscribeToStatePatches(patches => OnStatePatch?.Invoke(patches));
+			device.SubscribeToStreamEvents(data => OnStreamEvent?.Invoke(data));
+			if (PendingSettings is JsonElement settings)
+			{
+				try
+				{
+					device.LoadSettings(settings);
+				}
+				catch (Exception e)
+				{
+					Console.WriteLine("Error loading settings: " + e.Message);
+				}
+				PendingSettings = null;
+			}
+			Device = device;
+			// the clients and subscribed scripts didn't know the device's state so far;
+			// sent within the lock, such that it can't interleave with a concurrent Dispose
+			OnStateUpdate?.Invoke(device.GetState());
+		}
+	}
+
+	private IDeviceHandler GetDevice() => Device ?? throw new InvalidOperationException($"Device {DeviceId} is not available{(IsDisposed ? "" : " (yet)")}.");
+
+	public object HandleActionAsync(DeviceAction action) => GetDevice().HandleActionAsync(action);
+
+	public object GetState() => GetDevice().GetState();
+
+	public void SubscribeToStateUpdates(Action<object> onStateUpdate)
+	{
+		OnStateUpdate += onStateUpdate;
+	}
+
+	public void SubscribeToStatePatches(Action<object> onStatePatch)
+	{
+		OnStatePatch += onStatePatch;
+	}
+
+	public void SubscribeToStreamEvents(Action<object> onStreamEvent)
+	{
+		OnStreamEvent += onStreamEvent;
+	}
+
+	public void SetDeviceManager(DeviceManager deviceManager)
+	{
+		lock (this)
+		{
+			DeviceManager = deviceManager;
+			Device?.SetDeviceManager(deviceManager);
+		}
+	}
+
+	public void OnBeforeSaveSnapshot() => Device?.OnBeforeSaveSnapshot();
+
+	public void OnAfterSaveSnapshot() => Device?.OnAfterSaveSnapshot();
+
+	public object? OnSaveSnapshot(Func<string, Stream>? getStream, string deviceId) => Device?.OnSaveSnapshot(getStream, deviceId);
+
+	public Task OnRecord(Func<string, Stream> getStream, string deviceId, CancellationToken cancellationToken) => Device?.OnRecord(getStream, deviceId, cancellationToken) ?? Task.CompletedTask;
+
+	public object? GetSettings()
+	{
+		lock (this)
+		{
+			// keeps the settings of a device which didn't initialize (yet)
+			return Device != null ? Device.GetSettings() : PendingSettings;
+		}
+	}
+
+	public void LoadSettings(JsonElement settings)
+	{
+		lock (this)
+		{
+			if (Device == null)
+			{
+				PendingSettings = settings.Clone();
+				return;
+			}
+		}
+		Device.LoadSettings(settings);
+	}
+
+	public void Dispose()
+	{
+		lock (this)
+		{
+			IsDisposed = true;
+		}
+		Device?.Dispose();
+	}
+}
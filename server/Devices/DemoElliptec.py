@@ -1,21 +1,49 @@
+import time
+from typing import Callable
+
 state = {
     "channels": [
-        {"type": "rotation", "actualPosition": 123, "targetPosition": 123},
-        {"type": "rotation", "actualPosition": 123, "targetPosition": 123},
-        {"type": "rotation", "actualPosition": 123, "targetPosition": 123},
-        {"type": "rotation", "actualPosition": 123, "targetPosition": 123},
+        {"type": "rotation", "actualPosition": 123, "targetPosition": 123, "moving": False},
+        {"type": "rotation", "actualPosition": 123, "targetPosition": 123, "moving": False},
+        {"type": "rotation", "actualPosition": 123, "targetPosition": 123, "moving": False},
+        {"type": "rotation", "actualPosition": 123, "targetPosition": 123, "moving": False},
     ]
 }
 
+send_status_update: Callable[[], None]
+periodic: Callable
+
+# like the real stages, which report it via "moving", a move takes a while
+move_time = 0.2
+# channel -> time.monotonic() at which the ongoing move arrives
+arrival_times = {}
+
 
 def set_position(channel, position):
     if channel < 0 or channel >= len(state["channels"]):
         raise Exception("Invalid channel number")
-    channel = state["channels"][channel]
-    channel["targetPosition"] = position
-    channel["actualPosition"] = position - 0.2
+    channel_state = state["channels"][channel]
+    channel_state["targetPosition"] = position
+    channel_state["moving"] = True
+    arrival_times[channel] = time.monotonic() + move_time
     send_status_update()
 
 
+async def main():
+    async for _ in periodic(0.05):
+        now = time.monotonic()
+        arrived = False
+        for channel, arrival_time in list(arrival_times.items()):
+            if arrival_time > now:
+                continue
+            del arrival_times[channel]
+            channel_state = state["channels"][channel]
+            channel_state["actualPosition"] = channel_state["targetPosition"] - 0.2
+            channel_state["moving"] = False
+            arrived = True
+        if arrived:
+            send_status_update()
+
+
 def on_save_snapshot():
     return [channel["actualPosition"] for channel in state["channels"]]
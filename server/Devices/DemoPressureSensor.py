@@ -1,4 +1,38 @@
+import random
+import time
+from timeseries import ChannelHistory, RecordedSeries
+
+is_running: bool
+send_status_update: callable
+
 state = {"channels": [{"pressure": 9876, "status": "ok"}, {"pressure": 5432, "status": "ok"}]}
+history = ChannelHistory(24 * 3600, len(state["channels"]))
+recording: RecordedSeries = None
+
+
+def main():
+    # like the real sensor, a reading per second
+    while is_running:
+        for channel, pressure in zip(state["channels"], [9876, 5432]):
+            channel["pressure"] = pressure * (1 + random.gauss(0, 1e-3))
+        t = time.time()
+        readings = [channel["pressure"] for channel in state["channels"]]
+        history.add(t, readings)
+        if recording is not None:
+            recording.write(t, readings)
+        for i, channel in enumerate(state["channels"]):
+            channel["statistics"] = history.statistics(i)
+        send_status_update()
+        time.sleep(1)
+
+
+def get_history(channel, t_start=None, t_end=None, max_points=1000):
+    return history.query(int(channel), t_start, t_end, max_points)
+
+
+def on_record(get_stream):
+    global recording
+    recording = RecordedSeries(get_stream, ["C1", "C2"])
 
 
 def on_save_snapshot():
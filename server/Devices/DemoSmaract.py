@@ -1,13 +1,16 @@
-import time
 import random
+import time
 from typing import Callable
+from timeseries import RecordedSeries
 
 state = {"channels": []}
 
 is_running: bool
 send_status_update: Callable[[], None]
+periodic: Callable
 
 num_channels = 0
+recording: RecordedSeries = None
 
 
 def move_to(iChannel, position, mode):
@@ -40,7 +43,7 @@ def stop():
     pass
 
 
-def main():
+async def main():
     global num_channels
     num_channels = 3
     for i in range(num_channels):
@@ -55,11 +58,17 @@ def main():
             }
         )
 
-    while is_running:
+    async for _ in periodic(0.1):
         for i in range(num_channels):
             target_position = state["channels"][i]["targetPosition"]
             state["channels"][i]["actualPosition"] = target_position + random.uniform(
                 -0.1, 0.1
             )
+        if recording is not None:
+            recording.write(time.time(), [channel["actualPosition"] for channel in state["channels"]])
         send_status_update()
-        time.sleep(0.1)
+
+
+def on_record(get_stream):
+    global recording
+    recording = RecordedSeries(get_stream, [f"C{i + 1}" for i in range(num_channels)])
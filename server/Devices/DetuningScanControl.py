@@ -1,80 +1,160 @@
 import json
+import threading
 import time
+import numpy as np
 
-state = {"measurementPlan": "[]"}
+state = {
+    "measurementPlan": "[]",
+    "scan": {"running": False, "segment": 0, "segments": 0, "startedAt": None, "plannedDuration": 0, "cancelled": False, "error": None},
+}
 
 argv: any
 is_running: bool
 send_status_update: callable
 get_device_state: callable
+wait_for_state: callable
 action: callable
+action_batch: callable
+
+pending_scan = None
+scan_requested = threading.Event()
+cancel_requested = threading.Event()
+# whether the recording of the current segment was started by the scan, only
+# such a recording is stopped by cancelScan
+segment_recording = False
+segment_recording_lock = threading.Lock()
 
 
 def saveMeasurementPlan(measurementPlan):
     state["measurementPlan"] = measurementPlan
 
 
+def parse_measurement_plan(measurementPlan):
+    """Returns the offsets and durations (in minutes) of the plan's segments as arrays."""
+    plan = json.loads(measurementPlan)
+    if not isinstance(plan, list):
+        raise Exception("Measurement plan must be a list")
+    try:
+        offsets = [measurement["offset"] for measurement in plan]
+        durations = [measurement["duration"] for measurement in plan]
+    except (KeyError, TypeError):
+        raise Exception("Measurement plan must contain 'offset' and 'duration' keys")
+    if not {type(value) for value in offsets + durations} <= {int, float}:
+        raise Exception("'offset' and 'duration' must be numbers")
+    offsets = np.array(offsets, dtype=np.float64)
+    durations = np.array(durations, dtype=np.float64)
+    invalid = np.flatnonzero(durations <= 0)
+    if len(invalid):
+        raise Exception(f"'duration' must be greater than 0 (segment {invalid[0]})")
+    invalid = np.flatnonzero(np.abs(offsets) > 10e6)
+    if len(invalid):
+        raise Exception(f"'offset' must be within +-10 MHz (segment {invalid[0]})")
+    return offsets, durations
+
+
 def startScan(measurementPlan):
+    global pending_scan
+    if state["scan"]["running"] or scan_requested.is_set():
+        raise Exception("A scan is already running")
     state["measurementPlan"] = measurementPlan
-    measurementPlan = json.loads(measurementPlan)
-    main_state = get_device_state("main")
-    initial_filename = main_state["Filename"]
+    offsets, durations = parse_measurement_plan(measurementPlan)
+    if len(offsets) == 0:
+        return
     rfgen_state = get_device_state("cavity_detuning")
     base_frequency = rfgen_state["channels"][0]["frequency"]
     if base_frequency < 8e9 or base_frequency > 10e9:
         raise Exception(f"Cavity detuning generator frequency ({base_frequency/1e3} kHz) is out of range (8-10 GHz)")
-    measurements = []
-    for measurement in measurementPlan:
-        if "offset" not in measurement or "duration" not in measurement:
-            raise Exception(
-                "Measurement plan must contain 'offset' and 'duration' keys"
-            )
-        if not isinstance(measurement["offset"], (int, float)) or not isinstance(
-            measurement["duration"], (int, float)
-        ):
-            raise Exception("'offset' and 'duration' must be numbers")
-        if measurement["duration"] <= 0:
-            raise Exception("'duration' must be greater than 0")
-        if measurement["offset"] < -10e6 or measurement["offset"] > 10e6:
-            raise Exception("'offset' must be within +-10 MHz")
-        measurements.append(
-            {
-                "frequency": base_frequency + measurement["offset"],
-                "duration": measurement["duration"],
-            }
-        )
+    # the scan itself runs in main(), such that this action returns right away
+    pending_scan = (base_frequency + offsets, (durations * 60).astype(int), base_frequency)
+    cancel_requested.clear()
+    scan_requested.set()
+
+
+def cancelScan():
+    if not state["scan"]["running"] and not scan_requested.is_set():
+        return
+    with segment_recording_lock:
+        cancel_requested.set()
+        stop_recording = segment_recording
+    if stop_recording:
+        # ends the current segment, which wakes up the scan
+        action("main", None, "stopRecording", [])
 
+
+def set_segment_recording(recording):
+    """Returns whether the scan was cancelled meanwhile."""
+    global segment_recording
+    with segment_recording_lock:
+        segment_recording = recording
+        return cancel_requested.is_set()
+
+
+def run_scan(frequencies, durations, base_frequency):
+    initial_filename = get_device_state("main")["Filename"]
+    scan = state["scan"]
+    scan.update(running=True, segment=0, segments=len(frequencies), startedAt=time.time(), plannedDuration=int(durations.sum()), cancelled=False, error=None)
+    send_status_update()
     try:
-        for i, measurement in enumerate(measurements):
-            action("main", None, "setFilename", [f"{initial_filename} SCAN_{i}"])
-            action(
-                "cavity_detuning", None, "set_frequency", [0, measurement["frequency"]]
-            )
-            action("main", None, "startRecording", [int(measurement["duration"] * 60)])
-            action(
-                "main",
-                None,
-                "setRemainingAdditionalRecordings",
-                [len(measurements) - i - 1],
-            )
-            while is_running:
-                main_state = get_device_state("main")
-                if not main_state["IsRecording"]:
-                    break
-                time.sleep(0.25)
+        action("main", None, "setFilename", [f"{initial_filename} SCAN_0"])
+        for i, (frequency, duration) in enumerate(zip(frequencies, durations)):
+            if cancel_requested.is_set() or not is_running:
+                break
+            # the main device finalizes the previous recording in the background,
+            # so the next segment starts as soon as the previous one stopped;
+            # a segment which can't be started doesn't leave the detuning changed
+            step = [
+                ("cavity_detuning", None, "set_frequency", [0, float(frequency)], ("cavity_detuning", None, "set_frequency", [0, base_frequency])),
+                ("main", None, "startRecording", [int(duration)], ("main", None, "stopRecording", [])),
+                ("main", None, "setRemainingAdditionalRecordings", [len(frequencies) - i - 1]),
+            ]
+            if i + 1 < len(frequencies):
+                # the filename is only read when a recording starts
+                step.append(("main", None, "setFilename", [f"{initial_filename} SCAN_{i + 1}"]))
+            action_batch(step, atomic=True)
+            if set_segment_recording(True):
+                # cancelled while the segment was started
+                action("main", None, "stopRecording", [])
+            scan["segment"] = i
+            send_status_update()
+            wait_for_state("main", lambda main_state: main_state["IsRecording"] or cancel_requested.is_set(), timeout=5)
+            wait_for_state("main", lambda main_state: not main_state["IsRecording"] or cancel_requested.is_set())
+            set_segment_recording(False)
     finally:
-        action("main", None, "setRemainingAdditionalRecordings", [0])
-        action("main", None, "setFilename", [initial_filename])
-        action("cavity_detuning", None, "set_frequency", [0, base_frequency])
+        set_segment_recording(False)
+        # a failing action mustn't skip the remaining ones
+        action_batch([
+            ("main", None, "setRemainingAdditionalRecordings", [0]),
+            ("main", None, "setFilename", [initial_filename]),
+            ("cavity_detuning", None, "set_frequency", [0, base_frequency]),
+        ], best_effort=True)
+        scan["running"] = False
+        scan["cancelled"] = cancel_requested.is_set()
+        send_status_update()
+
+
+def main():
+    global pending_scan
+    while is_running:
+        if not scan_requested.wait(1):
+            continue
+        frequencies, durations, base_frequency = pending_scan
+        pending_scan = None
+        try:
+            run_scan(frequencies, durations, base_frequency)
+        except Exception as e:
+            print(f"DetuningScanControl: error {e}")
+            state["scan"]["error"] = str(e)
+            send_status_update()
+        finally:
+            scan_requested.clear()
 
 
 def get_settings():
-    return state
+    return {"measurementPlan": state["measurementPlan"]}
 
 
 def load_settings(settings):
-    global state
-    state = settings
+    state["measurementPlan"] = settings.get("measurementPlan", state["measurementPlan"])
 
 
 def on_save_snapshot():
@@ -6,6 +6,7 @@ public interface IDeviceHandler : IDisposable
 	object HandleActionAsync(DeviceAction action);
 	object GetState();
 	void SubscribeToStateUpdates(Action<object> onStateUpdate);
+	void SubscribeToStatePatches(Action<object> onStatePatch);
 	void SubscribeToStreamEvents(Action<object> onStreamEvent);
 	void SetDeviceManager(DeviceManager deviceManager);
 	void OnBeforeSaveSnapshot();
@@ -87,6 +88,9 @@ public abstract class DeviceHandlerBase<TState> : IDeviceHandler where TState :
 		OnStateUpdate += onStateUpdate;
 	}
 
+	// C# devices always publish partial state updates
+	public void SubscribeToStatePatches(Action<object> onStatePatch) { }
+
 	public void SubscribeToStreamEvents(Action<object> onStreamEvent)
 	{
 		OnStreamEvent += onStreamEvent;
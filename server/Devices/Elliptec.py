@@ -1,6 +1,8 @@
 import elliptec
+import threading
 import time
 from typing import Callable, Any
+from timeseries import RecordedSeries
 
 state = {"channels": []}
 
@@ -10,6 +12,57 @@ send_status_update: Callable[[], None]
 
 controller: elliptec.Controller = None
 motors = []
+recording: RecordedSeries = None
+
+# Positions are polled every `fastPollInterval` seconds while a motor is on its
+# way, afterwards the interval doubles up to `slowPollInterval`. Errors on the
+# bus back off up to `maxBackoff` seconds.
+fast_poll_interval = getattr(argv, "fastPollInterval", 0.2)
+slow_poll_interval = getattr(argv, "slowPollInterval", 20)
+max_backoff = getattr(argv, "maxBackoff", 30)
+max_move_attempts = 5
+position_tolerance = {"linear": 1e-3, "rotation": 1e-2, "slider": 0}
+
+
+class Motor:
+    # Bus bookkeeping of a channel; all bus accesses happen on the thread running main()
+    def __init__(self, device, type, address):
+        self.device = device
+        self.type = type
+        self.address = address
+        self.poll_interval = fast_poll_interval
+        self.next_poll = 0
+        self.failures = 0
+        self.move_attempts = 0
+        # a move whose completion reply didn't arrive within the controller's timeout
+        self.awaiting_completion = False
+
+    def get_position(self):
+        if self.type == "linear":
+            return self.device.get_distance()
+        if self.type == "rotation":
+            return self.device.get_angle()
+        return self.device.get_slot()
+
+    def move_to(self, position):
+        # blocks until the motor replies with its position after arriving
+        if self.type == "linear":
+            return self.device.set_distance(position)
+        if self.type == "rotation":
+            return self.device.set_angle(position)
+        return self.device.set_slot(position)
+
+    def from_pulses(self, pulses):
+        if self.type == "linear":
+            return self.device.pos_to_dist(pulses)
+        if self.type == "rotation":
+            return self.device.pos_to_angle(pulses)
+        return self.device.pos_to_slot(pulses)
+
+
+pending_moves = {}
+pending_moves_lock = threading.Lock()
+wake_up = threading.Event()
 
 
 def set_position(channel, position):
@@ -17,35 +70,12 @@ def set_position(channel, position):
         raise Exception("Invalid channel number")
     channel_state = state["channels"][channel]
     channel_state["targetPosition"] = position
-    send_status_update()
-    
-    motor = motors[channel]
-    if channel_state["type"] == "linear":
-        for _ in range(5):
-            try:
-                motor.set_distance(channel_state["targetPosition"])
-                # channel_state["actualPosition"] = motor.get_distance()
-                break
-            except:
-                pass
-    elif channel_state["type"] == "rotation":
-        for _ in range(5):
-            try:
-                motor.set_angle(channel_state["targetPosition"])
-                # channel_state["actualPosition"] = motor.get_angle()
-                break
-            except:
-                pass
-    elif channel_state["type"] == "slider":
-        for _ in range(5):
-            try:
-                motor.set_slot(channel_state["targetPosition"])
-                # channel_state["actualPosition"] = motor.get_slot()
-                break
-            except:
-                pass
-    else:
-        raise Exception("Invalid channel type")
+    channel_state["moving"] = True
+    with pending_moves_lock:
+        # only the latest target of a channel matters
+        pending_moves[channel] = position
+        motors[channel].move_attempts = 0
+    wake_up.set()
     send_status_update()
 
 
@@ -53,58 +83,151 @@ def on_save_snapshot():
     return [channel["actualPosition"] for channel in state["channels"]]
 
 
+def on_record(get_stream):
+    global recording
+    recording = RecordedSeries(get_stream, [f"C{i + 1}" for i in range(len(motors))])
+    recording.write(time.time(), [channel["actualPosition"] for channel in state["channels"]])
+
+
 if not hasattr(argv, "port"):
     raise Exception("Missing 'port' in Elliptec device parameters")
 if not hasattr(argv, "channels"):
     raise Exception("Missing 'channels' in Elliptec device parameters")
 
-controller = elliptec.Controller(argv.port, debug=False)
+port = argv.port
+if getattr(argv, "simulate", False):
+    from simulated_instruments import SimulatedELLxBus
+    simulated_bus = SimulatedELLxBus({ch.address: ch.type for ch in argv.channels}, error_rate=getattr(argv, "simulatedErrorRate", 0))
+    port = simulated_bus.port
+
+controller = elliptec.Controller(port, debug=False)
 for ch in argv.channels:
     if ch.type == "linear":
-        motor = elliptec.Linear(controller, ch.address, False)
-        motors.append(motor)
-        position = motor.get_distance()
-        state["channels"].append(
-            {"type": "linear", "actualPosition": position, "targetPosition": position}
-        )
+        device = elliptec.Linear(controller, ch.address, False)
     elif ch.type == "rotation":
-        motor = elliptec.Rotator(controller, ch.address, False)
-        motors.append(motor)
-        position = motor.get_angle()
-        state["channels"].append(
-            {"type": "rotation", "actualPosition": position, "targetPosition": position}
-        )
+        device = elliptec.Rotator(controller, ch.address, False)
     elif ch.type == "slider":
-        motor = elliptec.Slider(controller, ch.address, False)
-        motors.append(motor)
-        position = motor.get_slot()
-        state["channels"].append(
-            {"type": "slider", "actualPosition": position, "targetPosition": position}
-        )
+        device = elliptec.Slider(controller, ch.address, False)
     else:
         raise Exception("Invalid channel type")
+    motor = Motor(device, ch.type, ch.address)
+    motors.append(motor)
+    position = motor.get_position()
+    state["channels"].append(
+        {"type": ch.type, "actualPosition": position, "targetPosition": position, "moving": False, "error": None}
+    )
+
+
+def is_close(a, b, type):
+    return a is not None and b is not None and abs(a - b) <= position_tolerance[type]
+
+
+def collect_late_replies():
+    # Completion replies of moves which took longer than the controller's
+    # timeout arrive later on; they are consumed before sending the next command.
+    changed = False
+    while controller.s.in_waiting:
+        reply = controller.s.read_until(b"\r\n")
+        if not reply.endswith(b"\r\n"):
+            break
+        reply = reply.decode().strip()
+        address, code, value = reply[:1], reply[1:3].upper(), reply[3:]
+        for motor, channel_state in zip(motors, state["channels"]):
+            if motor.address != address:
+                continue
+            if code == "PO":
+                pulses = int(value, 16)
+                channel_state["actualPosition"] = motor.from_pulses(pulses - (pulses >> 31 << 32))
+                motor.awaiting_completion = False
+                changed = True
+            elif code == "GS" and int(value, 16) not in (0, 9):
+                channel_state["error"] = f"status {int(value, 16)}"
+                motor.awaiting_completion = False
+                changed = True
+    return changed
+
+
+def back_off(index, error):
+    motor = motors[index]
+    motor.failures += 1
+    motor.next_poll = time.monotonic() + min(fast_poll_interval * 2 ** motor.failures, max_backoff)
+    state["channels"][index]["error"] = str(error)
+    print(f"Elliptec: channel {index}: {error}")
+    try:
+        # start over with an empty buffer, such that replies don't get mixed up
+        controller.s.reset_input_buffer()
+    except Exception:
+        pass
+    return True
+
+
+def move(index, target):
+    motor = motors[index]
+    channel_state = state["channels"][index]
+    try:
+        collect_late_replies()
+        position = motor.move_to(target)
+    except Exception as e:
+        with pending_moves_lock:
+            motor.move_attempts += 1
+            if motor.move_attempts < max_move_attempts:
+                pending_moves.setdefault(index, target)
+        return back_off(index, e)
+    motor.failures = 0
+    motor.move_attempts = 0
+    channel_state["error"] = None
+    if position is None:
+        # still moving (the reply is collected later on) or refused, which the next poll tells
+        motor.awaiting_completion = True
+    else:
+        channel_state["actualPosition"] = position
+        channel_state["moving"] = not is_close(position, channel_state["targetPosition"], motor.type)
+    motor.poll_interval = fast_poll_interval
+    motor.next_poll = time.monotonic() + fast_poll_interval
+    return True
+
+
+def poll(index):
+    motor = motors[index]
+    channel_state = state["channels"][index]
+    try:
+        changed = collect_late_replies()
+        position = motor.get_position()
+        if position is None:
+            raise Exception("no valid position reply")
+    except Exception as e:
+        return back_off(index, e)
+    moved = not is_close(position, channel_state["actualPosition"], motor.type)
+    moving = (moved or motor.awaiting_completion) and not is_close(position, channel_state["targetPosition"], motor.type)
+    changed |= moved or moving != channel_state["moving"] or channel_state["error"] is not None
+    motor.failures = 0
+    channel_state["actualPosition"] = position
+    channel_state["moving"] = moving
+    channel_state["error"] = None
+    if not moving:
+        motor.awaiting_completion = False
+    motor.poll_interval = fast_poll_interval if moving else min(2 * motor.poll_interval, slow_poll_interval)
+    motor.next_poll = time.monotonic() + motor.poll_interval
+    return changed
 
 
 def main():
-    while True:
-        for motor, st in zip(motors, state["channels"]):
-            if st["type"] == "linear":
-                try:
-                    st["actualPosition"] = motor.get_distance()
-                except:
-                    pass
-            elif st["type"] == "rotation":
-                try:
-                    st["actualPosition"] = motor.get_angle()
-                except:
-                    pass
-            elif st["type"] == "slider":
-                try:
-                    st["actualPosition"] = motor.get_slot()
-                except:
-                    pass
-            else:
-                raise Exception("Invalid channel type")
-
-        send_status_update()
-        time.sleep(20)
+    while is_running:
+        wake_up.clear()
+        changed = False
+        for index, motor in enumerate(motors):
+            if motor.failures > 0 and motor.next_poll > time.monotonic():
+                continue
+            with pending_moves_lock:
+                target = pending_moves.pop(index, None)
+            if target is not None:
+                changed |= move(index, target)
+            elif motor.next_poll <= time.monotonic():
+                changed |= poll(index)
+
+        if changed:
+            if recording is not None:
+                recording.write(time.time(), [channel["actualPosition"] for channel in state["channels"]])
+            send_status_update()
+        next_poll = min((motor.next_poll for motor in motors), default=time.monotonic() + slow_poll_interval)
+        wake_up.wait(max(0, next_poll - time.monotonic()))
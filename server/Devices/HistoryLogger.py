@@ -0,0 +1,108 @@
+import threading
+import time
+
+from timeseries import ColumnStore
+
+argv: any
+is_running: bool
+subscribe_device_state: callable
+send_status_update: callable
+
+# Logs the numeric fields of the states of `devices` between recordings into a
+# column store, one series per field (e.g. `pressure/channels.1.pressure`).
+# Values are logged when they change, and at least every `heartbeatInterval`.
+# Only devices with slow-control values should be listed, every update of
+# their states is flattened.
+devices = list(argv.devices)
+directory = getattr(argv, "directory", "history")
+chunk_size = getattr(argv, "chunkSize", 4096)
+flush_interval = getattr(argv, "flushInterval", 10)
+heartbeat_interval = getattr(argv, "heartbeatInterval", 60)
+# longer lists are traces rather than slow-control values
+max_list_length = getattr(argv, "maxListLength", 16)
+
+store = ColumnStore(directory, chunk_size)
+# series name -> (time, value) last logged
+last_logged = {}
+last_logged_lock = threading.Lock()
+
+state = {"directory": directory, "devices": [], "series": len(store.names()), "samples": 0, "lastFlush": None}
+
+
+def numeric_fields(value, path=""):
+    """Yields the `(path, value)` pairs of the numbers within a state, e.g. `("channels.1.pressure", 1e-9)`."""
+    if isinstance(value, bool):
+        return
+    if isinstance(value, (int, float)):
+        yield path, float(value)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from numeric_fields(item, f"{path}.{key}" if path else str(key))
+    elif isinstance(value, list) and len(value) <= max_list_length:
+        for index, item in enumerate(value):
+            yield from numeric_fields(item, f"{path}.{index}" if path else str(index))
+
+
+def log_state(device_name, device_state):
+    if device_state is None:
+        return
+    t = time.time()
+    logged = 0
+    for field, value in numeric_fields(device_state):
+        name = ColumnStore.to_name(device_name, field)
+        with last_logged_lock:
+            last = last_logged.get(name)
+            if last is not None and last[1] == value and t - last[0] < heartbeat_interval:
+                continue
+            last_logged[name] = (t, value)
+        store.append(name, t, value)
+        logged += 1
+    state["samples"] += logged
+
+
+def subscribe_pending_devices():
+    for device_name in devices:
+        if device_name in state["devices"]:
+            continue
+        try:
+            subscribe_device_state(device_name, lambda device_state, device_name=device_name: log_state(device_name, device_state))
+        except Exception:
+            # not registered yet
+            continue
+        state["devices"].append(device_name)
+
+
+def query(name, t_start=None, t_end=None, max_points=1000):
+    """Min/max-decimated trace of a series; negative times are relative to now, e.g. `t_start=-86400` for the last day."""
+    now = time.time()
+    if t_start is not None and t_start < 0:
+        t_start += now
+    if t_end is not None and t_end < 0:
+        t_end += now
+    return store.query(name, t_start, t_end, max_points)
+
+
+def list_series():
+    return store.names()
+
+
+def flush():
+    store.flush()
+    state["lastFlush"] = time.time()
+    state["series"] = len(store.names())
+    send_status_update()
+
+
+def main():
+    next_flush = time.time() + flush_interval
+    while is_running:
+        subscribe_pending_devices()
+        if time.time() >= next_flush:
+            flush()
+            next_flush += flush_interval
+        time.sleep(1)
+    store.flush()
+
+
+def on_save_snapshot():
+    return None
@@ -1,3 +1,4 @@
+using System.Collections.Concurrent;
 using System.Text.Json;
 using System.Text.RegularExpressions;
 
@@ -10,6 +11,16 @@ public class MainState
 	public int RecordingTimeSeconds { get; set; } = 0;
 	public int PlannedRecordingTimeSeconds { get; set; } = 0;
 	public int RemainingAdditionalRecordings { get; set; } = 0;
+	public ConcurrentDictionary<string, DeviceInitialization> DeviceInitialization { get; set; } = new();
+}
+
+public class DeviceInitialization
+{
+	// "initializing", "ready", "fallback" (to the demo driver) or "failed"
+	public string Status { get; set; } = "";
+	public string? Driver { get; set; }
+	public double? Seconds { get; set; }
+	public PythonStartupProfile? Profile { get; set; }
 }
 
 public class MainDevice : DeviceHandlerBase<MainState>
@@ -50,6 +61,12 @@ public class MainDevice : DeviceHandlerBase<MainState>
 		SendStateUpdate(new { State.PendingActions });
 	}
 
+	public void SetDeviceInitialization(string deviceId, DeviceInitialization initialization)
+	{
+		State.DeviceInitialization[deviceId] = initialization;
+		SendStateUpdate(new { State.DeviceInitialization });
+	}
+
 	public void SetSaveDirectory(string directory)
 	{
 		State.SaveDirectory = directory;
@@ -70,6 +87,9 @@ public class MainDevice : DeviceHandlerBase<MainState>
 				if (path.Length != 2)
 					return statePath;
 				var state = DeviceManager!.Devices[path[0]].GetState();
+				// Python devices hand out their serialized state
+				if (state is SerializedPayload payload)
+					state = payload.ToDynamic();
 				if (state is IDictionary<string, object> dict && dict.TryGetValue(path[1], out var value))
 					return value.ToString() ?? statePath;
 				return statePath;
@@ -0,0 +1,89 @@
+using System.Diagnostics;
+
+public class DeviceMetricsSummary
+{
+	public long Actions { get; set; }
+	public double? ActionMeanMs { get; set; }
+	public double? ActionP99Ms { get; set; }
+	public double? GetStateMeanMs { get; set; }
+	public double? SaveSnapshotMeanMs { get; set; }
+	public double? GilWaitMeanMs { get; set; }
+	public double? GilHoldMeanMs { get; set; }
+	public double StatusUpdatesPerSecond { get; set; }
+	public double StatusUpdateBytesPerSecond { get; set; }
+	public double? MainLoopPeriodMs { get; set; }
+	public double? MainLoopJitterMs { get; set; }
+}
+
+public class MetricsState
+{
+	public Dictionary<string, DeviceMetricsSummary> Devices { get; set; } = new();
+}
+
+// Publishes a summary of DeviceManager.Metrics; the full histograms are served by /api/metrics.
+public class MetricsDevice : DeviceHandlerBase<MetricsState>
+{
+	private readonly TimeSpan UpdateInterval = TimeSpan.FromSeconds(2);
+	private readonly Timer UpdateTimer;
+	private readonly Dictionary<string, (long StatusUpdates, long StatusUpdateBytes)> LastCounters = new();
+	private long LastUpdate = Stopwatch.GetTimestamp();
+
+	public MetricsDevice()
+	{
+		UpdateTimer = new Timer(_ => Update(), null, UpdateInterval, UpdateInterval);
+	}
+
+	private static double? Mean(LatencyHistogram histogram)
+	{
+		var count = histogram.Count;
+		return count == 0 ? null : histogram.Sum / count * 1e3;
+	}
+
+	private static double? Mean(IEnumerable<LatencyHistogram> histograms)
+	{
+		var count = histograms.Sum(histogram => histogram.Count);
+		return count == 0 ? null : histograms.Sum(histogram => histogram.Sum) / count * 1e3;
+	}
+
+	private void Update()
+	{
+		if (DeviceManager == null) return;
+		var now = Stopwatch.GetTimestamp();
+		var seconds = (now - LastUpdate) / (double)Stopwatch.Frequency;
+		LastUpdate = now;
+		var devices = new Dictionary<string, DeviceMetricsSummary>();
+		foreach (var (deviceId, metrics) in DeviceManager.Metrics)
+		{
+			var counters = (Interlocked.Read(ref metrics.StatusUpdates), Interlocked.Read(ref metrics.StatusUpdateBytes));
+			var lastCounters = LastCounters.GetValueOrDefault(deviceId, counters);
+			LastCounters[deviceId] = counters;
+			var gil = metrics.Gil.Values.ToList();
+			var loopTiming = metrics.GetLoopTiming();
+			devices[deviceId] = new DeviceMetricsSummary
+			{
+				Actions = metrics.ActionLatency.Count,
+				ActionMeanMs = Mean(metrics.ActionLatency),
+				// the unbounded last bucket (> 10 s) can't be represented in JSON
+				ActionP99Ms = metrics.ActionLatency.Quantile(0.99) is double p99 && double.IsFinite(p99) ? p99 * 1e3 : null,
+				GetStateMeanMs = Mean(metrics.GetStateDuration),
+				SaveSnapshotMeanMs = Mean(metrics.SaveSnapshotDuration),
+				GilWaitMeanMs = Mean(gil.Select(histograms => histograms.Wait)),
+				GilHoldMeanMs = Mean(gil.Select(histograms => histograms.Hold)),
+				StatusUpdatesPerSecond = (counters.Item1 - lastCounters.Item1) / seconds,
+				StatusUpdateBytesPerSecond = (counters.Item2 - lastCounters.Item2) / seconds,
+				MainLoopPeriodMs = loopTiming?.Period * 1e3,
+				MainLoopJitterMs = loopTiming?.Jitter * 1e3,
+			};
+		}
+		State.Devices = devices;
+		SendStateUpdate(new { State.Devices });
+	}
+
+	// the metrics describe the server, not the experiment
+	public override object? OnSaveSnapshot(Func<string, Stream>? getStream, string deviceId) => null;
+
+	public override void Dispose()
+	{
+		UpdateTimer.Dispose();
+	}
+}
@@ -1,72 +1,204 @@
+import threading
 import time
-from openai import OpenAI
-from slack_sdk import WebClient
+from concurrent.futures import ThreadPoolExecutor
 
 argv: any
 is_running: bool
-get_device_state: callable
+wait_for_state: callable
+subscribe_device_state: callable
 send_status_update: callable
+lazy_import: callable
 
-state = {"name": ""}
+# both are only loaded when they're used
+openai = lazy_import("openai")
+slack_sdk = lazy_import("slack_sdk")
+
+pressure_device_name = getattr(argv, "pressureDeviceName", "pressure")
+pressure_channel = getattr(argv, "pressureChannel", 1)
+# a new particle is assumed once the pressure drops below the threshold,
+# the detection is armed again only after it rose above `rearmPressure`
+pressure_threshold = getattr(argv, "pressureThreshold", 1e-2)
+rearm_pressure = getattr(argv, "rearmPressure", 2e-2)
+# seconds to wait for the current pressure when starting to watch it
+pressure_timeout = getattr(argv, "pressureTimeout", 5)
+# per attempt of an outbound call, in seconds
+request_timeout = getattr(argv, "requestTimeout", 20)
+max_attempts = getattr(argv, "maxAttempts", 3)
+max_pending_tasks = getattr(argv, "maxPendingTasks", 4)
+# e.g. local stand-ins of the APIs for testing
+openai_base_url = getattr(argv, "openai_base_url", None)
+slack_base_url = getattr(argv, "slack_base_url", None)
+
+state = {"name": "", "pendingTasks": 0, "lastError": None}
+
+# The API calls run one after another on a single background thread, such
+# that the pressure watch never waits for them. Only the executor's thread
+# touches the clients and caches below.
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ParticleName")
+pending_tasks_lock = threading.Lock()
+openai_client = None
+slack_client = None
+# generated ahead of time (and kept in the settings), such that the next particle is named right away
+prefetched_name = None
+# whether the pressure was above `rearmPressure` since the last new particle
+armed = False
 
 
 def get_settings():
-    return state
+    return {"name": state["name"], "nextName": prefetched_name}
 
 
 def load_settings(settings):
-    global state
-    state = settings
+    global prefetched_name
+    state["name"] = settings.get("name", state["name"])
+    prefetched_name = settings.get("nextName", prefetched_name)
+
+
+def submit(task):
+    """Runs `task` in the background; returns False if too many tasks are pending already."""
+    with pending_tasks_lock:
+        if state["pendingTasks"] >= max_pending_tasks:
+            return False
+        state["pendingTasks"] += 1
+
+    def run():
+        try:
+            task()
+            state["lastError"] = None
+        except Exception as e:
+            print(f"ParticleName: {e}")
+            state["lastError"] = str(e)
+        finally:
+            with pending_tasks_lock:
+                state["pendingTasks"] -= 1
+            send_status_update()
+
+    executor.submit(run)
+    send_status_update()
+    return True
+
 
+def with_retries(description, call):
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return call()
+        except Exception as e:
+            if attempt == max_attempts or not is_running:
+                raise Exception(f"{description} failed: {e}") from e
+            delay = 2**attempt
+            print(f"ParticleName: {description} failed ({e}), retrying in {delay} s")
+            time.sleep(delay)
+
+
+def get_openai_client() -> "openai.OpenAI":
+    global openai_client
+    if openai_client is None:
+        if not getattr(argv, "openai_api_key", None):
+            raise Exception("OpenAI API key not provided")
+        # the retries are handled by `with_retries`
+        openai_client = openai.OpenAI(api_key=argv.openai_api_key, base_url=openai_base_url, timeout=request_timeout, max_retries=0)
+    return openai_client
+
+
+def get_slack_client() -> "slack_sdk.WebClient":
+    global slack_client
+    if slack_client is None:
+        options = {"base_url": slack_base_url} if slack_base_url else {}
+        slack_client = slack_sdk.WebClient(token=argv.slack_token, timeout=request_timeout, **options)
+    return slack_client
 
-def generate_particle_name(client: OpenAI):
-    name = client.responses.create(
+
+def generate_particle_name():
+    name = with_retries("Generating a name", lambda: get_openai_client().responses.create(
         model="gpt-4o",
         input="Output a first and a given name for a solid nanoparticle which is used in a physics experiment. It should be close to an ordinary English name, just with a _slight_ fun quantum twist. But not just adding quantum; and it should be a reasonable name. Output just the total name.",
         temperature=1,
-    ).output_text
+    ).output_text)
     return name.strip()
 
 
-def send_welcome_message(openAI_client, name):
+def send_welcome_message(name):
+    if not getattr(argv, "slack_token", None) or not getattr(argv, "slack_channel", None):
+        print("ParticleName: Slack token or channel not provided.")
+        return
+    message = with_retries("Generating the welcome message", lambda: get_openai_client().responses.create(
+        model="gpt-4o",
+        input=f'Write a funny welcome message for a nanoparticle named "{name}", which is trapped in a laser field and gonna be cooled and used in a quantum physics experiment. It shouldn\'t be longer than 2 sentences.',
+        temperature=1,
+    ).output_text)
+    # the message isn't generated again if only posting it fails
+    with_retries("Posting the welcome message", lambda: get_slack_client().chat_postMessage(channel=argv.slack_channel, text=message))
+
+
+def prefetch_name():
+    global prefetched_name
+    if prefetched_name is None:
+        prefetched_name = generate_particle_name()
+
+
+def name_new_particle(welcome=True):
+    global prefetched_name
+    name, prefetched_name = prefetched_name, None
+    state["name"] = name or generate_particle_name()
+    send_status_update()
+    if welcome:
+        send_welcome_message(state["name"])
+
+
+def name_first_particle():
+    # the settings might have been loaded meanwhile
+    if not state["name"]:
+        name_new_particle(welcome=False)
+
+
+def get_pressure(pressure_state):
+    try:
+        return pressure_state["channels"][pressure_channel]["pressure"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def on_pressure_update(pressure_state):
+    # called for every update of the pressure sensor, the API calls are only queued
+    global armed
+    pressure = get_pressure(pressure_state)
+    if not pressure:
+        return
+    if pressure > rearm_pressure:
+        armed = True
+    elif armed and pressure < pressure_threshold:
+        armed = False
+        if not submit(name_new_particle):
+            print("ParticleName: too many pending tasks, skipping the new particle")
+        submit(prefetch_name)
+
+
+def watch_pressure(report_errors=True):
+    """Subscribes to the pressure updates; returns False if that's not possible (yet)."""
+    global armed
     try:
-        if not hasattr(argv, "slack_token") or not hasattr(argv, "slack_channel"):
-            print("ParticleName: Slack token or channel not provided.")
-            return
-        response = openAI_client.responses.create(
-            model="gpt-4o",
-            input=f'Write a funny welcome message for a nanoparticle named "{name}", which is trapped in a laser field and gonna be cooled and used in a quantum physics experiment. It shouldn\'t be longer than 2 sentences.',
-            temperature=1,
-        ).output_text
-        slack_client = WebClient(token=argv.slack_token)
-        slack_client.chat_postMessage(channel=argv.slack_channel, text=response)
+        subscribe_device_state(pressure_device_name, on_pressure_update)
     except Exception as e:
-        print(f"Error sending welcome message: {e}")
+        if report_errors:
+            print(f"ParticleName: can't watch {pressure_device_name} ({e}), retrying")
+        return False
+    # the callback only sees the following updates; a sensor which is still
+    # initializing has no state yet, it's armed by its updates then
+    try:
+        current_state = wait_for_state(pressure_device_name, lambda _: True, timeout=pressure_timeout)
+    except Exception as e:
+        print(f"ParticleName: can't get the state of {pressure_device_name} ({e})")
+        current_state = None
+    armed = (get_pressure(current_state) or 0) > rearm_pressure
+    return True
 
 
 def main():
-    client = OpenAI(api_key=argv.openai_api_key)
-    if not state["name"]:
-        state["name"] = generate_particle_name(client)
-
-    previous_pressure = None
+    submit(name_first_particle)
+    submit(prefetch_name)
+    watching = watch_pressure()
     while is_running:
-        try:
-            pressureState = get_device_state("pressure")
-            pressure = pressureState["channels"][1]["pressure"]
-
-            if (
-                previous_pressure
-                and pressure
-                and previous_pressure >= 1e-2
-                and pressure < 1e-2
-            ):
-                state["name"] = generate_particle_name(client)
-                send_status_update()
-                send_welcome_message(client, state["name"])
-
-            if pressure:
-                previous_pressure = pressure
-        except:
-            pass
         time.sleep(1)
+        if not watching:
+            watching = watch_pressure(report_errors=False)
+    executor.shutdown(wait=False, cancel_futures=True)
@@ -1,5 +1,6 @@
 import serial
 import time
+from timeseries import ChannelHistory, RecordedSeries
 
 argv: any
 is_running: bool
@@ -10,6 +11,13 @@ state = {"channels": []}
 
 ser: serial.Serial = None
 sensorStates = ["ok", "underrange", "overrange", "error"]
+# the sensor sends a reading per second, so keep the last day by default
+historyLength = getattr(argv, "historyLength", 24 * 3600)
+statisticsWindow = getattr(argv, "statisticsWindow", 60)
+history: ChannelHistory = None
+recording: RecordedSeries = None
+# the `get_stream` of a recording for which main() didn't create the series yet
+record_get_stream: callable = None
 
 
 def send(command):
@@ -58,19 +66,53 @@ else:
 
 
 def main():
+    global history, recording, record_get_stream
     while is_running:
         data = ser.readline().strip().decode().split(",")
+        t = time.time()
         statusList = data[::2]
         pressureList = data[1::2]
         newState = []
+        readings = []
         for s, p in zip(statusList, pressureList):
             status = int(s)
             isOk = status == 0
             newState.append(
                 {"pressure": float(p) if isOk else 0, "status": sensorStates[status]}
             )
+            readings.append(float(p) if isOk else float("nan"))
+        if history is None:
+            history = ChannelHistory(historyLength, len(readings), statisticsWindow)
+        history.add(t, readings)
+        if record_get_stream is not None:
+            try:
+                recording = RecordedSeries(record_get_stream, [f"C{i + 1}" for i in range(len(readings))])
+            except RuntimeError:
+                pass  # the recording already stopped
+            record_get_stream = None
+        if recording is not None:
+            recording.write(t, readings)
+        for i, channel in enumerate(newState):
+            channel["statistics"] = history.statistics(i)
         state["channels"] = newState
         send_status_update()
 
+
+def get_history(channel, t_start=None, t_end=None, max_points=1000):
+    """Pressure trace of `channel` between the Unix timestamps `t_start` and `t_end`
+    (negative values are seconds before the latest reading), min/max-decimated to `max_points`."""
+    if history is None:
+        return {"t": [], "min": [], "max": []}
+    return history.query(int(channel), t_start, t_end, max_points)
+
+
+def on_record(get_stream):
+    # the channels are only known after the first reading, so main() creates
+    # the series then, which takes a second at most
+    global recording, record_get_stream
+    recording = None
+    record_get_stream = get_stream
+
+
 def on_save_snapshot():
     return [channel["pressure"] if channel["status"] == "ok" else "-" for channel in state["channels"]]
@@ -1,15 +1,27 @@
 import time
+from collections import deque
 import numpy as np
 
 correction_eta = 0.2
 correction_theta = 1.2
 
-state = {"lockH": False, "outOfLockRange": True}
+# d(theta, eta) / d(QWP, HWP) in °/°, as assumed by the alternating corrections
+NOMINAL_JACOBIAN = [[0.0, -2.0], [-2.0, 0.0]]
+
+state = {
+    "lockH": False,
+    "outOfLockRange": True,
+    "mode": "alternating",
+    "jacobian": NOMINAL_JACOBIAN,
+    "calibrating": False,
+    "statistics": {"locked": False, "timeToLock": None, "residualRMS": None, "corrections": 0},
+}
 
 argv: any
 is_running: bool
 send_status_update: callable
 get_device_state: callable
+wait_for_state: callable
 action: callable
 
 if not hasattr(argv, "polarizationDeviceName"):
@@ -19,50 +31,198 @@ if not hasattr(argv, "waveplateDeviceName"):
 if not hasattr(argv, "waveplateQWPChannel") or not hasattr(argv, "waveplateHWPChannel"):
     raise ValueError("`waveplateQWPChannel` and `waveplateHWPChannel` are required")
 
+# polarization error (°) below which the lock counts as locked and doesn't correct
+lock_tolerance = getattr(argv, "lockTolerance", 0.2)
+# fraction of the Jacobian step applied per correction and its limit (°)
+gain = getattr(argv, "gain", 1)
+max_step = getattr(argv, "maxStep", 2)
+calibration_step = getattr(argv, "calibrationStep", 1)
+calibration_samples = getattr(argv, "calibrationSamples", 3)
+# number of samples the residual RMS is computed over
+statistics_window = getattr(argv, "statisticsWindow", 100)
+
+calibration_requested = False
+lock_started_at = None
+residuals = deque(maxlen=statistics_window)
+
 
 def wait():
     time.sleep(1)
 
 
+def wait_for_polarization():
+    # react on every new polarimeter sample; polarimeters which don't publish
+    # their readings fall back to being polled once per second
+    return wait_for_state(argv.polarizationDeviceName, timeout=1) or get_device_state(argv.polarizationDeviceName)
+
+
+def wait_for_waveplates():
+    # waits for both waveplates to arrive, then drops the sample which might
+    # have been taken while they were still moving
+    def arrived(waveplate_state):
+        channels = waveplate_state["channels"]
+        return not any(channels[ch].get("moving", False) for ch in (argv.waveplateQWPChannel, argv.waveplateHWPChannel))
+
+    wait_for_state(argv.waveplateDeviceName, arrived, timeout=5)
+    wait_for_polarization()
+
+
+def get_error(polarizationState):
+    theta = np.rad2deg(polarizationState["theta"]) - correction_theta
+    eta = np.rad2deg(polarizationState["eta"]) - correction_eta
+    return np.array([theta, eta])
+
+
 def start_polarization_lock():
+    global lock_started_at
     state["lockH"] = True
+    state["statistics"] = {"locked": False, "timeToLock": None, "residualRMS": None, "corrections": 0}
+    lock_started_at = time.monotonic()
+    residuals.clear()
 
 
 def stop_polarization_lock():
     state["lockH"] = False
 
 
+def set_mode(mode):
+    if mode not in ["alternating", "jacobian"]:
+        raise Exception("Invalid lock mode")
+    state["mode"] = mode
+    send_status_update()
+
+
+def calibrate_jacobian():
+    # the calibration moves the waveplates and is therefore run by main()
+    global calibration_requested
+    calibration_requested = True
+
+
+def get_settings():
+    return {"mode": state["mode"], "jacobian": state["jacobian"]}
+
+
+def load_settings(settings):
+    state["mode"] = settings.get("mode", state["mode"])
+    state["jacobian"] = settings.get("jacobian", state["jacobian"])
+
+
+def get_waveplate_channels():
+    waveplateState = get_device_state(argv.waveplateDeviceName)
+    QWP_channel = waveplateState["channels"][argv.waveplateQWPChannel]
+    HWP_channel = waveplateState["channels"][argv.waveplateHWPChannel]
+    if QWP_channel["type"] != "rotation" or HWP_channel["type"] != "rotation":
+        raise Exception("PolarizationLock: waveplate channels are not rotation")
+    return QWP_channel, HWP_channel
+
+
+def set_waveplates(QWP_position, HWP_position):
+    # both moves are queued at once, such that the waveplates move together
+    action(argv.waveplateDeviceName, None, "set_position", [argv.waveplateQWPChannel, QWP_position])
+    action(argv.waveplateDeviceName, None, "set_position", [argv.waveplateHWPChannel, HWP_position])
+
+
+def measure_error():
+    errors = []
+    while len(errors) < calibration_samples:
+        polarizationState = wait_for_polarization()
+        if polarizationState["status"] != "ok" or polarizationState["DOP"] < 0.8:
+            raise Exception("PolarizationLock: no valid polarization for the calibration")
+        errors.append(get_error(polarizationState))
+    return np.mean(errors, axis=0)
+
+
+def run_calibration():
+    """Measures the Jacobian by stepping each waveplate by ±`calibrationStep`."""
+    QWP_channel, HWP_channel = get_waveplate_channels()
+    origin = np.array([QWP_channel["targetPosition"], HWP_channel["targetPosition"]])
+    jacobian = np.zeros((2, 2))
+    try:
+        for plate in range(2):
+            offset = np.zeros(2)
+            offset[plate] = calibration_step
+            set_waveplates(*(origin + offset))
+            wait_for_waveplates()
+            error_plus = measure_error()
+            set_waveplates(*(origin - offset))
+            wait_for_waveplates()
+            error_minus = measure_error()
+            jacobian[:, plate] = (error_plus - error_minus) / (2 * calibration_step)
+    finally:
+        set_waveplates(*origin)
+        wait_for_waveplates()
+    if abs(np.linalg.det(jacobian)) < 1e-3:
+        raise Exception("PolarizationLock: calibrated Jacobian is singular")
+    state["jacobian"] = jacobian.tolist()
+
+
+def update_statistics(error):
+    statistics = state["statistics"]
+    locked = bool(np.all(np.abs(error) < lock_tolerance))
+    if locked and statistics["timeToLock"] is None:
+        statistics["timeToLock"] = time.monotonic() - lock_started_at
+    statistics["locked"] = locked
+    if statistics["timeToLock"] is not None:
+        residuals.append(error)
+        statistics["residualRMS"] = np.sqrt(np.mean(np.square(residuals), axis=0)).tolist()
+
+
+def correct_jacobian(error, QWP_channel, HWP_channel):
+    if np.all(np.abs(error) < lock_tolerance):
+        return False
+    step = -gain * np.linalg.solve(np.array(state["jacobian"]), error)
+    step = np.clip(step, -max_step, max_step)
+    set_waveplates(QWP_channel["targetPosition"] + step[0], HWP_channel["targetPosition"] + step[1])
+    return True
+
+
 def main():
+    global calibration_requested
     correct_QWP_next = False
     while is_running:
         try:
-            polarizationState = get_device_state(argv.polarizationDeviceName)
+            if calibration_requested:
+                calibration_requested = False
+                state["calibrating"] = True
+                send_status_update()
+                try:
+                    run_calibration()
+                finally:
+                    state["calibrating"] = False
+                    send_status_update()
+
+            polarizationState = wait_for_polarization()
             if polarizationState["status"] != "ok" or polarizationState["DOP"] < 0.8:
-                wait()
                 continue
-            theta = np.rad2deg(polarizationState["theta"]) - correction_theta
-            eta = np.rad2deg(polarizationState["eta"]) - correction_eta
+            error = get_error(polarizationState)
+            theta, eta = error
             out_of_lock_range = bool(np.abs(theta) > 5 or np.abs(eta) > 5)
             if state["outOfLockRange"] != out_of_lock_range:
                 state["outOfLockRange"] = out_of_lock_range
                 send_status_update()
             if not state["lockH"]:
-                wait()
                 continue
             if out_of_lock_range:
                 raise Exception("PolarizationLock: polarization out of lock range (+- 5°)")
 
-            waveplateState = get_device_state(argv.waveplateDeviceName)
-            QWP_channel = waveplateState["channels"][argv.waveplateQWPChannel]
-            HWP_channel = waveplateState["channels"][argv.waveplateHWPChannel]
-            if QWP_channel["type"] != "rotation" or HWP_channel["type"] != "rotation":
-                raise Exception("PolarizationLock: waveplate channels are not rotation")
+            update_statistics(error)
+            QWP_channel, HWP_channel = get_waveplate_channels()
+
+            if state["mode"] == "jacobian":
+                # acts on every fresh sample taken after the waveplates arrived
+                if correct_jacobian(error, QWP_channel, HWP_channel):
+                    state["statistics"]["corrections"] += 1
+                    send_status_update()
+                    wait_for_waveplates()
+                else:
+                    send_status_update()
+                continue
 
             if correct_QWP_next and np.abs(eta) < 0.2:
                 if np.abs(theta) > 0.2:
                     correct_QWP_next = False
                 else:
-                    wait()
+                    send_status_update()
                     continue
 
             if correct_QWP_next:
@@ -80,10 +240,13 @@ def main():
                     [argv.waveplateHWPChannel, HWP_channel["targetPosition"] + theta / 2],
                 )
             correct_QWP_next = not correct_QWP_next
+            state["statistics"]["corrections"] += 1
+            send_status_update()
+            # give the waveplate time to move before evaluating the next sample
+            wait()
         except Exception as e:
             print(f"PolarizationLock: error {e}")
-            pass
-        wait()
+            wait()
 
 
 def on_save_snapshot():
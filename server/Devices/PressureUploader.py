@@ -1,10 +1,19 @@
+import json
+import os
+import threading
 import time
+from collections import deque
+from datetime import datetime, timezone
 import numpy as np
-import requests
 
 argv: any
 is_running: bool
-get_device_state: callable
+subscribe_device_state: callable
+send_status_update: callable
+lazy_import: callable
+
+# only loaded once the first upload is due
+requests = lazy_import("requests")
 
 if not argv.deviceName:
 	raise ValueError("`deviceName` is required")
@@ -15,34 +24,144 @@ if not argv.uploadUrl:
 if not argv.apiKey:
 	raise ValueError("`apiKey` is required")
 
+time_interval = getattr(argv, 'timeInterval', 60)
+# Intervals per POST, each an entry `{id, value, unit}` of the `sensors` list
+# (oldest first, without timestamps); with `batchSize` 1, every request carries
+# a single interval as it used to.
+batch_size = getattr(argv, 'batchSize', 5)
+# by default, a batch is sent once it's full, but at least every 5 minutes
+upload_interval = getattr(argv, 'uploadInterval', min(batch_size * time_interval, 300))
+# batches kept on disk while the server can't be reached; the oldest get dropped first
+spool_directory = getattr(argv, 'spoolDirectory', os.path.join('spool', argv.deviceName))
+spool_limit = getattr(argv, 'spoolLimit', 10000)
+sensor_id = f'{argv.deviceName}-{argv.selectedChannel}'
+
+state = {"pendingIntervals": 0, "spooledBatches": 0, "lastUpload": None, "lastError": None}
+
+
+class ReadingBuffer:
+	# Readings of the current interval; the sensor publishes about once per second,
+	# so the buffer is allocated once with plenty of headroom.
+	def __init__(self, capacity):
+		self.values = np.empty(capacity)
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def add(self, value):
+		with self.lock:
+			if self.count < len(self.values):
+				self.values[self.count] = value
+				self.count += 1
+
+	def aggregate(self):
+		with self.lock:
+			if self.count == 0:
+				return None
+			entry = {
+				"id": sensor_id,
+				"value": float(self.values[:self.count].mean()),
+				"unit": "mbar",
+			}
+			self.count = 0
+		return entry
+
+
+readings = ReadingBuffer(max(10 * time_interval, 100))
+outbox = deque()
+session = None
+
+
+def post(sensors):
+	global session
+	# the session keeps the connection to the server alive between uploads
+	if session is None:
+		session = requests.Session()
+		session.headers["Authorization"] = f'Bearer {argv.apiKey}'
+	with session.post(argv.uploadUrl, json={'sensors': sensors}, timeout=10) as response:
+		if response.status_code >= 300:
+			raise Exception(f"Failed to upload data: {response.status_code} {response.text}")
+
+
+def spooled_batches():
+	if not os.path.isdir(spool_directory):
+		return []
+	return sorted(filename for filename in os.listdir(spool_directory) if filename.endswith('.json'))
+
+
+def spool(batch):
+	os.makedirs(spool_directory, exist_ok=True)
+	with open(os.path.join(spool_directory, f'{time.time_ns()}.json'), 'w') as file:
+		json.dump(batch, file)
+	for filename in spooled_batches()[:-spool_limit]:
+		os.remove(os.path.join(spool_directory, filename))
+
+
+def replay_spool(max_batches=10):
+	# oldest first; stops at the first failure, which leaves the file for the next try
+	for filename in spooled_batches()[:max_batches]:
+		path = os.path.join(spool_directory, filename)
+		with open(path) as file:
+			post(json.load(file))
+		os.remove(path)
+
+
+def next_batch():
+	return [outbox.popleft() for _ in range(min(batch_size, len(outbox)))]
+
+
+def upload():
+	batch = next_batch()
+	try:
+		# the spooled batches are older, so they go first
+		replay_spool()
+		if batch:
+			if spooled_batches():
+				# still catching up after an outage
+				spool(batch)
+			else:
+				post(batch)
+			batch = []
+		state["lastUpload"] = datetime.now(timezone.utc).isoformat()
+		state["lastError"] = None
+	except Exception as e:
+		if batch:
+			spool(batch)
+		state["lastError"] = str(e)
+		print(f"PressureUploader: {e}")
+
+
+def run_sender():
+	last_upload = time.time()
+	while is_running:
+		time.sleep(1)
+		if time.time() - last_upload < upload_interval:
+			continue
+		last_upload = time.time()
+		upload()
+		state["pendingIntervals"] = len(outbox)
+		state["spooledBatches"] = len(spooled_batches())
+		send_status_update()
+
+
 def main():
-	pressure_readings = []
+	def on_pressure_update(pressureState):
+		pressure = pressureState["channels"][argv.selectedChannel]["pressure"]
+		if pressure:
+			readings.add(pressure)
+
+	subscribe_device_state(argv.deviceName, on_pressure_update)
+	state["spooledBatches"] = len(spooled_batches())
+	sender = threading.Thread(target=run_sender, name="PressureUploader.sender", daemon=True)
+	sender.start()
 	start = time.time()
-	time_interval = argv.timeInterval if hasattr(argv, 'timeInterval') else 60
 	while is_running:
-		try:
-			pressureState = get_device_state(argv.deviceName)
-			pressure = pressureState["channels"][argv.selectedChannel]["pressure"]
-			
-			if pressure:
-				pressure_readings.append(pressure)
-			
-			if time.time() - start > time_interval and len(pressure_readings) > 0:
-				average_pressure = np.mean(pressure_readings)
-				pressure_readings = []
-				start = time.time()
-
-				sensors = [{
-					"id": f'{argv.deviceName}-{argv.selectedChannel}',
-					"value": average_pressure,
-					"unit": "mbar",
-				}]
-				
-				# Upload the average pressure to the server
-				with requests.post(argv.uploadUrl, json={'sensors': sensors}, headers={'Authorization': f'Bearer {argv.apiKey}'}) as response:
-					if response.status_code >= 300:
-						print(f"Failed to upload data: {response.status_code} {response.text}")
-
-		except Exception as e:
-			pass
-		time.sleep(1)
+		while is_running and time.time() - start < time_interval:
+			time.sleep(1)
+		start = time.time()
+		entry = readings.aggregate()
+		if entry is not None:
+			outbox.append(entry)
+	sender.join()
+	# don't hold up the shutdown with uploading, the data is sent after the next start
+	while outbox:
+		spool(next_batch())
@@ -1,5 +1,7 @@
+using System.Diagnostics;
 using System.Dynamic;
 using System.Text.Json;
+using System.Threading.Channels;
 using Python.Runtime;
 
 public static class JsonElementExtensions
@@ -51,48 +53,114 @@ public static class JsonElementExtensions
 	}
 }
 
+// Seconds spent on waiting for the GIL, executing the prelude, importing modules, executing the rest of the script and discovering its functions.
+public record PythonStartupProfile(double Gil, double Prelude, double Imports, double Exec, double MethodDiscovery)
+{
+	public double Total => Gil + Prelude + Imports + Exec + MethodDiscovery;
+
+	public static PythonStartupProfile? Of(IDeviceHandler device) => device switch
+	{
+		PythonDevice pythonDevice => pythonDevice.StartupProfile,
+		PythonWorkerDevice workerDevice => workerDevice.StartupProfile,
+		_ => null,
+	};
+
+	public override string ToString() => $"GIL {Gil * 1e3:F1} ms, prelude {Prelude * 1e3:F1} ms, imports {Imports * 1e3:F1} ms, exec {Exec * 1e3:F1} ms, method discovery {MethodDiscovery * 1e3:F1} ms";
+}
+
 public class PythonDevice : IDeviceHandler
 {
+	private const string BridgeDirectory = "PythonBridge";
+	private const string PreludeFilename = "PythonBridge/prelude.py";
+	// Compiled code objects by script path, shared by all devices running the same script (and the prelude run by each of them).
+	private static readonly Dictionary<string, (DateTime LastWriteTime, PyObject Code)> CompiledScripts = new();
+	private static bool IsBridgeOnPath = false;
 	private readonly Dictionary<string, PyObject> MethodCache = new();
 	private event Action<object>? OnStateUpdate;
+	private event Action<object>? OnStatePatch;
 	private event Action<object>? OnStreamEvent;
 	protected DeviceManager? DeviceManager;
 	private PyModule PyModule;
-	public PythonDevice(string filename, object? arguments = null)
+	private readonly HashSet<string> SubscribedDevices = new();
+	private Channel<(string DeviceId, string Method, string Payload, long Sequence)>? DeviceStateUpdates;
+	private long DeviceStateSequence = 0;
+	// Incremented whenever the script might have changed its state (`send_status_update`, actions, loaded settings).
+	// As long as it doesn't change, the cached snapshots are handed out without taking the GIL. Hence changes of `state`
+	// without `send_status_update` aren't seen until the next one (`host.py --check-state-cache` reports those).
+	private long StateVersion = 0;
+	private StateSnapshot? CachedState;
+	private StateSnapshot? CachedSaveSnapshot;
+	private record StateSnapshot(long Version, string? SerializedJson, object? Value)
+	{
+		// states are only converted to JSON if needed
+		public string Json => SerializedJson ?? ((SerializedPayload)Value!).ToJson();
+	}
+	// Whether the scripts may encode their states as MessagePack (if the msgpack package is available) instead of JSON.
+	// This only pays off if the clients use the MessagePack hub protocol, the control hub clients use JSON
+	// (see client/components/provider.tsx), such that the JSON is forwarded to them as is.
+	public static bool UseMessagePack = false;
+	// whether the prelude actually encodes the state as MessagePack
+	private readonly bool UsesMessagePack;
+	public PythonStartupProfile? StartupProfile { get; private set; }
+	// shared with DeviceManager.Metrics, a DeferredDevice hands over its own instance
+	public DeviceMetrics Metrics { get; set; } = new();
+	public PythonDevice(string filename, object? arguments = null, double maxStatusUpdateRate = 0)
 	{
+		var stopwatch = Stopwatch.StartNew();
 		using (Py.GIL())
 		{
+			var gilAcquired = stopwatch.Elapsed.TotalSeconds;
+			if (!IsBridgeOnPath)
+			{
+				dynamic sys = Py.Import("sys");
+				sys.path.insert(0, Path.GetFullPath(BridgeDirectory));
+				IsBridgeOnPath = true;
+			}
 			PyModule = Py.CreateScope();
-			PyModule.Import("json", "_json");
-			PyModule.Exec("state = None");
 			PyModule.Set("_send_status_update", new Action<string>(SendStateUpdate));
-			PyModule.Exec("def send_status_update(partial_state=None): _send_status_update(_json.dumps(partial_state if partial_state else state))");
-			PyModule.Exec("def _get_state(): return _json.dumps(state)");
-			PyModule.Exec("def _on_save_snapshot(): return _json.dumps(on_save_snapshot())");
+			PyModule.Set("_send_status_patch", new Action<string>(SendStatePatch));
+			if (UseMessagePack)
+			{
+				PyModule.Set("_send_status_update_packed", new Action<PyObject>(data => SendPackedStateUpdate(ToBytes(data))));
+				PyModule.Set("_send_status_patch_packed", new Action<PyObject>(data => SendPackedStatePatch(ToBytes(data))));
+			}
 			PyModule.Set("_get_device_state", (string deviceName) =>
 				{
 					var device = DeviceManager?.Devices[deviceName];
 					if (device == null) throw new ArgumentException($"Device {deviceName} doesn't exist.");
-					return JsonSerializer.Serialize(device.GetState());
+					if (device is DeferredDevice deferredDevice) device = deferredDevice.Current ?? throw new ArgumentException($"Device {deviceName} isn't initialized.");
+					return device is PythonDevice pythonDevice ? pythonDevice.GetStateSnapshot().Json : JsonSerializer.Serialize(device.GetState());
 				});
-			PyModule.Exec("def get_device_state(device_name): return _json.loads(_get_device_state(device_name))");
 			PyModule.Set("action", (string deviceId, string? channelId, string actionName, object[]? parameters) => DeviceManager?.Action(new DeviceAction(deviceId, channelId, actionName, parameters)));
-			PyModule.Set("_request", (string deviceId, string? channelId, string actionName, object[]? parameters) => JsonSerializer.Serialize(DeviceManager?.Request(new DeviceAction(deviceId, channelId, actionName, parameters))));
-			PyModule.Exec("def request(device_id, channel_id, action_name, parameters): return _json.loads(_request(device_id, channel_id, action_name, parameters))");
+			PyModule.Set("_action_batch", (string serializedActions, bool atomic, bool bestEffort) => DeviceManager?.ActionBatch(BatchedAction.ListFromJson(JsonSerializer.Deserialize<JsonElement>(serializedActions)), atomic, bestEffort));
+			PyModule.Set("_request", (string deviceId, string? channelId, string actionName, object[]? parameters) =>
+				{
+					var result = DeviceManager?.Request(new DeviceAction(deviceId, channelId, actionName, parameters));
+					// numeric arrays are handed over as NumPy arrays, everything else as JSON string
+					return NumPyUtils.ToNumPy(result) ?? JsonSerializer.Serialize(result).ToPython();
+				});
+			PyModule.Set("_send_stream_data", new Action<PyObject, string>(SendStreamArray));
+			PyModule.Set("_subscribe_device_state", new Action<string>(SubscribeToDeviceState));
+			PyModule.Set("_device_state_sequence", () => Interlocked.Read(ref DeviceStateSequence));
+			PyModule.Set("_mark_state_changed", new Action(MarkStateChanged));
+			PyModule.Set("_record_loop_iteration", new Action(() => Metrics.RecordLoopIteration()));
 			PyModule.Set("print", (string text) => Console.WriteLine(text));
-			PyModule.Exec("def _get_settings(): return _json.dumps(get_settings())");
-			PyModule.Exec("def _load_settings(settings): load_settings(_json.loads(settings))");
 			PyModule.Set("is_running", true);
+			PyModule.Execute(GetCompiledScript(PreludeFilename));
+			UsesMessagePack = PyModule.Get<bool>("_packed");
+			var preludeExecuted = stopwatch.Elapsed.TotalSeconds;
+			PyModule.Set("max_status_update_rate", maxStatusUpdateRate);
 
 			if (arguments != null)
 			{
 				PyModule.Set("argv", arguments.ToPython());
 			}
 
-			var script = File.ReadAllText(filename);
+			double importSeconds;
 			try
 			{
-				PyModule.Exec(script);
+				using var execScript = PyModule.Get("_exec_script");
+				importSeconds = execScript.Invoke(GetCompiledScript(filename)).As<double>();
 			}
 			catch (PythonException e)
 			{
@@ -100,18 +168,27 @@ public class PythonDevice : IDeviceHandler
 				Dispose();
 				throw;
 			}
+			var scriptExecuted = stopwatch.Elapsed.TotalSeconds;
 
-			dynamic inspect = Py.Import("inspect");
-			foreach (var name in PyModule.Dir())
+			using (var listFunctions = PyModule.Get("_list_functions"))
+			using (var functions = listFunctions.Invoke())
 			{
-				var functionName = name.ToString();
-				if (functionName == null) continue;
-				var function = PyModule.Get(functionName);
-				if (inspect.isfunction(function).As<bool>())
+				foreach (var function in functions)
 				{
-					MethodCache[functionName.ToLower()] = function;
+					MethodCache[function[0].As<string>().ToLower()] = function[1];
 				}
 			}
+			MethodCache["_monitor_main_loop"].Invoke();
+			StartupProfile = new PythonStartupProfile(gilAcquired, preludeExecuted - gilAcquired, importSeconds, scriptExecuted - preludeExecuted - importSeconds, stopwatch.Elapsed.TotalSeconds - scriptExecuted);
+			Console.WriteLine($"Started {filename}: {StartupProfile}");
+
+			dynamic inspect = Py.Import("inspect");
+			if (MethodCache.TryGetValue("main", out var main) && inspect.iscoroutinefunction(main).As<bool>())
+			{
+				// `async def main()` runs on the event loop shared by all Python devices instead of blocking a thread
+				MethodCache["_start_async_main"].Invoke(new Action<string>(OnAsyncMainError).ToPython());
+				return;
+			}
 		}
 		if (MethodCache.ContainsKey("main"))
 		{
@@ -133,13 +210,80 @@ public class PythonDevice : IDeviceHandler
 		}
 	}
 
+	// Has to be called holding the GIL.
+	private static PyObject GetCompiledScript(string filename)
+	{
+		var path = Path.GetFullPath(filename);
+		var lastWriteTime = File.GetLastWriteTimeUtc(path);
+		if (CompiledScripts.TryGetValue(path, out var cached) && cached.LastWriteTime == lastWriteTime) return cached.Code;
+		using var builtins = Py.Import("builtins");
+		using var source = new PyString(File.ReadAllText(path));
+		using var pathString = new PyString(path);
+		using var mode = new PyString("exec");
+		var code = builtins.InvokeMethod("compile", source, pathString, mode);
+		CompiledScripts[path] = (lastWriteTime, code);
+		return code;
+	}
+
+	// Takes the GIL, recording the time waited for and held by `call` in the metrics.
+	private TimedGil AcquireGil(string call) => new(Metrics.GetGilHistograms(call));
+
+	private readonly struct TimedGil : IDisposable
+	{
+		private readonly Py.GILState State;
+		private readonly (LatencyHistogram Wait, LatencyHistogram Hold) Histograms;
+		private readonly long Acquired;
+
+		public TimedGil((LatencyHistogram Wait, LatencyHistogram Hold) histograms)
+		{
+			var start = Stopwatch.GetTimestamp();
+			State = Py.GIL();
+			Acquired = Stopwatch.GetTimestamp();
+			Histograms = histograms;
+			Histograms.Wait.Record(Acquired - start);
+		}
+
+		public void Dispose()
+		{
+			State.Dispose();
+			Histograms.Hold.RecordSince(Acquired);
+		}
+	}
+
+	private void OnAsyncMainError(string error)
+	{
+		Console.WriteLine($"PythonDevice error: {error}");
+		// we're on the event loop here, so dispose from somewhere else
+		Task.Run(Dispose);
+	}
+
+	private void MarkStateChanged()
+	{
+		Interlocked.Increment(ref StateVersion);
+	}
+
 	public object GetState()
 	{
-		using (Py.GIL())
+		var start = Stopwatch.GetTimestamp();
+		var state = GetStateSnapshot().Value!;
+		Metrics.GetStateDuration.RecordSince(start);
+		return state;
+	}
+
+	private StateSnapshot GetStateSnapshot()
+	{
+		var version = Interlocked.Read(ref StateVersion);
+		var snapshot = CachedState;
+		if (snapshot != null && snapshot.Version == version) return snapshot;
+		using (AcquireGil("get_state"))
 		{
-			string stateJson = MethodCache["_get_state"].Invoke().As<string>();
-			return JsonSerializer.Deserialize<JsonElement>(stateJson).ToDynamic() ?? new object();
+			using var state = MethodCache["_get_state"].Invoke();
+			// a change while serializing has a newer version, so this snapshot won't be reused for it
+			var payload = UsesMessagePack ? SerializedPayload.FromMessagePack(ToBytes(state)) : SerializedPayload.FromJson(state.As<string>());
+			snapshot = new StateSnapshot(version, null, payload);
 		}
+		CachedState = snapshot;
+		return snapshot;
 	}
 
 	public object HandleActionAsync(DeviceAction action)
@@ -153,15 +297,22 @@ public class PythonDevice : IDeviceHandler
 		{
 			try
 			{
-				using (Py.GIL())
+				using (AcquireGil("action"))
 				{
-					return method.Invoke(action.Parameters?.Select(x => x.ToPython()).ToArray() ?? []);
+					using var result = method.Invoke(action.Parameters?.Select(x => x.ToPython()).ToArray() ?? []);
+					using var resultJson = MethodCache["_action_result"].Invoke(result);
+					if (resultJson.IsNone()) return new object();
+					return JsonSerializer.Deserialize<JsonElement>(resultJson.As<string>()).ToDynamic() ?? new object();
 				}
 			}
 			catch (Exception ex)
 			{
 				throw new InvalidOperationException($"Failed to invoke action method {action.ActionName}.", ex);
 			}
+			finally
+			{
+				MarkStateChanged();
+			}
 		}
 		else
 		{
@@ -174,6 +325,11 @@ public class PythonDevice : IDeviceHandler
 		OnStateUpdate += onStateUpdate;
 	}
 
+	public void SubscribeToStatePatches(Action<object> onStatePatch)
+	{
+		OnStatePatch += onStatePatch;
+	}
+
 	public void SubscribeToStreamEvents(Action<object> onStreamEvent)
 	{
 		OnStreamEvent += onStreamEvent;
@@ -181,7 +337,36 @@ public class PythonDevice : IDeviceHandler
 
 	public void SendStateUpdate(string serializedPartialState)
 	{
-		OnStateUpdate?.Invoke(JsonSerializer.Deserialize<dynamic>(serializedPartialState)!);
+		Metrics.RecordStatusUpdate(serializedPartialState);
+		OnStateUpdate?.Invoke(SerializedPayload.FromJson(serializedPartialState));
+	}
+
+	// A state patch is a list of `[path, value]` pairs, with `path` being the list of keys/indices leading to `value`.
+	public void SendStatePatch(string serializedPatches)
+	{
+		Metrics.RecordStatusUpdate(serializedPatches);
+		OnStatePatch?.Invoke(SerializedPayload.FromJson(serializedPatches));
+	}
+
+	// The serialized updates are forwarded to the clients without decoding them (see SerializedPayload).
+	private void SendPackedStateUpdate(byte[] partialState)
+	{
+		Metrics.RecordStatusUpdate(partialState.Length);
+		OnStateUpdate?.Invoke(SerializedPayload.FromMessagePack(partialState));
+	}
+
+	private void SendPackedStatePatch(byte[] patches)
+	{
+		Metrics.RecordStatusUpdate(patches.Length);
+		OnStatePatch?.Invoke(SerializedPayload.FromMessagePack(patches));
+	}
+
+	private static byte[] ToBytes(PyObject bytes)
+	{
+		using var buffer = bytes.GetBuffer();
+		var data = new byte[buffer.Length];
+		buffer.Read(data, 0, data.Length, 0);
+		return data;
 	}
 
 	public void SendStreamData(object data)
@@ -189,6 +374,87 @@ public class PythonDevice : IDeviceHandler
 		OnStreamEvent?.Invoke(data);
 	}
 
+	// Called by `send_stream_data` with a C-contiguous float32 array of shape (channels, samples).
+	private void SendStreamArray(PyObject array, string serializedMeta)
+	{
+		using var shape = array.GetAttr("shape");
+		using var channelAxis = shape[0];
+		using var sampleAxis = shape[1];
+		var channelCount = channelAxis.As<int>();
+		var length = sampleAxis.As<int>();
+		using var ctypes = array.GetAttr("ctypes");
+		using var pointer = ctypes.GetAttr("data");
+		var address = pointer.As<long>();
+		var channels = new float[channelCount][];
+		unsafe
+		{
+			var source = new ReadOnlySpan<float>((void*)address, channelCount * length);
+			for (var i = 0; i < channelCount; i++)
+			{
+				channels[i] = source.Slice(i * length, length).ToArray();
+			}
+		}
+		if (DeviceManager == null) return;
+		var frame = PythonStreaming.CreateFrame(channels, serializedMeta);
+		// decimating for the individual connections doesn't need the GIL
+		var threadState = PythonEngine.BeginAllowThreads();
+		try
+		{
+			PythonStreaming.Send(DeviceManager, this, frame);
+		}
+		finally
+		{
+			PythonEngine.EndAllowThreads(threadState);
+		}
+	}
+
+	private void SubscribeToDeviceState(string deviceName)
+	{
+		if (DeviceManager == null || !DeviceManager.Devices.ContainsKey(deviceName)) throw new ArgumentException($"Device {deviceName} doesn't exist.");
+		lock (SubscribedDevices)
+		{
+			SubscribedDevices.Add(deviceName);
+			if (DeviceStateUpdates != null) return;
+			DeviceStateUpdates = Channel.CreateUnbounded<(string, string, string, long)>(new UnboundedChannelOptions { SingleReader = true });
+			DeviceManager.StateChanged += ForwardDeviceState;
+		}
+		Task.Run(DispatchDeviceStates);
+	}
+
+	private void ForwardDeviceState(string deviceId, string method, object payload)
+	{
+		lock (SubscribedDevices)
+		{
+			if (!SubscribedDevices.Contains(deviceId)) return;
+			// the sequence has to be in the same order as the queue
+			var sequence = Interlocked.Increment(ref DeviceStateSequence);
+			DeviceStateUpdates?.Writer.TryWrite((deviceId, method, JsonSerializer.Serialize(payload), sequence));
+		}
+	}
+
+	private async Task DispatchDeviceStates()
+	{
+		var reader = DeviceStateUpdates!.Reader;
+		while (await reader.WaitToReadAsync())
+		{
+			// deliver everything queued up so far within a single GIL acquisition
+			using (AcquireGil("dispatch"))
+			{
+				while (reader.TryRead(out var update))
+				{
+					try
+					{
+						MethodCache["_dispatch_device_state_update"].Invoke(update.DeviceId.ToPython(), update.Method.ToPython(), update.Payload.ToPython(), update.Sequence.ToPython());
+					}
+					catch (PythonException e)
+					{
+						Console.WriteLine($"PythonDevice error: {e.Message}\n{e.StackTrace}");
+					}
+				}
+			}
+		}
+	}
+
 	public void SetDeviceManager(DeviceManager deviceManager)
 	{
 		DeviceManager = deviceManager;
@@ -200,9 +466,14 @@ public class PythonDevice : IDeviceHandler
 		if (HasBeenDisposed) return;
 		HasBeenDisposed = true;
 		DeviceManager?.UnregisterDevice(this);
+		if (DeviceStateUpdates != null)
+		{
+			DeviceManager!.StateChanged -= ForwardDeviceState;
+			DeviceStateUpdates.Writer.TryComplete();
+		}
 		using (Py.GIL())
 		{
-			PyModule.Set("is_running", false);
+			PyModule.Get("_dispose").Invoke();
 			Thread.Sleep(10);
 			PyModule.Dispose();
 		}
@@ -210,21 +481,86 @@ public class PythonDevice : IDeviceHandler
 
 	public object? OnSaveSnapshot(Func<string, Stream>? getStream, string deviceId)
 	{
-		using (Py.GIL())
+		var start = Stopwatch.GetTimestamp();
+		try
+		{
+			return GetSaveSnapshot();
+		}
+		finally
 		{
-			// here we intentionally use the prefixed snapshot function to get the snapshot as JSON
-			var methodName = MethodCache.ContainsKey("on_save_snapshot") ? "_on_save_snapshot" : "_get_state";
-			var snapshotJson = MethodCache[methodName].Invoke().As<string>();
-			return JsonSerializer.Deserialize<dynamic>(snapshotJson) ?? null;
+			Metrics.SaveSnapshotDuration.RecordSince(start);
 		}
 	}
 
+	private object? GetSaveSnapshot()
+	{
+		var version = Interlocked.Read(ref StateVersion);
+		var snapshot = CachedSaveSnapshot;
+		if (snapshot != null && snapshot.Version == version) return snapshot.Value;
+		string snapshotJson;
+		if (MethodCache.ContainsKey("on_save_snapshot"))
+		{
+			using (AcquireGil("save_snapshot"))
+			{
+				// here we intentionally use the prefixed snapshot function to get the snapshot as JSON
+				snapshotJson = MethodCache["_on_save_snapshot"].Invoke().As<string>();
+			}
+		}
+		else
+		{
+			snapshotJson = GetStateSnapshot().Json;
+		}
+		snapshot = new StateSnapshot(version, snapshotJson, JsonSerializer.Deserialize<dynamic>(snapshotJson) ?? null);
+		CachedSaveSnapshot = snapshot;
+		return snapshot.Value;
+	}
+
 	virtual public void OnBeforeSaveSnapshot() { }
 	virtual public void OnAfterSaveSnapshot() { }
-	virtual public Task OnRecord(Func<string, Stream> getStream, string deviceId, CancellationToken cancellationToken) { return Task.CompletedTask; }
+	virtual public Task OnRecord(Func<string, Stream> getStream, string deviceId, CancellationToken cancellationToken)
+	{
+		if (!MethodCache.ContainsKey("on_record")) return Task.CompletedTask;
+
+		var recording = new PythonRecording(getStream, deviceId);
+		try
+		{
+			using (AcquireGil("record"))
+			{
+				MethodCache["_start_recording"].Invoke(
+					new Func<string, string, int>(recording.Open).ToPython(),
+					new Action<int, PyObject>(recording.Write).ToPython()
+				);
+			}
+		}
+		catch (PythonException e)
+		{
+			Console.WriteLine($"PythonDevice error: {e.Message}\n{e.StackTrace}");
+			return recording.CompleteAsync();
+		}
+
+		var stopped = new TaskCompletionSource();
+		cancellationToken.Register(() => stopped.TrySetResult());
+		return Task.Run(async () =>
+		{
+			await stopped.Task;
+			try
+			{
+				using (AcquireGil("record"))
+				{
+					// hands over the partially filled blocks and closes the streams on the Python side
+					MethodCache["_stop_recording"].Invoke();
+				}
+			}
+			catch (PythonException e)
+			{
+				Console.WriteLine($"PythonDevice error: {e.Message}\n{e.StackTrace}");
+			}
+			await recording.CompleteAsync();
+		});
+	}
 	public object? GetSettings()
 	{
-		using (Py.GIL())
+		using (AcquireGil("settings"))
 		{
 			if (!MethodCache.ContainsKey("get_settings")) return null;
 			var settings = MethodCache["_get_settings"].Invoke().As<string>();
@@ -233,10 +569,11 @@ public class PythonDevice : IDeviceHandler
 	}
 	public void LoadSettings(JsonElement settings)
 	{
-		using (Py.GIL())
+		using (AcquireGil("settings"))
 		{
 			if (!MethodCache.ContainsKey("load_settings")) return;
 			MethodCache["_load_settings"].Invoke(JsonSerializer.Serialize(settings).ToPython());
 		}
+		MarkStateChanged();
 	}
 }
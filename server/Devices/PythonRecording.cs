@@ -0,0 +1,102 @@
+using System.Runtime.InteropServices;
+using System.Threading.Channels;
+using Python.Runtime;
+
+// The streams a Python device opened in `on_record`, each being written to `<deviceId>_<name>.npy`.
+// The blocks written by the script are copied and queued, such that the disk access happens on a background task instead of the acquisition thread.
+public class PythonRecording
+{
+	private readonly Func<string, Stream> GetStream;
+	private readonly string DeviceId;
+	private readonly List<(IDisposable Writer, Action<byte[]> Write)> Streams = new();
+	private readonly Channel<(int Handle, byte[] Data)> Blocks = Channel.CreateUnbounded<(int, byte[])>(new UnboundedChannelOptions { SingleReader = true });
+	private readonly Task WriterTask;
+
+	public PythonRecording(Func<string, Stream> getStream, string deviceId)
+	{
+		GetStream = getStream;
+		DeviceId = deviceId;
+		WriterTask = Task.Run(WriteBlocks);
+	}
+
+	// Returns the handle of the new stream, to be passed to `Write`.
+	public int Open(string name, string dtype)
+	{
+		var stream = GetStream($"{DeviceId}_{name}.npy");
+		var entry = dtype switch
+		{
+			"float32" => CreateWriter<float>(stream),
+			"float64" => CreateWriter<double>(stream),
+			"int32" => CreateWriter<int>(stream),
+			"int64" => CreateWriter<long>(stream),
+			_ => throw new ArgumentException($"Unsupported recording data type {dtype}."),
+		};
+		lock (Streams)
+		{
+			Streams.Add(entry);
+			return Streams.Count - 1;
+		}
+	}
+
+	private static (IDisposable, Action<byte[]>) CreateWriter<T>(Stream stream) where T : unmanaged
+	{
+		// the streams are closed by the DeviceManager once all devices finished recording
+		var writer = new NPYStreamWriter<T>(stream, false);
+		return (writer, data => writer.WriteArray(MemoryMarshal.Cast<byte, T>(data.AsSpan())));
+	}
+
+	// Called from Python (holding the GIL) with a C-contiguous array of the stream's data type.
+	public void Write(int handle, PyObject array)
+	{
+		using var nbytes = array.GetAttr("nbytes");
+		var length = nbytes.As<long>();
+		using var ctypes = array.GetAttr("ctypes");
+		using var pointer = ctypes.GetAttr("data");
+		var address = pointer.As<long>();
+		var data = new byte[length];
+		unsafe
+		{
+			new ReadOnlySpan<byte>((void*)address, (int)length).CopyTo(data);
+		}
+		Write(handle, data);
+	}
+
+	public void Write(int handle, byte[] data)
+	{
+		Blocks.Writer.TryWrite((handle, data));
+	}
+
+	private async Task WriteBlocks()
+	{
+		await foreach (var (handle, data) in Blocks.Reader.ReadAllAsync())
+		{
+			Action<byte[]> write;
+			lock (Streams)
+			{
+				write = Streams[handle].Write;
+			}
+			try
+			{
+				write(data);
+			}
+			catch (Exception e)
+			{
+				Console.WriteLine($"Failed to write recording of {DeviceId}: {e.Message}");
+			}
+		}
+	}
+
+	// Writes the remaining blocks and finalizes the .npy headers.
+	public async Task CompleteAsync()
+	{
+		Blocks.Writer.TryComplete();
+		await WriterTask;
+		lock (Streams)
+		{
+			foreach (var (writer, _) in Streams)
+			{
+				writer.Dispose();
+			}
+		}
+	}
+}
@@ -0,0 +1,87 @@
+using System.Collections;
+using System.Text.Json;
+
+public class PythonStreamData
+{
+	// The padding is required to make the data align with the 32-bit boundary
+	public byte _Padd { get; set; }
+	// Important for alignment: No other porperties should be before _Padding/Data
+	public required byte[] Data { get; set; }
+	public required int[] ChannelsInData { get; set; }
+	public required float XMin { get; set; }
+	public required float XMax { get; set; }
+	public float XMinDecimated { get; set; } = 0f;
+	public float XMaxDecimated { get; set; } = 0f;
+	public required int Length { get; set; }
+	public Dictionary<string, object?>? Meta { get; set; }
+}
+
+// A frame sent by `send_stream_data`: float32 samples per channel, covering XMin to XMax.
+public record PythonStreamFrame(float[][] Channels, float XMin, float XMax, Dictionary<string, object?>? Meta);
+
+public static class PythonStreaming
+{
+	private const int DefaultMaxSamples = 2000;
+	private static readonly JsonSerializerOptions MetaSerializerOptions = new() { Converters = { new NaturalObjectConverter() } };
+
+	// `xMin`/`xMax` of the meta data give the x range of the samples (default: the sample indices), everything else is passed on to the clients.
+	public static PythonStreamFrame CreateFrame(float[][] channels, string serializedMeta)
+	{
+		var meta = JsonSerializer.Deserialize<Dictionary<string, object?>>(serializedMeta, MetaSerializerOptions) ?? new();
+		var length = channels.Length == 0 ? 0 : channels[0].Length;
+		var xMin = meta.Remove("xMin", out var xMinValue) && xMinValue != null ? Convert.ToSingle(xMinValue) : 0f;
+		var xMax = meta.Remove("xMax", out var xMaxValue) && xMaxValue != null ? Convert.ToSingle(xMaxValue) : Math.Max(length - 1, 0);
+		return new PythonStreamFrame(channels, xMin, xMax, meta.Count > 0 ? meta : null);
+	}
+
+	public static void Send(DeviceManager deviceManager, IDeviceHandler device, PythonStreamFrame frame)
+	{
+		deviceManager.SendStreamData(deviceManager.GetDeviceId(device), Filter, frame);
+	}
+
+	// Applies the customization of a streaming connection: `xMin`/`xMax` (range to decimate to),
+	// `maxSamples` (default 2000) and `channels` (indices of the channels to send, default all).
+	public static PythonStreamData Filter(PythonStreamFrame frame, Dictionary<object, object>? customization)
+	{
+		var xMinWish = customization != null && customization.TryGetValue("xMin", out var xMinValue) ? Convert.ToSingle(xMinValue) : frame.XMin;
+		var xMaxWish = customization != null && customization.TryGetValue("xMax", out var xMaxValue) ? Convert.ToSingle(xMaxValue) : frame.XMax;
+		var maxSamples = customization != null && customization.TryGetValue("maxSamples", out var maxSamplesValue) ? Convert.ToInt32(maxSamplesValue) : DefaultMaxSamples;
+		var channels = Enumerable.Range(0, frame.Channels.Length);
+		if (customization != null && customization.TryGetValue("channels", out var selection) && selection is IEnumerable selectedChannels and not string)
+		{
+			var selected = selectedChannels.Cast<object>().Select(Convert.ToInt32).ToHashSet();
+			channels = channels.Where(selected.Contains);
+		}
+
+		var xMin = frame.XMin;
+		var xMax = frame.XMin;
+		var length = 0;
+		var decimated = new List<float[]>();
+		var channelsInData = new List<int>();
+		foreach (var channel in channels)
+		{
+			var decimation = SignalUtils.DecimateSignal(frame.Channels[channel], frame.XMin, frame.XMax, xMinWish, xMaxWish, maxSamples);
+			xMin = decimation.xMin;
+			xMax = decimation.xMax;
+			length = decimation.signal.Length;
+			decimated.Add(decimation.signal);
+			channelsInData.Add(channel);
+		}
+		var buffer = new byte[length * sizeof(float) * decimated.Count];
+		for (var i = 0; i < decimated.Count; i++)
+		{
+			Buffer.BlockCopy(decimated[i], 0, buffer, i * length * sizeof(float), length * sizeof(float));
+		}
+		return new PythonStreamData
+		{
+			XMin = frame.XMin,
+			XMax = frame.XMax,
+			XMinDecimated = xMin,
+			XMaxDecimated = xMax,
+			Data = buffer,
+			ChannelsInData = channelsInData.ToArray(),
+			Length = length,
+			Meta = frame.Meta,
+		};
+	}
+}
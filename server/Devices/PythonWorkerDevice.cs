@@ -0,0 +1,535 @@
+using System.Collections.Concurrent;
+using System.Diagnostics;
+using System.Globalization;
+using System.Text.Json;
+
+// Runs a Python device script in its own worker process (PythonBridge/worker.py) instead of the embedded interpreter,
+// such that a stalling instrument doesn't hold the GIL shared by all other Python devices.
+// Calls into the worker have a deadline; a worker missing it (or dying) gets restarted.
+// Messages are JSON objects, framed by their length as little-endian int32, on the worker's stdin/stdout.
+public class PythonWorkerDevice : IDeviceHandler
+{
+	private const string WorkerFilename = "PythonBridge/worker.py";
+	public static string PythonExecutable = Environment.GetEnvironmentVariable("LABORCHESTRA_PYTHON") ?? "python";
+	private readonly TimeSpan StartupTimeout = TimeSpan.FromSeconds(30);
+	private readonly TimeSpan HeartbeatInterval = TimeSpan.FromSeconds(1);
+	private readonly TimeSpan MinRestartInterval = TimeSpan.FromSeconds(5);
+
+	private readonly string Filename;
+	private readonly string SerializedArguments;
+	private readonly double MaxStatusUpdateRate;
+	private readonly TimeSpan CallTimeout;
+	private event Action<object>? OnStateUpdate;
+	private event Action<object>? OnStatePatch;
+	private event Action<object>? OnStreamEvent;
+	protected DeviceManager? DeviceManager;
+
+	private Process? Worker;
+	private DateTime LastStart = DateTime.MinValue;
+	private readonly object WriteLock = new();
+	private readonly object RestartLock = new();
+	private readonly ConcurrentDictionary<long, TaskCompletionSource<JsonElement>> PendingCalls = new();
+	private long LastCallId = 0;
+	private readonly HashSet<string> SubscribedDevices = new();
+	private object LastState = new();
+	// The worker's state is only fetched again once it (might have) changed; see PythonDevice.StateVersion.
+	private long StateVersion = 0;
+	private long LastStateVersion = -1;
+	private readonly CancellationTokenSource DisposeTokenSource = new();
+	private PythonRecording? Recording;
+	public PythonStartupProfile? StartupProfile { get; private set; }
+	// shared with DeviceManager.Metrics, a DeferredDevice hands over its own instance
+	public DeviceMetrics Metrics { get; set; } = new();
+
+	public PythonWorkerDevice(string filename, object? arguments = null, double maxStatusUpdateRate = 0, double callTimeoutInSeconds = 5)
+	{
+		Filename = filename;
+		SerializedArguments = JsonSerializer.Serialize(arguments);
+		MaxStatusUpdateRate = maxStatusUpdateRate;
+		CallTimeout = TimeSpan.FromSeconds(callTimeoutInSeconds);
+		StartWorker();
+		Task.Run(Watchdog);
+	}
+
+	private void StartWorker()
+	{
+		var startInfo = new ProcessStartInfo(PythonExecutable)
+		{
+			RedirectStandardInput = true,
+			RedirectStandardOutput = true,
+			UseShellExecute = false,
+		};
+		startInfo.ArgumentList.Add(WorkerFilename);
+		startInfo.ArgumentList.Add(Filename);
+		startInfo.ArgumentList.Add("--argv");
+		startInfo.ArgumentList.Add(SerializedArguments);
+		startInfo.ArgumentList.Add("--max-status-update-rate");
+		startInfo.ArgumentList.Add(MaxStatusUpdateRate.ToString(CultureInfo.InvariantCulture));
+
+		var workerReady = new TaskCompletionSource<string?>(TaskCreationOptions.RunContinuationsAsynchronously);
+		LastStart = DateTime.Now;
+		var worker = Process.Start(startInfo) ?? throw new InvalidOperationException($"Couldn't start the worker for {Filename}.");
+		Worker = worker;
+		Task.Factory.StartNew(() => ReadMessages(worker, workerReady), TaskCreationOptions.LongRunning);
+
+		if (!workerReady.Task.Wait(StartupTimeout))
+		{
+			StopWorker();
+			throw new TimeoutException($"The worker for {Filename} didn't start within {StartupTimeout.TotalSeconds} s.");
+		}
+		if (workerReady.Task.Result is string error)
+		{
+			StopWorker();
+			Console.WriteLine($"PythonWorkerDevice error: {error}");
+			throw new InvalidOperationException($"The worker for {Filename} failed to start.");
+		}
+		// a restarted worker starts over with the initial state
+		Interlocked.Increment(ref StateVersion);
+	}
+
+	private void StopWorker()
+	{
+		var worker = Worker;
+		Worker = null;
+		if (worker == null) return;
+		try
+		{
+			worker.Kill(true);
+		}
+		catch (InvalidOperationException)
+		{
+			// already exited
+		}
+		worker.Dispose();
+		foreach (var id in PendingCalls.Keys)
+		{
+			if (PendingCalls.TryRemove(id, out var call))
+			{
+				call.TrySetException(new IOException($"The worker for {Filename} has been stopped."));
+			}
+		}
+	}
+
+	// Restarts the worker, unless it has already been replaced since it stalled.
+	private void Restart(Process? stalledWorker)
+	{
+		lock (RestartLock)
+		{
+			if (HasBeenDisposed || stalledWorker != Worker) return;
+			StopWorker();
+			// don't let a script failing right away keep us busy
+			var wait = LastStart + MinRestartInterval - DateTime.Now;
+			if (wait > TimeSpan.Zero) Thread.Sleep(wait);
+			Console.WriteLine($"Restarting the worker for {Filename}.");
+			try
+			{
+				StartWorker();
+			}
+			catch (Exception e)
+			{
+				// the watchdog tries again
+				Console.WriteLine($"PythonWorkerDevice error: {e.Message}");
+			}
+		}
+	}
+
+	private async Task Watchdog()
+	{
+		while (!DisposeTokenSource.IsCancellationRequested)
+		{
+			try
+			{
+				await Task.Delay(HeartbeatInterval, DisposeTokenSource.Token);
+			}
+			catch (TaskCanceledException)
+			{
+				return;
+			}
+			if (Worker == null)
+			{
+				Restart(null);
+				continue;
+			}
+			try
+			{
+				Call("ping", []);
+			}
+			catch (Exception)
+			{
+				// a missed deadline already restarted the worker
+			}
+		}
+	}
+
+	private void ReadMessages(Process worker, TaskCompletionSource<string?> workerReady)
+	{
+		var stream = worker.StandardOutput.BaseStream;
+		var header = new byte[4];
+		try
+		{
+			while (true)
+			{
+				stream.ReadExactly(header);
+				var payload = new byte[BitConverter.ToInt32(header)];
+				stream.ReadExactly(payload);
+				using var document = JsonDocument.Parse(payload);
+				HandleMessage(document.RootElement.Clone(), workerReady);
+			}
+		}
+		catch (Exception e) when (e is EndOfStreamException || e is IOException || e is ObjectDisposedException)
+		{
+			// the worker exited
+		}
+		workerReady.TrySetResult("The worker exited.");
+		if (worker == Worker && !HasBeenDisposed)
+		{
+			Console.WriteLine($"The worker for {Filename} exited unexpectedly.");
+			Task.Run(() => Restart(worker));
+		}
+	}
+
+	private void HandleMessage(JsonElement message, TaskCompletionSource<string?> workerReady)
+	{
+		switch (message.GetProperty("type").GetString())
+		{
+			case "ready":
+				if (message.TryGetProperty("profile", out var profile))
+				{
+					StartupProfile = new PythonStartupProfile(0, profile.GetProperty("prelude").GetDouble(), profile.GetProperty("imports").GetDouble(), profile.GetProperty("exec").GetDouble(), profile.GetProperty("methodDiscovery").GetDouble());
+				}
+				workerReady.TrySetResult(null);
+				break;
+			case "failed":
+				workerReady.TrySetResult(message.GetProperty("message").GetString());
+				break;
+			case "result":
+				if (PendingCalls.TryRemove(message.GetProperty("id").GetInt64(), out var call))
+				{
+					call.TrySetResult(message.GetProperty("value"));
+				}
+				break;
+			case "error":
+				if (PendingCalls.TryRemove(message.GetProperty("id").GetInt64(), out var failedCall))
+				{
+					failedCall.TrySetException(new InvalidOperationException(message.GetProperty("message").GetString()));
+				}
+				break;
+			case "state_update":
+				Interlocked.Increment(ref StateVersion);
+				var serializedState = message.GetProperty("payload").GetString()!;
+				Metrics.RecordStatusUpdate(serializedState);
+				OnStateUpdate?.Invoke(JsonSerializer.Deserialize<dynamic>(serializedState)!);
+				break;
+			case "state_patch":
+				Interlocked.Increment(ref StateVersion);
+				var serializedPatches = message.GetProperty("payload").GetString()!;
+				Metrics.RecordStatusUpdate(serializedPatches);
+				OnStatePatch?.Invoke(JsonSerializer.Deserialize<dynamic>(serializedPatches)!);
+				break;
+			case "loop_iteration":
+				Metrics.RecordLoopIteration();
+				break;
+			case "stream_data":
+				ForwardStreamData(message);
+				break;
+			case "recording_block":
+				Recording?.Write(message.GetProperty("handle").GetInt32(), Convert.FromBase64String(message.GetProperty("data").GetString()!));
+				break;
+			case "call":
+				// calls of the script may take a while (or call back into the worker), so don't block reading
+				Task.Run(() => HandleWorkerCall(message));
+				break;
+		}
+	}
+
+	private void ForwardStreamData(JsonElement message)
+	{
+		if (DeviceManager == null) return;
+		var channelCount = message.GetProperty("channels").GetInt32();
+		var length = message.GetProperty("length").GetInt32();
+		var data = Convert.FromBase64String(message.GetProperty("data").GetString()!);
+		var channels = new float[channelCount][];
+		for (var i = 0; i < channelCount; i++)
+		{
+			channels[i] = new float[length];
+			Buffer.BlockCopy(data, i * length * sizeof(float), channels[i], 0, length * sizeof(float));
+		}
+		PythonStreaming.Send(DeviceManager, this, PythonStreaming.CreateFrame(channels, message.GetProperty("meta").GetRawText()));
+	}
+
+	private void HandleWorkerCall(JsonElement message)
+	{
+		var id = message.GetProperty("id").GetInt64();
+		try
+		{
+			var args = message.GetProperty("args");
+			object? value = message.GetProperty("method").GetString() switch
+			{
+				"get_device_state" => JsonSerializer.Serialize(GetDevice(args[0].GetString()!).GetState()),
+				"action" => WorkerAction(args),
+				"action_batch" => WorkerActionBatch(args),
+				"request" => JsonSerializer.Serialize(DeviceManager!.Request(DeviceAction.FromJson(args))),
+				"subscribe_device_state" => SubscribeToDeviceState(args[0].GetString()!),
+				"open_recording_stream" => (Recording ?? throw new InvalidOperationException("Not recording.")).Open(args[0].GetString()!, args[1].GetString()!),
+				var method => throw new InvalidOperationException($"Unknown worker call {method}."),
+			};
+			Send(new { id, type = "result", value });
+		}
+		catch (Exception e)
+		{
+			Send(new { id, type = "error", message = e.Message });
+		}
+	}
+
+	private IDeviceHandler GetDevice(string deviceName)
+	{
+		if (DeviceManager == null || !DeviceManager.Devices.TryGetValue(deviceName, out var device)) throw new ArgumentException($"Device {deviceName} doesn't exist.");
+		return device;
+	}
+
+	private object? WorkerAction(JsonElement args)
+	{
+		DeviceManager!.Action(DeviceAction.FromJson(args));
+		return null;
+	}
+
+	private object? WorkerActionBatch(JsonElement args)
+	{
+		DeviceManager!.ActionBatch(BatchedAction.ListFromJson(args[0]), args[1].GetBoolean(), args[2].GetBoolean());
+		return null;
+	}
+
+	private object? SubscribeToDeviceState(string deviceName)
+	{
+		GetDevice(deviceName);
+		lock (SubscribedDevices)
+		{
+			// after a restart, the worker subscribes again
+			if (!SubscribedDevices.Add(deviceName)) return null;
+			if (SubscribedDevices.Count == 1) DeviceManager!.StateChanged += ForwardDeviceState;
+		}
+		return null;
+	}
+
+	private void ForwardDeviceState(string deviceId, string method, object payload)
+	{
+		lock (SubscribedDevices)
+		{
+			if (!SubscribedDevices.Contains(deviceId)) return;
+		}
+		try
+		{
+			// sent before the reply of an action causing it, so the script reads its own writes
+			Send(new { type = "state_changed", device_id = deviceId, method, payload = JsonSerializer.Serialize(payload) });
+		}
+		catch (IOException)
+		{
+			// the worker is being restarted
+		}
+	}
+
+	private void Send(object message)
+	{
+		var payload = JsonSerializer.SerializeToUtf8Bytes(message);
+		lock (WriteLock)
+		{
+			var worker = Worker ?? throw new IOException($"The worker for {Filename} isn't running.");
+			try
+			{
+				var stream = worker.StandardInput.BaseStream;
+				stream.Write(BitConverter.GetBytes(payload.Length));
+				stream.Write(payload);
+				stream.Flush();
+			}
+			catch (Exception e) when (e is InvalidOperationException || e is ObjectDisposedException)
+			{
+				throw new IOException($"The worker for {Filename} isn't running.", e);
+			}
+		}
+	}
+
+	private JsonElement Call(string method, object?[] args, TimeSpan? timeout = null)
+	{
+		var id = Interlocked.Increment(ref LastCallId);
+		var call = new TaskCompletionSource<JsonElement>(TaskCreationOptions.RunContinuationsAsynchronously);
+		PendingCalls[id] = call;
+		var deadline = timeout ?? CallTimeout;
+		var worker = Worker;
+		try
+		{
+			Send(new { id, type = "call", method, args });
+			if (!call.Task.Wait(deadline))
+			{
+				Console.WriteLine($"PythonWorkerDevice {Filename}: {method} missed its deadline of {deadline.TotalSeconds} s.");
+				Task.Run(() => Restart(worker));
+				throw new TimeoutException($"{method} didn't finish within {deadline.TotalSeconds} s.");
+			}
+			return call.Task.Result;
+		}
+		catch (AggregateException e) when (e.InnerException != null)
+		{
+			throw e.InnerException;
+		}
+		finally
+		{
+			PendingCalls.TryRemove(id, out _);
+		}
+	}
+
+	public object GetState()
+	{
+		var version = Interlocked.Read(ref StateVersion);
+		if (version == Interlocked.Read(ref LastStateVersion)) return LastState;
+		var start = Stopwatch.GetTimestamp();
+		try
+		{
+			var stateJson = Call("get_state", []).GetString()!;
+			LastState = JsonSerializer.Deserialize<JsonElement>(stateJson).ToDynamic() ?? new object();
+			Interlocked.Exchange(ref LastStateVersion, version);
+		}
+		catch (Exception e)
+		{
+			// a stalled worker mustn't stall the others, so we rather hand out the last known state
+			Console.WriteLine($"PythonWorkerDevice {Filename}: using the last known state ({e.Message})");
+		}
+		Metrics.GetStateDuration.RecordSince(start);
+		return LastState;
+	}
+
+	public object HandleActionAsync(DeviceAction action)
+	{
+		if (action.ActionName.ToLower() == "getstate")
+		{
+			return GetState();
+		}
+		try
+		{
+			return Call("action", [action.ActionName, action.Parameters]);
+		}
+		catch (Exception ex)
+		{
+			throw new InvalidOperationException($"Failed to invoke action method {action.ActionName}.", ex);
+		}
+		finally
+		{
+			Interlocked.Increment(ref StateVersion);
+		}
+	}
+
+	public void SubscribeToStateUpdates(Action<object> onStateUpdate)
+	{
+		OnStateUpdate += onStateUpdate;
+	}
+
+	public void SubscribeToStatePatches(Action<object> onStatePatch)
+	{
+		OnStatePatch += onStatePatch;
+	}
+
+	public void SubscribeToStreamEvents(Action<object> onStreamEvent)
+	{
+		OnStreamEvent += onStreamEvent;
+	}
+
+	public void SetDeviceManager(DeviceManager deviceManager)
+	{
+		DeviceManager = deviceManager;
+	}
+
+	private bool HasBeenDisposed = false;
+	public void Dispose()
+	{
+		if (HasBeenDisposed) return;
+		HasBeenDisposed = true;
+		DisposeTokenSource.Cancel();
+		DeviceManager?.UnregisterDevice(this);
+		lock (SubscribedDevices)
+		{
+			if (SubscribedDevices.Count > 0) DeviceManager!.StateChanged -= ForwardDeviceState;
+		}
+		lock (RestartLock)
+		{
+			var worker = Worker;
+			try
+			{
+				Call("dispose", [], TimeSpan.FromSeconds(1));
+				worker?.WaitForExit(TimeSpan.FromSeconds(2));
+			}
+			catch (Exception)
+			{
+				// killed below
+			}
+			StopWorker();
+		}
+	}
+
+	public object? OnSaveSnapshot(Func<string, Stream>? getStream, string deviceId)
+	{
+		var start = Stopwatch.GetTimestamp();
+		try
+		{
+			var snapshotJson = Call("on_save_snapshot", []).GetString()!;
+			return JsonSerializer.Deserialize<dynamic>(snapshotJson) ?? null;
+		}
+		catch (Exception e)
+		{
+			Console.WriteLine($"PythonWorkerDevice {Filename}: saving the last known state ({e.Message})");
+			return LastState;
+		}
+		finally
+		{
+			Metrics.SaveSnapshotDuration.RecordSince(start);
+		}
+	}
+
+	virtual public void OnBeforeSaveSnapshot() { }
+	virtual public void OnAfterSaveSnapshot() { }
+	virtual public Task OnRecord(Func<string, Stream> getStream, string deviceId, CancellationToken cancellationToken)
+	{
+		var recording = new PythonRecording(getStream, deviceId);
+		Recording = recording;
+		try
+		{
+			if (!Call("start_recording", []).GetBoolean())
+			{
+				Recording = null;
+				return recording.CompleteAsync();
+			}
+		}
+		catch (Exception e)
+		{
+			Console.WriteLine($"PythonWorkerDevice {Filename}: not recording ({e.Message})");
+			Recording = null;
+			return recording.CompleteAsync();
+		}
+
+		var stopped = new TaskCompletionSource();
+		cancellationToken.Register(() => stopped.TrySetResult());
+		return Task.Run(async () =>
+		{
+			await stopped.Task;
+			try
+			{
+				// the remaining blocks arrive before the reply
+				Call("stop_recording", []);
+			}
+			catch (Exception e)
+			{
+				Console.WriteLine($"PythonWorkerDevice {Filename}: failed to stop recording ({e.Message})");
+			}
+			Recording = null;
+			await recording.CompleteAsync();
+		});
+	}
+	public object? GetSettings()
+	{
+		var settings = Call("get_settings", []);
+		if (settings.ValueKind == JsonValueKind.Null) return null;
+		return JsonSerializer.Deserialize<dynamic>(settings.GetString()!) ?? null;
+	}
+	public void LoadSettings(JsonElement settings)
+	{
+		Call("load_settings", [JsonSerializer.Serialize(settings)]);
+		Interlocked.Increment(ref StateVersion);
+	}
+}
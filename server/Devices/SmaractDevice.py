@@ -1,18 +1,32 @@
-from smaract import ctl
+import threading
 import time
 from typing import Callable, Any
+from timeseries import RecordedSeries
 
 state = {"channels": []}
 
 argv: Any
 is_running: bool
-send_status_update: Callable[[], None]
+send_status_update: Callable[..., None]
 
 if not hasattr(argv, "device"):
     raise Exception("Smaract: Missing `device`")
 
+if getattr(argv, "simulate", False):
+    from simulated_instruments import SimulatedSmarActCTL
+    ctl = SimulatedSmarActCTL()
+else:
+    from smaract import ctl
+
 handle = ctl.Open(argv.device)
 num_channels = 0
+recording: RecordedSeries = None
+
+# The positions are read every `fastPollInterval` seconds while a channel is
+# moving; at rest, the interval doubles up to `slowPollInterval`.
+fast_poll_interval = getattr(argv, "fastPollInterval", 0.05)
+slow_poll_interval = getattr(argv, "slowPollInterval", 1)
+wake_up = threading.Event()
 
 def get_scale_factor(move_mode):
     if move_mode == "closed-loop":
@@ -33,6 +47,11 @@ def move_to(iChannel, position, mode):
         position -= channel["targetPosition"]
     channel["targetPosition"] = position
     ctl.Move(handle, iChannel, int(position * get_scale_factor(channel["mode"]) + 0.5))
+    channel["moving"] = True
+    # published right away, such that waiting for the move to finish works
+    # despite the rate limit
+    send_status_update(flush=True)
+    wake_up.set()
 
 
 def set_mode(iChannel, mode):
@@ -71,6 +90,37 @@ def set_velocity(iChannel, velocity, mode):
 def stop():
     for i in range(num_channels):
         ctl.Stop(handle, i)
+    wake_up.set()
+
+
+def read_channels():
+    # position and channel state of all channels within a single round trip to the controller
+    t_handle = ctl.OpenOutputBuffer(handle)
+    requests = [
+        (ctl.RequestReadProperty(handle, i, ctl.Property.POSITION, t_handle), ctl.RequestReadProperty(handle, i, ctl.Property.CHANNEL_STATE, t_handle))
+        for i in range(num_channels)
+    ]
+    ctl.CloseOutputBuffer(handle, t_handle)
+    return [(ctl.ReadProperty_i64(handle, position), ctl.ReadProperty_i32(handle, channel_state)) for position, channel_state in requests]
+
+
+def watch_events():
+    # movement completions are published as soon as the controller reports them
+    while is_running:
+        try:
+            event = ctl.WaitForEvent(handle, 500)
+        except ctl.Error as e:
+            if e.code != ctl.ErrorCode.TIMEOUT and is_running:
+                print(f"Smaract: {e}")
+                time.sleep(0.5)
+            continue
+        if event.type != ctl.EventType.MOVEMENT_FINISHED or not 0 <= event.idx < num_channels:
+            continue
+        channel = state["channels"][event.idx]
+        channel["moving"] = False
+        channel["lastMovement"] = {"finished": time.time(), "errorCode": event.i32}
+        # the final position is read right away
+        wake_up.set()
 
 def main():
     global num_channels
@@ -86,6 +136,8 @@ def main():
                 "actualPosition": 0,
                 "mode": "unknown",
                 "supportedModes": [],
+                "moving": False,
+                "lastMovement": None,
             })
             continue
         converted_move_mode = "closed-loop" if move_mode == ctl.MoveMode.CL_ABSOLUTE else "open-loop" if move_mode == ctl.MoveMode.STEP else "scan" if move_mode == ctl.MoveMode.SCAN_ABSOLUTE else "unknown"
@@ -106,18 +158,36 @@ def main():
             "velocity": move_velocity / scale_factor,
             "mode": converted_move_mode,
             "supportedModes": ["closed-loop", "open-loop", "scan"], # todo: get supported modes from device
+            "moving": False,
+            "lastMovement": None,
         })
 
+    event_watcher = threading.Thread(target=watch_events, name="Smaract.events", daemon=True)
+    event_watcher.start()
+    poll_interval = fast_poll_interval
     while is_running:
+        wake_up.clear()
         try:
-            for i in range(num_channels):
-                actual_position = ctl.GetProperty_i64(handle, i, ctl.Property.POSITION)
-                state["channels"][i]["actualPosition"] = actual_position / 1_000_000 # convert to um
+            moving = False
+            for channel, (actual_position, channel_state) in zip(state["channels"], read_channels()):
+                channel["actualPosition"] = actual_position / 1_000_000 # convert to um
+                channel["moving"] = bool(channel_state & ctl.ChannelState.ACTIVELY_MOVING)
+                moving |= channel["moving"]
+            if recording is not None:
+                recording.write(time.time(), [channel["actualPosition"] for channel in state["channels"]])
             send_status_update()
+            poll_interval = fast_poll_interval if moving else min(2 * poll_interval, slow_poll_interval)
         except Exception as e:
-            pass
-        time.sleep(0.1)
+            print(f"Smaract: {e}")
+            poll_interval = slow_poll_interval
+        wake_up.wait(poll_interval)
+    event_watcher.join()
     ctl.Close(handle)
 
+def on_record(get_stream):
+    global recording
+    recording = RecordedSeries(get_stream, [f"C{i + 1}" for i in range(num_channels)])
+
+
 def on_save_snapshot():
     return [channel["actualPosition"] for channel in state["channels"]]
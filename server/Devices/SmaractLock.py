@@ -1,89 +1,139 @@
 import time
+from collections import deque
 import numpy as np
 
-state = {"lockZ": False}
+state = {"lockZ": False, "zCenter": None, "lastStep": None}
 
 argv: any
 is_running: bool
 send_status_update: callable
 get_device_state: callable
+wait_for_state: callable
 action: callable
 request: callable
 
+osci_channel = getattr(argv, "osciChannel", 0)
+smaract_z_channel = getattr(argv, "smaractZChannel", 0)
+# FFT averaging duration of the oscilloscope while locking
+averaging_duration = getattr(argv, "averagingDuration", 500)
+# after each move, the spectrum is read once it's averaged for `settleFactor`
+# averaging durations (the previous position then contributes e^-settleFactor)
+settle_factor = getattr(argv, "settleFactor", 2)
+# fraction of the way to the fitted minimum moved per update
+gain = getattr(argv, "gain", 0.5)
+# number of recent measurements the parabola is fitted to
+fit_points = getattr(argv, "fitPoints", 6)
+debug = getattr(argv, "debug", False)
+# dither amplitude and the limits of a single update of the center position
+STEP_LIMITS = {
+    "closed-loop": {"dither": 0.010, "minStep": 0.001, "maxStep": 0.050},  # µm
+    "scan": {"dither": 0.100, "minStep": 0.010, "maxStep": 0.500},  # V
+}
+DITHER_PATTERN = [-1, 0, 1, 0]
+
 
 def start_z_lock():
     state["lockZ"] = True
-    action("het", None, 'setFFTAveragingDuration', [500])
+    action("het", None, 'setFFTAveragingDuration', [averaging_duration])
 
 
 def stop_z_lock():
     state["lockZ"] = False
 
+
+def get_step_limits(move_mode):
+    if move_mode not in STEP_LIMITS:
+        raise Exception(f"Invalid move mode: {move_mode}")
+    limits = dict(STEP_LIMITS[move_mode])
+    for name in limits:
+        limits[name] = getattr(argv, name, limits[name])
+    return limits
+
+
+def fit_step(positions, signals, center, limits):
+    """Step of the center towards the minimum of a parabola fitted to the measurements.
+
+    Without a minimum (flat or concave fit), it steps downhill by the maximal step.
+    """
+    # relative coordinates keep the fit well-conditioned
+    x = (positions - center) / limits["dither"]
+    y = signals / signals.mean()
+    curvature, slope, _ = np.polyfit(x, y, 2)
+    if curvature > 0:
+        step = -gain * slope / (2 * curvature) * limits["dither"]
+    else:
+        step = -np.sign(slope) * limits["maxStep"]
+    return float(np.clip(step, -limits["maxStep"], limits["maxStep"]))
+
+
 def main():
-    osci_channel = 0
-    smaract_z_channel = 0
-    alpha = 1
-    debug = False
-    
+    heterodyne_frequency = 0
+
     def get_peak_height():
         f, psd = request("het", None, "GetFFT", [osci_channel, heterodyne_frequency - 5e3, heterodyne_frequency + 5e3])
-        return np.sum(psd)
+        # the spectrum is in dB; the peak's power is summed linearly
+        return float(np.sum(10 ** (np.asarray(psd, dtype=np.float64) / 10)))
 
-    def get_move_by(move_mode):
-        if move_mode == "closed-loop":
-            return 0.010 # 10 nm
-        if move_mode == "scan":
-            return 0.100 # 100 mV
-        raise Exception(f"Invalid move mode: {move_mode}")
-    
+    def wait_for_smaract():
+        wait_for_state("smaract", lambda s: not s["channels"][smaract_z_channel].get("moving", False), timeout=1)
+
+    positions = deque(maxlen=fit_points)
+    signals = deque(maxlen=fit_points)
+    center = None
+    move_mode = None
+    dither_index = 0
     while is_running:
         try:
             if not state["lockZ"]:
-                time.sleep(1)
+                if center is not None:
+                    try:
+                        # back from the dither to the locked position
+                        action("smaract", None, "move_to", [smaract_z_channel, center, move_mode])
+                    finally:
+                        center = None
+                        state["zCenter"] = None
+                        send_status_update()
+                time.sleep(0.5)
                 continue
-            
+
             constants = get_device_state("constants")
             heterodyne_frequency = constants["HeterodyneFrequency"]
-            smaract_state = get_device_state("smaract")
-            
-            move_mode = smaract_state["channels"][smaract_z_channel]["mode"]
-            z_position = smaract_state["channels"][smaract_z_channel]["targetPosition"]
-            move_by = get_move_by(move_mode)
-            
-            time.sleep(1)
-            if not is_running or not state["lockZ"]: continue
-            signal_zero = get_peak_height()
-            
-            # move to x - dx
-            action("smaract", None, "move_to", [smaract_z_channel, z_position - move_by, move_mode])
-            time.sleep(1)
-            if not is_running or not state["lockZ"]: continue
-            signal_minus = get_peak_height()
+            smaract_channel = get_device_state("smaract")["channels"][smaract_z_channel]
+            if center is None or smaract_channel["mode"] != move_mode:
+                # (re)start from where the positioner is
+                move_mode = smaract_channel["mode"]
+                center = smaract_channel["targetPosition"]
+                positions.clear()
+                signals.clear()
+            limits = get_step_limits(move_mode)
+            settle_time = settle_factor * get_device_state("het")["FFTAveragingDurationInMilliseconds"] / 1000
 
-            # move to x + dx
-            action("smaract", None, "move_to", [smaract_z_channel, z_position + move_by, move_mode])
-            time.sleep(1)
+            position = center + DITHER_PATTERN[dither_index % len(DITHER_PATTERN)] * limits["dither"]
+            dither_index += 1
+            action("smaract", None, "move_to", [smaract_z_channel, position, move_mode])
+            wait_for_smaract()
+            time.sleep(settle_time)
             if not is_running or not state["lockZ"]: continue
-            signal_plus = get_peak_height()
-            
-            if signal_zero == 0 or np.isnan(signal_zero):
+            signal = get_peak_height()
+            if signal == 0 or not np.isfinite(signal):
                 print(f"SmaractLock: signal is zero or NaN")
                 continue
-            
-            # try to find the minimal position
+            positions.append(position)
+            signals.append(signal)
+            if len(positions) < 3:
+                continue
+
+            # updated with every new averaged spectrum
+            step = fit_step(np.array(positions), np.array(signals), center, limits)
+            if abs(step) < limits["minStep"]:
+                step = 0.0
             if debug:
-                action("smaract", None, "move_to", [smaract_z_channel, z_position, move_mode])
-            if signal_zero < min(signal_minus, signal_plus):
-                if not debug:
-                    action("smaract", None, "move_to", [smaract_z_channel, z_position, move_mode])
+                print(f"simulated move of smaract to new optimum by {step} {'µm' if move_mode == 'closed-loop' else 'V'}")
             else:
-                relative_change = (signal_plus - signal_minus) / signal_zero
-                gradient = relative_change / (2 * move_by)
-                gradient = np.clip(gradient, -10, 10)
-                if debug:
-                    print(f"simulated move of smaract to new optimum by {alpha * gradient} {'µm' if move_mode == 'closed-loop' else 'V'}")
-                else:
-                    action("smaract", None, "move_to", [smaract_z_channel, z_position + alpha * gradient, move_mode])
+                center += step
+            state["zCenter"] = center
+            state["lastStep"] = step
+            send_status_update()
         except Exception as e:
             print(f"SmaractLock: error {e}")
             time.sleep(1)
@@ -1,47 +1,125 @@
-import pyvisa
+import numpy as np
 import time
-
-state = { "status": "not found", "theta": 0, "eta": 0, "DOP": 0, "power": 0}
-
-
-class PaxData:
-	# 1170,95294,5,134283776,6,5856,29712,3.349497e-2,1.38085,-8.918476e-2,-2.549722e-1,9.227656e-1,7.660135e-5
-    revs: int
-    timestamp: int
-    paxOpMode: int
-    paxFlags: int
-    paxTIARange: int
-    adcMin: int
-    adcMax: int
-    revTime: float
-    misAdj: float
-    theta: float
-    eta: float
-    DOP: float
-    Ptotal: float
-    def __init__(self, revs, timestamp, paxOpMode, paxFlags, paxTIARange, adcMin, adcMax, revTime, misAdj, theta, eta, DOP, Ptotal):
-        self.revs = int(revs)
-        self.timestamp = int(timestamp)
-        self.paxOpMode = int(paxOpMode)
-        self.paxFlags = int(paxFlags)
-        self.paxTIARange = int(paxTIARange)
-        self.adcMin = int(adcMin)
-        self.adcMax = int(adcMax)
-        self.revTime = float(revTime)
-        self.misAdj = float(misAdj)
-        self.theta = float(theta)
-        self.eta = float(eta)
-        self.DOP = float(DOP)
-        self.Ptotal = float(Ptotal)
-
+from timeseries import RecordedSeries, RingBuffer, decimate_min_max, to_json_list
 
 argv: any
 is_running: bool
 send_status_update: callable
+send_stream_data: callable
+
+state = { "status": "not found", "theta": 0, "eta": 0, "DOP": 0, "power": 0, "thetaStd": 0, "etaStd": 0, "revolutionRate": 0 }
 
-rm = pyvisa.ResourceManager()
+# fields of a `SENS:DATA:LAT?` record, e.g.
+# 1170,95294,5,134283776,6,5856,29712,3.349497e-2,1.38085,-8.918476e-2,-2.549722e-1,9.227656e-1,7.660135e-5
+PAX_FIELDS = ["revs", "timestamp", "paxOpMode", "paxFlags", "paxTIARange", "adcMin", "adcMax", "revTime", "misAdj", "theta", "eta", "DOP", "Ptotal"]
+REVS, FLAGS, THETA, ETA, DOP, PTOTAL = (PAX_FIELDS.index(name) for name in ["revs", "paxFlags", "theta", "eta", "DOP", "Ptotal"])
+
+# "latest" publishes a single revolution every 0.33 s, "buffered" reads every revolution
+# and publishes their averages every `publishInterval` seconds
+mode = getattr(argv, "mode", "latest")
+publish_interval = getattr(argv, "publishInterval", 0.1) if mode == "buffered" else 0.33
+# "buffered" queries twice per revolution, as the instrument repeats the latest one in
+# between, and every `minQueryInterval` seconds as long as the revolution rate isn't known
+min_query_interval = getattr(argv, "minQueryInterval", 0.005)
+# revolutions available via get_waveform (theta, eta, DOP, power)
+history = RingBuffer(getattr(argv, "historyLength", 100000), 4)
+recording: RecordedSeries = None
+
+if getattr(argv, "simulate", False):
+	from simulated_instruments import SimulatedResourceManager
+	rm = SimulatedResourceManager()
+else:
+	import pyvisa
+	rm = pyvisa.ResourceManager()
 inst = rm.open_resource(argv.device)
 
+
+def flags_to_status(flags):
+	if flags & 0x01:
+		return "motor speed too low"
+	elif flags & 0x02:
+		return "motor speed too high"
+	elif flags & 0x04:
+		return "power too low"
+	elif flags & 0x08:
+		return "power too high"
+	elif flags & 0x10:
+		return "temperature too low"
+	elif flags & 0x0dff:
+		return "error"
+	return "ok"
+
+
+def parse_records(replies):
+	# all replies are parsed at once, into one row per revolution
+	values = np.array(",".join(reply.strip() for reply in replies).split(","), dtype=np.float64)
+	return values.reshape(-1, len(PAX_FIELDS))
+
+
+def new_revolutions(records, last_revs):
+	# the instrument repeats the latest revolution until the next one has been measured
+	revs = records[:, REVS]
+	is_new = np.empty(len(records), dtype=bool)
+	is_new[0] = revs[0] != last_revs
+	is_new[1:] = revs[1:] != revs[:-1]
+	return records[is_new]
+
+
+def publish(records, t_start, t_end):
+	valid = records[(records[:, FLAGS].astype(np.int64) & 0x0dff) == 0]
+	if len(valid) == 0:
+		valid = records
+	# theta is an orientation, so it's averaged on the doubled angle to not break at ±π/2
+	double_theta = 2 * valid[:, THETA]
+	state["status"] = flags_to_status(int(records[-1, FLAGS]))
+	state["theta"] = float(np.arctan2(np.sin(double_theta).mean(), np.cos(double_theta).mean()) / 2)
+	state["eta"] = float(valid[:, ETA].mean())
+	state["DOP"] = float(valid[:, DOP].mean())
+	state["power"] = float(valid[:, PTOTAL].mean())
+	state["thetaStd"] = float(valid[:, THETA].std())
+	state["etaStd"] = float(valid[:, ETA].std())
+	state["revolutionRate"] = len(records) / max(t_end - t_start, 1e-9)
+	times = np.linspace(t_start, t_end, len(records) + 1)[1:]
+	revolutions = records[:, [THETA, ETA, DOP, PTOTAL]]
+	history.extend(times, revolutions)
+	if recording is not None:
+		recording.write(times, revolutions)
+	send_status_update()
+	# the individual revolutions, with x being the seconds since t0
+	send_stream_data(revolutions.T, {"xMin": 0, "xMax": t_end - t_start, "t0": t_start, "channelNames": ["theta", "eta", "DOP", "power"]})
+
+
+def publish_error():
+	state["status"] = "error"
+	state["theta"] = 0
+	state["eta"] = 0
+	state["DOP"] = 0
+	state["power"] = 0
+	send_status_update()
+
+
+def on_record(get_stream):
+	# every revolution, also those in between the published averages
+	global recording
+	recording = RecordedSeries(get_stream, ["theta", "eta", "DOP", "power"])
+
+
+def get_waveform(duration=10, max_points=1000):
+	"""Theta, eta, DOP and power of the revolutions within the last `duration` seconds, min/max-decimated to `max_points`."""
+	times, values = history.get(time.time() - duration)
+	waveform = {}
+	for column, name in enumerate(["theta", "eta", "DOP", "power"]):
+		t, minima, maxima = decimate_min_max(times, values[:, column], int(max_points))
+		waveform["t"] = t.tolist()
+		waveform[name] = {"min": to_json_list(minima), "max": to_json_list(maxima)}
+	return waveform
+
+
+def query_interval():
+	revolution_rate = state["revolutionRate"]
+	return max(min_query_interval, 0.5 / revolution_rate) if revolution_rate > 0 else min_query_interval
+
+
 def main():
 	idn = inst.query("*IDN?")
 	if not idn.startswith("THORLABS,PAX"):
@@ -53,35 +131,35 @@ def main():
 	inst.write("INP:ROT:STAT ON")
 
 	time.sleep(1)
+	last_revs = -1
+	replies = []
+	t_start = time.time()
+	last_query = 0
 	while is_running:
 		try:
-			result = PaxData(*inst.query("SENS:DATA:LAT?").split(","))
-			status = "ok"
-			if result.paxFlags & 0x01:
-				status = "motor speed too low"
-			elif result.paxFlags & 0x02:
-				status = "motor speed too high"
-			elif result.paxFlags & 0x04:
-				status = "power too low"
-			elif result.paxFlags & 0x08:
-				status = "power too high"
-			elif result.paxFlags & 0x10:
-				status = "temperature too low"
-			elif result.paxFlags & 0x0dff:
-				status = "error"
-			state["status"] = status
-			state["theta"] = result.theta
-			state["eta"] = result.eta
-			state["DOP"] = result.DOP
-			state["power"] = result.Ptotal
+			if mode == "buffered":
+				delay = last_query + query_interval() - time.perf_counter()
+				if delay > 0:
+					time.sleep(delay)
+				last_query = time.perf_counter()
+			replies.append(inst.query("SENS:DATA:LAT?"))
+			t_end = time.time()
+			if mode == "buffered" and t_end - t_start < publish_interval:
+				continue
+			records = new_revolutions(parse_records(replies), last_revs)
+			replies.clear()
+			if len(records) > 0:
+				last_revs = records[-1, REVS]
+				publish(records, t_start, t_end)
+			t_start = t_end
 		except Exception as e:
 			print(f"Error: {e}")
-			state["status"] = "error"
-			state["theta"] = 0
-			state["eta"] = 0
-			state["DOP"] = 0
-			state["power"] = 0
-		send_status_update()
-		time.sleep(0.33)
+			replies.clear()
+			publish_error()
+			time.sleep(publish_interval)
+			t_start = time.time()
+			continue
+		if mode != "buffered":
+			time.sleep(publish_interval)
 	inst.write("INP:ROT:STAT OFF")
 	inst.close()
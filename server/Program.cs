@@ -75,6 +75,23 @@ app.MapGet("/api/ping", async (HttpContext context, AccessControlService accessC
 	await context.Response.WriteAsync("Pong");
 });
 
+// Prometheus scrape endpoint
+app.MapGet("/api/metrics", async (HttpContext context, AccessControlService accessControlService, DeviceManager deviceManager) =>
+{
+	var isLocalRequest = ConnectionUtils.IsLocal(context.Connection);
+	if (!isLocalRequest)
+	{
+		var authHeader = context.Request.Headers["Authorization"].ToString();
+		if (!accessControlService.IsBearerValid(authHeader))
+		{
+			context.Response.StatusCode = 401; // Unauthorized
+			return;
+		}
+	}
+	context.Response.ContentType = "text/plain; version=0.0.4";
+	await context.Response.WriteAsync(PrometheusExporter.Export(deviceManager.Metrics));
+});
+
 app.UseSpaYarp();
 
 // Start up the DeviceManager
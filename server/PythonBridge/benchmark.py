@@ -0,0 +1,179 @@
+# Benchmarks the hot paths of the Python device bridge using the Demo* devices
+# in the standalone host:
+#
+#   python PythonBridge/benchmark.py [--json results.json] [--compare baseline.json]
+#
+# With --compare, metrics which got worse by more than --tolerance are reported
+# and the script exits with a non-zero status.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from host import DeviceHost  # noqa: E402
+
+DEVICES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Devices")
+
+# metric name suffixes for which larger values are better
+HIGHER_IS_BETTER = ("_per_s",)
+
+
+class MessageCounter:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        # counts only the messages of this device, if set
+        self.device_id = None
+
+    def __call__(self, device_id, method, serialized_payload):
+        if self.device_id is not None and device_id != self.device_id:
+            return
+        self.messages += 1
+        self.bytes += len(serialized_payload.encode())
+
+    def reset(self, device_id=None):
+        self.messages = 0
+        self.bytes = 0
+        self.device_id = device_id
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def time_calls(function, repetitions):
+    durations = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return {
+        "median_us": percentile(durations, 0.5) * 1e6,
+        "p99_us": percentile(durations, 0.99) * 1e6,
+    }
+
+
+def prefixed(prefix, metrics):
+    return {f"{prefix}.{name}": value for name, value in metrics.items()}
+
+
+def benchmark_actions(host, repetitions):
+    rfgen = host.devices["cavity_detuning"]
+    elliptec = host.devices["elliptec"]
+    results = {}
+    results.update(prefixed("action.rfgen.set_frequency", time_calls(lambda: rfgen.handle_action("set_frequency", [0, 9e9]), repetitions)))
+    results.update(prefixed("action.elliptec.set_position", time_calls(lambda: elliptec.handle_action("set_position", [1, 45.0]), repetitions)))
+    results.update(prefixed("action.smaract.move_to", time_calls(lambda: host.devices["smaract"].handle_action("move_to", [0, 1.5, "closed-loop"]), repetitions)))
+    return results
+
+
+def benchmark_status_updates(host, counter, repetitions):
+    # DemoRFGen has no main() which would publish in between
+    scope = host.devices["cavity_detuning"].scope
+    channel = scope["state"]["channels"][0]
+    results = {}
+    for label, full in [("patch", False), ("full", True)]:
+        # publishes what is pending and cancels the trailing-edge timer of the
+        # rate limit, which would otherwise swallow all of the calls below
+        scope["send_status_update"](flush=True)
+        counter.reset("cavity_detuning")
+        start = time.perf_counter()
+        for i in range(repetitions):
+            channel["frequency"] += 1  # empty patches aren't published
+            scope["send_status_update"](full=full)
+        elapsed = time.perf_counter() - start
+        assert counter.messages == repetitions, f"{counter.messages} of {repetitions} status updates were published"
+        results[f"status_update.{label}.calls_per_s"] = repetitions / elapsed
+        results[f"status_update.{label}.bytes_per_call"] = counter.bytes / repetitions
+    return results
+
+
+def benchmark_snapshots(host, repetitions):
+    results = {}
+    for device_id in ["smaract", "elliptec", "pressure", "tweezerPolarization"]:
+        device = host.devices[device_id]
+        # cached: the state didn't change since the last call
+        results.update(prefixed(f"get_state.{device_id}", time_calls(device.get_state, repetitions)))
+        results.update(prefixed(f"get_state_uncached.{device_id}", time_calls(lambda: (device.scope["_mark_state_changed"](), device.get_state()), repetitions)))
+        results.update(prefixed(f"on_save_snapshot.{device_id}", time_calls(device.on_save_snapshot, repetitions)))
+    results["get_full_state.bytes"] = len(json.dumps(host.get_full_state()).encode())
+    return results
+
+
+def benchmark_main_loop(host, counter, duration):
+    # DemoSmaract's main() publishes at 10 Hz; measures the traffic it produces.
+    counter.reset("smaract")
+    time.sleep(duration)
+    return {
+        "main_loop.smaract.messages_per_s": counter.messages / duration,
+        "main_loop.smaract.bytes_per_message": counter.bytes / max(counter.messages, 1),
+    }
+
+
+def run(repetitions, duration):
+    host = DeviceHost()
+    counter = MessageCounter()
+    host.subscribe_to_state_updates(counter)
+    host.register_device("cavity_detuning", os.path.join(DEVICES_DIR, "DemoRFGen.py"))
+    host.register_device("elliptec", os.path.join(DEVICES_DIR, "DemoElliptec.py"))
+    host.register_device("smaract", os.path.join(DEVICES_DIR, "DemoSmaract.py"), max_status_update_rate=10)
+    host.register_device("pressure", os.path.join(DEVICES_DIR, "DemoPressureSensor.py"))
+    host.register_device("tweezerPolarization", os.path.join(DEVICES_DIR, "DemoPolarimeter.py"))
+    time.sleep(0.2)  # let DemoSmaract's main() create its channels
+
+    results = {}
+    try:
+        results.update(benchmark_main_loop(host, counter, duration))
+        results.update(benchmark_actions(host, repetitions))
+        results.update(benchmark_status_updates(host, counter, repetitions))
+        results.update(benchmark_snapshots(host, repetitions))
+    finally:
+        host.dispose()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, value in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        change = value / reference - 1
+        if name.endswith(HIGHER_IS_BETTER):
+            change = -change
+        if change > tolerance:
+            regressions.append((name, reference, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the Python device bridge.")
+    parser.add_argument("--repetitions", type=int, default=2000)
+    parser.add_argument("--duration", type=float, default=2, help="seconds to observe the main() loops")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change counted as regression")
+    args = parser.parse_args()
+
+    results = run(args.repetitions, args.duration)
+    width = max(len(name) for name in results)
+    for name, value in results.items():
+        print(f"{name:<{width}}  {value:12.2f}")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for name, reference, value, change in regressions:
+            print(f"REGRESSION {name}: {reference:.2f} -> {value:.2f} ({change:+.0%})")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+# The asyncio event loop shared by all Python devices. It runs on a single
+# thread, which is started on first use; `async def main()` and `async def`
+# actions of all devices are executed on it.
+import asyncio
+import threading
+
+_loop = None
+_loop_thread = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    global _loop, _loop_thread
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="device_loop", daemon=True)
+            _loop_thread.start()
+        return _loop
+
+
+def submit(coroutine):
+    """Schedules `coroutine` on the shared loop and returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop())
+
+
+def run(coroutine):
+    """Runs `coroutine` on the shared loop and blocks until it has finished."""
+    if threading.current_thread() is _loop_thread:
+        coroutine.close()
+        raise RuntimeError("Blocking on the device loop from within the loop would dead-lock; use the *_async bridge functions instead.")
+    return submit(coroutine).result()
+
+
+class Periodic:
+    """Drift-free periodic timer: `async for tick in Periodic(0.1): ...`
+
+    Ticks lie on a fixed grid, so the time spent in the loop body doesn't add up.
+    If the body overruns the interval, the next tick happens immediately and
+    ticks lying completely in the past are skipped; each overrun is reported via
+    `on_overrun(skipped_ticks, lateness)`.
+    """
+
+    def __init__(self, interval, on_overrun=None):
+        self.interval = interval
+        self.on_overrun = on_overrun
+        self.ticks = 0
+        self.overruns = 0
+        self.max_lateness = 0.0
+        self._deadline = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        now = asyncio.get_running_loop().time()
+        if self._deadline is None:
+            self._deadline = now
+        else:
+            self._deadline += self.interval
+            lateness = now - self._deadline
+            if lateness > 0:
+                skipped = int(lateness // self.interval)
+                self._deadline += skipped * self.interval
+                self.overruns += 1
+                self.max_lateness = max(self.max_lateness, lateness)
+                if self.on_overrun is not None:
+                    self.on_overrun(skipped, lateness)
+            else:
+                await asyncio.sleep(-lateness)
+        self.ticks += 1
+        return self.ticks
@@ -0,0 +1,411 @@
+# Pure-Python stand-in for PythonDevice.cs and DeviceManager.cs.
+#
+# It injects the same globals into the device scripts as the .NET server does
+# (`state`, `argv`, `is_running`, `send_status_update`, `get_device_state`,
+# `action`, `request`, `print`, ...) by executing the very same prelude, so
+# device scripts can be run, profiled and benchmarked without pythonnet:
+#
+#   python PythonBridge/host.py Devices/DemoSmaract.py --duration 5
+import argparse
+import collections
+import inspect
+import itertools
+import json
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+import traceback
+from types import SimpleNamespace
+
+BRIDGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PRELUDE_FILENAME = os.path.join(BRIDGE_DIRECTORY, "prelude.py")
+if BRIDGE_DIRECTORY not in sys.path:
+    sys.path.insert(0, BRIDGE_DIRECTORY)
+
+
+# compiled code objects by path, shared by all devices running the same script
+_compiled_scripts = {}
+_compiled_scripts_lock = threading.Lock()
+
+
+def compile_script(filename):
+    path = os.path.abspath(filename)
+    modified = os.path.getmtime(path)
+    with _compiled_scripts_lock:
+        cached = _compiled_scripts.get(path)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+    with open(path) as file:
+        code = compile(file.read(), path, "exec")
+    with _compiled_scripts_lock:
+        _compiled_scripts[path] = (modified, code)
+    return code
+
+
+def to_argv(value):
+    # pythonnet exposes the anonymous .NET argument objects with attribute access
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: to_argv(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return [to_argv(item) for item in value]
+    return value
+
+
+def to_request_result(value):
+    # like PythonDevice.cs, arrays are passed on as they are and everything else as JSON
+    return value if hasattr(value, "__array_interface__") else json.dumps(value)
+
+
+class HostedDevice:
+    def __init__(self, host, device_id, filename, arguments=None, max_status_update_rate=0):
+        self.host = host
+        self.device_id = device_id
+        self.filename = filename
+        self.method_cache = {}
+        self.main_thread = None
+        self.subscribed_devices = set()
+        self.device_state_updates = None
+        self.device_state_sequence = itertools.count(1)
+        self.last_device_state_sequence = 0
+        self._subscription_lock = threading.Lock()
+        # like PythonDevice.cs, the serialized state is reused until the script changes it
+        self.state_version = 0
+        # re-serializes the state on every call to report changes without send_status_update
+        self.check_state_cache = host.check_state_cache
+        self._state_snapshot = None
+        self.scope = scope = {"__name__": f"device_{device_id}", "__builtins__": __builtins__}
+        scope["_send_status_update"] = self._send_status_update
+        scope["_send_status_patch"] = self._send_status_patch
+        scope["_get_device_state"] = lambda device_name: host.devices[device_name].get_serialized_state()
+        scope["action"] = lambda device_id, channel_id, action_name, parameters: host.action(
+            device_id, channel_id, action_name, parameters
+        )
+        scope["_action_batch"] = lambda serialized_actions, atomic, best_effort: host.action_batch(json.loads(serialized_actions), atomic, best_effort)
+        scope["_request"] = lambda device_id, channel_id, action_name, parameters: to_request_result(
+            host.request(device_id, channel_id, action_name, parameters)
+        )
+        scope["_send_stream_data"] = lambda array, serialized_meta: host.on_stream_data(device_id, array.copy(), json.loads(serialized_meta))
+        scope["_subscribe_device_state"] = self._subscribe_device_state
+        scope["_device_state_sequence"] = lambda: self.last_device_state_sequence
+        scope["_mark_state_changed"] = self._mark_state_changed
+        scope["_record_loop_iteration"] = lambda: host.on_loop_iteration(device_id)
+        scope["print"] = lambda text: print(f"[{device_id}] {text}")
+        scope["is_running"] = True
+        # like PythonDevice.cs, the startup time is broken down in seconds
+        start = time.perf_counter()
+        exec(compile_script(PRELUDE_FILENAME), scope)
+        prelude_done = time.perf_counter()
+        scope["max_status_update_rate"] = max_status_update_rate
+        if arguments is not None:
+            scope["argv"] = to_argv(arguments)
+
+        import_seconds = scope["_exec_script"](compile_script(filename))
+        exec_done = time.perf_counter()
+
+        for name, value in scope["_list_functions"]():
+            self.method_cache[name.lower()] = value
+        scope["_monitor_main_loop"]()
+        self.startup_profile = {
+            "prelude": prelude_done - start,
+            "imports": import_seconds,
+            "exec": exec_done - prelude_done - import_seconds,
+            "methodDiscovery": time.perf_counter() - exec_done,
+        }
+
+        main = self.method_cache.get("main")
+        if main is not None and inspect.iscoroutinefunction(main):
+            scope["_start_async_main"](self._on_async_main_error)
+        elif main is not None:
+            self.main_thread = threading.Thread(target=self._run_main, name=f"{device_id}.main", daemon=True)
+            self.main_thread.start()
+
+    def _run_main(self):
+        try:
+            self.method_cache["main"]()
+        except Exception:
+            print(f"PythonDevice error ({self.device_id}):\n{traceback.format_exc()}")
+            self.dispose()
+
+    def _on_async_main_error(self, error):
+        print(f"PythonDevice error ({self.device_id}): {error}")
+        threading.Thread(target=self.dispose, daemon=True).start()
+
+    def _send_status_update(self, serialized_partial_state):
+        self.host.on_state_update(self.device_id, "PartialStateUpdate", serialized_partial_state)
+
+    def _send_status_patch(self, serialized_patches):
+        self.host.on_state_update(self.device_id, "StatePatch", serialized_patches)
+
+    def _subscribe_device_state(self, device_name):
+        if device_name not in self.host.devices:
+            raise KeyError(f"Device {device_name} doesn't exist.")
+        with self._subscription_lock:
+            self.subscribed_devices.add(device_name)
+            if self.device_state_updates is not None:
+                return
+            self.device_state_updates = queue.SimpleQueue()
+        self.host.subscribe_to_state_updates(self._forward_device_state)
+        threading.Thread(target=self._dispatch_device_states, name=f"{self.device_id}.dispatch", daemon=True).start()
+
+    def _forward_device_state(self, device_id, method, serialized_payload):
+        with self._subscription_lock:
+            if device_id not in self.subscribed_devices:
+                return
+            self.last_device_state_sequence = next(self.device_state_sequence)
+            self.device_state_updates.put((device_id, method, serialized_payload, self.last_device_state_sequence))
+
+    def _dispatch_device_states(self):
+        dispatch = self.scope["_dispatch_device_state_update"]
+        while True:
+            update = self.device_state_updates.get()
+            if update is None:
+                return
+            dispatch(*update)
+
+    def _mark_state_changed(self):
+        self.state_version += 1
+
+    def _get_state_snapshot(self):
+        version = self.state_version
+        snapshot = self._state_snapshot
+        if snapshot is None or snapshot[0] != version:
+            serialized_state = self.method_cache["_get_state"]()
+            snapshot = self._state_snapshot = (version, serialized_state, json.loads(serialized_state))
+        elif self.check_state_cache:
+            serialized_state = self.method_cache["_get_state"]()
+            if serialized_state != snapshot[1]:
+                print(f"[{self.device_id}] state changed without send_status_update, the server would hand out the stale state")
+                snapshot = self._state_snapshot = (version, serialized_state, json.loads(serialized_state))
+        return snapshot
+
+    def get_serialized_state(self):
+        return self._get_state_snapshot()[1]
+
+    def get_state(self):
+        return self._get_state_snapshot()[2]
+
+    def handle_action(self, action_name, parameters):
+        action_name = action_name.lower()
+        if action_name == "getstate":
+            return self.get_state()
+        method = self.method_cache.get(action_name)
+        if method is None:
+            raise KeyError(f"Action method {action_name} not found.")
+        try:
+            return self.scope["_await_result"](method(*(parameters or [])))
+        finally:
+            self._mark_state_changed()
+
+    def start_recording(self, open_stream, write_block):
+        """Calls the script's `on_record`; returns False if it doesn't record anything."""
+        if "on_record" not in self.method_cache:
+            return False
+        self.scope["_start_recording"](open_stream, write_block)
+        return True
+
+    def stop_recording(self):
+        self.scope["_stop_recording"]()
+
+    def on_save_snapshot(self):
+        method_name = "_on_save_snapshot" if "on_save_snapshot" in self.method_cache else "_get_state"
+        return json.loads(self.method_cache[method_name]())
+
+    def dispose(self, timeout=1):
+        if self.device_state_updates is not None:
+            self.device_state_updates.put(None)
+        self.scope["_dispose"]()
+        if self.main_thread is not None and self.main_thread is not threading.current_thread():
+            self.main_thread.join(timeout)
+
+
+class HostRecording:
+    # Mirrors DeviceManager.Record: the streams of the devices are saved as
+    # `<directory>/<device id>_<name>.npy` once the recording stops.
+    def __init__(self, host, directory):
+        self.host = host
+        self.directory = directory
+        self.streams = []
+        self.recording_devices = []
+        self._lock = threading.Lock()
+
+    def open_stream(self, device_id, name, dtype):
+        with self._lock:
+            self.streams.append((os.path.join(self.directory, f"{device_id}_{name}.npy"), dtype, []))
+            return len(self.streams) - 1
+
+    def write_block(self, handle, array):
+        self.streams[handle][2].append(array.copy())
+
+    def stop(self):
+        import numpy
+
+        for device in self.recording_devices:
+            device.stop_recording()
+        os.makedirs(self.directory, exist_ok=True)
+        for path, dtype, blocks in self.streams:
+            numpy.save(path, numpy.concatenate(blocks) if blocks else numpy.empty(0, dtype=dtype))
+        return [path for path, _, _ in self.streams]
+
+
+class DeviceHost:
+    # Mirrors DeviceManager: a delay of MaxUpdateDelay after actions, the full
+    # state of the affected devices gets published.
+    max_update_delay = 0.05
+
+    def __init__(self, check_state_cache=False):
+        self.check_state_cache = check_state_cache
+        self.devices = {}
+        self.state_listeners = []
+        self.stream_listeners = []
+        # timestamps of the latest iterations of the devices' main loops
+        self.loop_iterations = collections.defaultdict(lambda: collections.deque(maxlen=1000))
+        self._update_queue = set()
+        self._update_timer = None
+        self._lock = threading.Lock()
+
+    def register_device(self, device_id, filename, arguments=None, max_status_update_rate=0):
+        device = HostedDevice(self, device_id, filename, arguments, max_status_update_rate)
+        self.devices[device_id] = device
+        return device
+
+    def subscribe_to_state_updates(self, listener):
+        """`listener(device_id, method, serialized_payload)` for every message sent to the clients."""
+        self.state_listeners.append(listener)
+
+    def on_state_update(self, device_id, method, serialized_payload):
+        for listener in self.state_listeners:
+            listener(device_id, method, serialized_payload)
+
+    def subscribe_to_stream_data(self, listener):
+        """`listener(device_id, array, meta)` for every frame sent with `send_stream_data`."""
+        self.stream_listeners.append(listener)
+
+    def on_stream_data(self, device_id, array, meta):
+        for listener in self.stream_listeners:
+            listener(device_id, array, meta)
+
+    def on_loop_iteration(self, device_id):
+        self.loop_iterations[device_id].append(time.perf_counter())
+
+    def get_loop_timing(self, device_id):
+        """Mean period and standard deviation of the device's main loop in seconds, or None."""
+        iterations = self.loop_iterations[device_id]
+        periods = [b - a for a, b in zip(iterations, itertools.islice(iterations, 1, None))]
+        return (statistics.fmean(periods), statistics.pstdev(periods)) if periods else None
+
+    def action(self, device_id, channel_id, action_name, parameters):
+        self.devices[device_id].handle_action(action_name, parameters)
+        self.queue_update({device_id})
+
+    def queue_update(self, device_ids):
+        with self._lock:
+            self._update_queue.update(device_ids)
+            if self._update_timer is None:
+                self._update_timer = threading.Timer(self.max_update_delay, self.update_devices)
+                self._update_timer.daemon = True
+                self._update_timer.start()
+
+    def action_batch(self, actions, atomic=False, best_effort=False):
+        if atomic and best_effort:
+            raise ValueError("A batch can't be both atomic and best-effort")
+        completed = []
+        errors = []
+        try:
+            for entry in actions:
+                try:
+                    self.devices[entry[0]].handle_action(entry[2], entry[3])
+                except Exception as e:
+                    if not best_effort:
+                        raise
+                    errors.append(e)
+                    continue
+                completed.append(entry)
+            if errors:
+                raise ExceptionGroup(f"{len(errors)} of {len(actions)} batched actions failed", errors)
+        except Exception:
+            if atomic:
+                for entry in reversed(completed):
+                    undo = entry[4] if len(entry) > 4 else None
+                    if undo is None:
+                        continue
+                    try:
+                        self.devices[undo[0]].handle_action(undo[2], undo[3])
+                    except Exception as e:
+                        print(f"Error reverting {entry[0]}.{entry[2]}: {e}")
+            raise
+        finally:
+            self.queue_update({entry[0] for entry in actions})
+
+    def request(self, device_id, channel_id, action_name, parameters):
+        return self.devices[device_id].handle_action(action_name, parameters)
+
+    def update_devices(self):
+        with self._lock:
+            self._update_timer = None
+            device_ids, self._update_queue = self._update_queue, set()
+        for device_id in device_ids:
+            device = self.devices.get(device_id)
+            # disposed meanwhile
+            if device is not None:
+                self.on_state_update(device_id, "PartialStateUpdate", json.dumps(device.get_state()))
+
+    def record(self, directory):
+        """Starts a recording of all devices; `stop()` the returned recording to save it."""
+        recording = HostRecording(self, directory)
+        for device_id, device in self.devices.items():
+            open_stream = lambda name, dtype, device_id=device_id: recording.open_stream(device_id, name, dtype)
+            if device.start_recording(open_stream, recording.write_block):
+                recording.recording_devices.append(device)
+        return recording
+
+    def get_full_state(self):
+        return {device_id: device.get_state() for device_id, device in self.devices.items()}
+
+    def dispose(self):
+        with self._lock:
+            if self._update_timer is not None:
+                self._update_timer.cancel()
+                self._update_timer = None
+            self._update_queue.clear()
+        for device in self.devices.values():
+            device.dispose()
+        self.devices.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a device script outside of the .NET server.")
+    parser.add_argument("script")
+    parser.add_argument("--device-id", default="device")
+    parser.add_argument("--argv", type=json.loads, default=None, help="device arguments as JSON")
+    parser.add_argument("--max-status-update-rate", type=float, default=0)
+    parser.add_argument("--duration", type=float, default=5, help="seconds to run main()")
+    parser.add_argument("--quiet", action="store_true", help="don't print the state updates")
+    parser.add_argument("--record", metavar="DIRECTORY", help="record the run into DIRECTORY")
+    parser.add_argument("--check-state-cache", action="store_true", help="report changes of the state without send_status_update")
+    args = parser.parse_args()
+
+    host = DeviceHost(args.check_state_cache)
+    if not args.quiet:
+        host.subscribe_to_state_updates(lambda device_id, method, payload: print(f"{method} {device_id}: {payload}"))
+    device = host.register_device(args.device_id, args.script, args.argv, args.max_status_update_rate)
+    print("Startup: " + ", ".join(f"{phase} {seconds * 1e3:.1f} ms" for phase, seconds in device.startup_profile.items()))
+    recording = host.record(args.record) if args.record else None
+    try:
+        time.sleep(args.duration)
+    except KeyboardInterrupt:
+        pass
+    if recording is not None:
+        for path in recording.stop():
+            print(f"Recorded {path}")
+    loop_timing = host.get_loop_timing(args.device_id)
+    if loop_timing is not None:
+        print(f"Main loop: period {loop_timing[0] * 1e3:.1f} ms, jitter {loop_timing[1] * 1e3:.1f} ms")
+    print(json.dumps(host.get_full_state(), indent=2))
+    host.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
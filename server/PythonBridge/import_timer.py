@@ -0,0 +1,40 @@
+"""Measures the time a thread spends importing modules.
+
+Used for the startup profile of the Python devices, which are created on
+several threads at once; imports of other threads aren't counted.
+"""
+import builtins
+import threading
+import time
+
+_original_import = builtins.__import__
+_local = threading.local()
+
+
+def _timed_import(*args, **kwargs):
+    seconds = getattr(_local, "seconds", None)
+    if seconds is None or _local.importing:
+        return _original_import(*args, **kwargs)
+    # only the outermost import is timed, it includes the nested ones
+    _local.importing = True
+    start = time.perf_counter()
+    try:
+        return _original_import(*args, **kwargs)
+    finally:
+        _local.importing = False
+        _local.seconds += time.perf_counter() - start
+
+
+def run(function, *args):
+    """Calls `function(*args)` and returns the seconds spent in imports meanwhile."""
+    _local.seconds = 0.0
+    _local.importing = False
+    try:
+        function(*args)
+        return _local.seconds
+    finally:
+        _local.seconds = None
+
+
+if builtins.__import__ is _original_import:
+    builtins.__import__ = _timed_import
@@ -0,0 +1,70 @@
+"""Reports the iterations of the outermost loop of the devices' `main()`.
+
+Uses `sys.monitoring` (Python 3.12+): only the backward jumps of the
+monitored code objects raise events, and those of inner loops get disabled
+after their first occurrence, so the overhead is one call per iteration of
+the main loop. The iteration is reported to `_record_loop_iteration` of the
+scope the code runs in, such that devices sharing a script are told apart.
+"""
+import dis
+import sys
+
+_monitoring = getattr(sys, "monitoring", None)
+_tool_id = None
+# code object -> offsets of the backward jumps of its outermost loop
+_loop_jumps = {}
+
+
+def _on_jump(code, instruction_offset, destination_offset):
+    jumps = _loop_jumps.get(code)
+    if jumps is None or instruction_offset not in jumps:
+        return _monitoring.DISABLE
+    record = sys._getframe(1).f_globals.get("_record_loop_iteration")
+    if record is not None:
+        record()
+
+
+def _get_tool_id():
+    global _tool_id
+    if _tool_id is None:
+        for tool_id in (4, 3):
+            if _monitoring.get_tool(tool_id) is None:
+                _monitoring.use_tool_id(tool_id, "LabOrchestra loop monitor")
+                _monitoring.register_callback(tool_id, _monitoring.events.JUMP, _on_jump)
+                _tool_id = tool_id
+                break
+    return _tool_id
+
+
+def monitor(function):
+    """Starts reporting the iterations of `function`'s outermost loop; returns whether that's possible."""
+    if _monitoring is None:
+        return False
+    code = function.__code__
+    instructions = list(dis.get_instructions(code))
+    lines = {instruction.offset: instruction.positions.lineno for instruction in instructions}
+    jumps = [(instruction.argval, instruction.offset) for instruction in instructions if instruction.opname.startswith("JUMP_BACKWARD")]
+    # The exception handlers are placed after the rest of the code, so their
+    # jumps (e.g. a `continue` within `except`) don't tell where a loop ends.
+    handlers_start = min((instruction.offset for instruction in instructions if instruction.opname == "PUSH_EXC_INFO"), default=sys.maxsize)
+    # A loop spans from a head (a target of backward jumps) to its last jump
+    # back. `continue` (also from within `try` or after an inner loop) and the
+    # end of the body might jump to different heads of the same loop (e.g. a
+    # `while` loop repeats its condition at the end of the body), those spans
+    # overlap; the spans of inner loops lie within the span of an outer head.
+    ends = {}
+    for target, source in jumps:
+        if source < handlers_start:
+            ends[target] = max(source, ends.get(target, source))
+    outer_heads = {head for head, end in ends.items() if not any(other_head < head and end < other_end for other_head, other_end in ends.items())}
+    # a `continue` within `except` might jump to the condition of a `while`
+    # loop, which is on the same line as its repeated condition at the end
+    loop_lines = {lines[ends[head]] for head in outer_heads}
+    outer_heads.update(target for target, source in jumps if source >= handlers_start and lines[target] in loop_lines)
+    outer_jumps = frozenset(source for target, source in jumps if target in outer_heads)
+    tool_id = _get_tool_id()
+    if not outer_jumps or tool_id is None:
+        return False
+    _loop_jumps[code] = outer_jumps
+    _monitoring.set_local_events(tool_id, code, _monitoring.events.JUMP)
+    return True
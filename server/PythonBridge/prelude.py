@@ -0,0 +1,535 @@
+# Executed in the scope of every Python device before the device script itself.
+# The host (PythonDevice.cs) injects the underscore-prefixed bridge callables
+# (`_send_status_update`, `_send_status_patch`, `_get_device_state`, `_request`,
+# `_subscribe_device_state`, `_device_state_sequence`, `_mark_state_changed`,
+# `_send_stream_data`) as well as `action`, `print`, `is_running` and `argv`
+# beforehand. Hosts which accept MessagePack encoded states additionally inject
+# `_send_status_update_packed` and `_send_status_patch_packed`. The PythonBridge
+# directory is on `sys.path`, such that the shared modules (e.g. `device_loop`)
+# can be imported.
+import asyncio as _asyncio
+import importlib.util as _importlib_util
+import json as _json
+import sys as _sys
+import threading as _threading
+import time as _time
+import types as _types
+
+import device_loop as _device_loop
+import import_timer as _import_timer
+import loop_monitor as _loop_monitor
+
+try:
+    import msgpack as _msgpack
+except ImportError:
+    _msgpack = None
+
+state = None
+
+# The state is encoded as MessagePack if both sides support it, otherwise as JSON.
+_packed = _msgpack is not None and "_send_status_update_packed" in globals()
+if _packed:
+    _send_status_update = _send_status_update_packed
+    _send_status_patch = _send_status_patch_packed
+
+# Maximal number of published status updates per second (0: unlimited). The
+# host sets this per device; scripts may override it. Updates requested within
+# one window are merged into a single trailing-edge update.
+max_status_update_rate = 0
+
+# Detached copy of the state as it was last published to the clients.
+_published_state = None
+_status_update_lock = _threading.RLock()
+_status_update_timer = None
+_last_status_update = float("-inf")
+_pending_partial_state = {}
+_pending_state_update = None  # None, "diff" or "full"
+
+# Mirrors of the subscribed devices' states, kept up to date by the host
+# calling `_dispatch_device_state_update` for every update of these devices.
+_device_states = {}
+_device_state_versions = {}
+_device_state_callbacks = {}
+_device_state_condition = _threading.Condition()
+_dispatched_sequence = 0
+_dispatch_thread = None
+
+# future of `async def main()`, running on the shared device loop
+_main_future = None
+
+
+def _encode(value):
+    # NumPy scalars and arrays become plain numbers and lists; the JSON is
+    # forwarded to the clients as is, so it must not contain NaN or Infinity
+    if _packed:
+        return _msgpack.packb(value, default=_to_json)
+    return _json.dumps(value, default=_to_json, allow_nan=False)
+
+
+def _copy_state(value):
+    if hasattr(value, "tolist"):
+        # NumPy scalars and arrays, which can't be compared like plain values
+        return value.tolist()
+    if isinstance(value, dict):
+        return {key: _copy_state(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_copy_state(item) for item in value]
+    return value
+
+
+def _diff_state(old, new, path, patches):
+    # Returns a detached copy of `new` and appends a `(path, value)` pair for
+    # every subtree of `new` which differs from `old`.
+    if hasattr(new, "tolist"):
+        new = new.tolist()
+    if isinstance(new, dict):
+        if isinstance(old, dict) and old.keys() <= new.keys():
+            copy = {}
+            for key, value in new.items():
+                if key in old:
+                    copy[key] = _diff_state(old[key], value, path + [key], patches)
+                else:
+                    copy[key] = _copy_state(value)
+                    patches.append((path + [key], copy[key]))
+            return copy
+    elif isinstance(new, (list, tuple)):
+        if isinstance(old, list) and len(old) == len(new):
+            return [
+                _diff_state(old[i], value, path + [i], patches)
+                for i, value in enumerate(new)
+            ]
+    elif type(old) is type(new) and old == new:
+        return new
+    # removed keys, resized lists and changed values replace the whole subtree
+    copy = _copy_state(new)
+    patches.append((path, copy))
+    return copy
+
+
+def _publish_state(full):
+    global _published_state
+    if full or not isinstance(_published_state, dict):
+        _published_state = _copy_state(state)
+        _send_status_update(_encode(_published_state))
+        return
+    patches = []
+    published_state = _diff_state(_published_state, state, [], patches)
+    _published_state = published_state
+    if not patches:
+        return
+    if not patches[-1][0]:
+        # the root got replaced (e.g. a top-level key was removed)
+        _send_status_update(_encode(published_state))
+    else:
+        _send_status_patch(_encode(patches))
+
+
+def _publish_pending_status_update():
+    global _pending_partial_state, _pending_state_update, _last_status_update
+    partial_state, _pending_partial_state = _pending_partial_state, {}
+    state_update, _pending_state_update = _pending_state_update, None
+    _last_status_update = _time.monotonic()
+    if partial_state:
+        _send_status_update(_encode(partial_state))
+        if _published_state is not None:
+            for key, value in partial_state.items():
+                _published_state[key] = _copy_state(value)
+    if state_update is not None:
+        _publish_state(state_update == "full")
+
+
+def _on_status_update_timer():
+    global _status_update_timer
+    with _status_update_lock:
+        if _status_update_timer is not _threading.current_thread():
+            return  # cancelled in favour of a flush
+        _status_update_timer = None
+        if is_running:
+            _publish_pending_status_update()
+
+
+def send_status_update(partial_state=None, full=False, flush=False):
+    """Publishes the changes of `state` (or just `partial_state`) to the clients.
+
+    `full` sends the whole state instead of a patch, `flush` bypasses the rate
+    limit for latency-critical updates. The host reuses the serialized `state`
+    until this is called (or an action ran), so changes which aren't published
+    this way aren't seen by `GetState` either.
+    """
+    global _pending_state_update, _status_update_timer
+    # invalidates the host's cached snapshot of the state, also if rate limited
+    _mark_state_changed()
+    with _status_update_lock:
+        if partial_state:
+            _pending_partial_state.update(partial_state)
+        elif full:
+            _pending_state_update = "full"
+        elif _pending_state_update is None:
+            _pending_state_update = "diff"
+
+        if _status_update_timer is not None:
+            if not flush:
+                return
+            _status_update_timer.cancel()
+            _status_update_timer = None
+        min_interval = 1 / max_status_update_rate if max_status_update_rate > 0 else 0
+        wait = _last_status_update + min_interval - _time.monotonic()
+        if flush or wait <= 0:
+            _publish_pending_status_update()
+        else:
+            _status_update_timer = _threading.Timer(wait, _on_status_update_timer)
+            _status_update_timer.daemon = True
+            _status_update_timer.start()
+
+
+def send_stream_data(array, meta=None):
+    """Streams `array` (samples, or channels x samples) as binary float32 data to the StreamingHub.
+
+    `meta` may contain the x range of the samples as `xMin` and `xMax` (default:
+    the sample indices) plus anything else the clients need. Each connection
+    receives the channels and x range selected by its stream customization,
+    decimated to at most `maxSamples` (2000) points.
+    """
+    import numpy
+
+    array = numpy.ascontiguousarray(array, dtype=numpy.float32)
+    if array.ndim == 1:
+        array = array[numpy.newaxis]
+    _send_stream_data(array, _json.dumps(meta or {}, default=_to_json))
+
+
+class RecordingStream:
+    """Appends samples to `<device id>_<name>.npy` of the running recording.
+
+    Obtained from the `get_stream` passed to `on_record(get_stream)`, which a
+    script defines to take part in recordings. Samples are collected in blocks
+    of `block_size` and handed to the host as a whole, which writes them to
+    disk in the background. Writes after the recording stopped are ignored.
+    """
+
+    def __init__(self, handle, write_block, dtype, block_size):
+        import numpy
+
+        self._numpy = numpy
+        self._handle = handle
+        self._write_block = write_block
+        self._buffer = numpy.empty(block_size, dtype=dtype)
+        self._fill = 0
+        self._lock = _threading.Lock()
+        self.is_open = True
+
+    def write(self, samples):
+        """Appends a single sample or an array of them; returns False once the recording stopped."""
+        samples = self._numpy.asarray(samples, dtype=self._buffer.dtype).ravel()
+        with self._lock:
+            if not self.is_open:
+                return False
+            if self._fill == 0 and len(samples) >= len(self._buffer):
+                # large chunks don't need to go through the buffer
+                self._write_block(self._handle, self._numpy.ascontiguousarray(samples))
+                return True
+            while len(samples):
+                count = min(len(samples), len(self._buffer) - self._fill)
+                self._buffer[self._fill:self._fill + count] = samples[:count]
+                self._fill += count
+                samples = samples[count:]
+                if self._fill == len(self._buffer):
+                    self._flush()
+        return True
+
+    def _flush(self):
+        if self._fill:
+            self._write_block(self._handle, self._buffer[:self._fill])
+            self._fill = 0
+
+    def close(self):
+        with self._lock:
+            if self.is_open:
+                self._flush()
+                self.is_open = False
+
+
+_recording_streams = []
+_recording_generation = 0
+
+
+def _start_recording(open_stream, write_block):
+    # called by the host when a recording starts, if the script defines `on_record`
+    generation = _recording_generation
+
+    def get_stream(name, dtype="float64", block_size=65536):
+        if generation != _recording_generation:
+            raise RuntimeError("The recording has already stopped")
+        stream = RecordingStream(open_stream(name, dtype), write_block, dtype, block_size)
+        _recording_streams.append(stream)
+        return stream
+
+    on_record(get_stream)
+
+
+def _stop_recording():
+    global _recording_generation
+    _recording_generation += 1
+    while _recording_streams:
+        _recording_streams.pop().close()
+
+
+def _set_in(target, path, value):
+    # copy-on-write, such that previously handed out states stay untouched
+    if not path:
+        return value
+    key = path[0]
+    if isinstance(target, list):
+        copy = list(target)
+        copy[key] = _set_in(copy[key], path[1:], value)
+    else:
+        copy = dict(target) if isinstance(target, dict) else {}
+        copy[str(key)] = _set_in(copy.get(str(key)), path[1:], value)
+    return copy
+
+
+def _dispatch_device_state_update(device_name, method, payload, sequence):
+    global _dispatched_sequence, _dispatch_thread
+    _dispatch_thread = _threading.get_ident()
+    update = _json.loads(payload)
+    with _device_state_condition:
+        _dispatched_sequence = max(_dispatched_sequence, sequence)
+        device_state = _device_states.get(device_name)
+        # a device which was still initializing when subscribing starts with its full state
+        if device_state is not None or (device_name in _device_states and method != "StatePatch"):
+            if method == "StatePatch":
+                for path, value in update:
+                    device_state = _set_in(device_state, path, value)
+            else:
+                device_state = {**(device_state or {}), **update}
+            _device_states[device_name] = device_state
+            _device_state_versions[device_name] += 1
+            callbacks = list(_device_state_callbacks[device_name])
+        else:
+            callbacks = []
+        _device_state_condition.notify_all()
+    for callback in callbacks:
+        try:
+            callback(device_state)
+        except Exception as e:
+            print(f"Error in state callback for {device_name}: {e}")
+
+
+def _sync_device_states():
+    # Waits until all updates sent before this call have been dispatched,
+    # such that the effects of the device's own actions are visible.
+    if _dispatch_thread == _threading.get_ident():
+        return
+    sequence = _device_state_sequence()
+    _device_state_condition.wait_for(lambda: _dispatched_sequence >= sequence or not is_running)
+
+
+def subscribe_device_state(device_name, callback=None):
+    """Mirrors the state of another device, calling `callback(state)` after each of its updates.
+
+    Returns a function which removes the callback again.
+    """
+    with _device_state_condition:
+        if device_name not in _device_states:
+            _device_state_callbacks[device_name] = []
+            _device_state_versions[device_name] = 0
+            _subscribe_device_state(device_name)
+            try:
+                _device_states[device_name] = get_device_state(device_name)
+            except Exception:
+                # still initializing; its state arrives with its first update
+                _device_states[device_name] = None
+        if callback is not None:
+            _device_state_callbacks[device_name].append(callback)
+
+    def unsubscribe():
+        with _device_state_condition:
+            if callback in _device_state_callbacks[device_name]:
+                _device_state_callbacks[device_name].remove(callback)
+
+    return unsubscribe
+
+
+def wait_for_state(device_name, predicate=None, timeout=None):
+    """Waits until the state of `device_name` satisfies `predicate(state)`.
+
+    Without predicate, this waits for the next update of the device. Returns the
+    state, or None if the timeout elapsed or the device got disposed.
+    """
+    subscribe_device_state(device_name)
+    with _device_state_condition:
+        _sync_device_states()
+        version = _device_state_versions[device_name]
+        if predicate is None:
+            condition = lambda: _device_state_versions[device_name] != version
+        else:
+            condition = lambda: _device_states[device_name] is not None and predicate(_device_states[device_name])
+        if _device_state_condition.wait_for(lambda: not is_running or condition(), timeout) and is_running:
+            return _device_states[device_name]
+        return None
+
+
+def _start_async_main(on_error):
+    global _main_future
+
+    def on_done(future):
+        if not future.cancelled() and future.exception() is not None:
+            on_error(repr(future.exception()))
+
+    _main_future = _device_loop.submit(main())
+    _main_future.add_done_callback(on_done)
+
+
+def _await_result(value):
+    # actions defined as `async def` are run on the shared device loop
+    return _device_loop.run(value) if _asyncio.iscoroutine(value) else value
+
+
+def _to_json(value):
+    # NumPy arrays and scalars, everything else is represented by its string
+    return value.tolist() if hasattr(value, "tolist") else str(value)
+
+
+def lazy_import(name):
+    """Returns the module `name`, which is only loaded on its first attribute access.
+
+    For heavy modules which are rarely used, such that they don't slow down the
+    creation of the device.
+    """
+    module = _sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = _importlib_util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = _importlib_util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = _importlib_util.module_from_spec(spec)
+    _sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def _exec_script(code):
+    # runs the compiled device script in this scope; returns the seconds spent in imports
+    return _import_timer.run(exec, code, globals())
+
+
+def _monitor_main_loop():
+    # reports the iterations of main()'s loop to the host's `_record_loop_iteration`
+    main = globals().get("main")
+    return main is not None and _loop_monitor.monitor(main)
+
+
+def _list_functions():
+    # the functions of the scope (including the prelude's) for the host's method cache;
+    # compares the exact type, as isinstance() would load lazily imported modules
+    return [(name, value) for name, value in globals().items() if type(value) is _types.FunctionType]
+
+
+def _action_result(value):
+    # action results are handed over as JSON, such that they can be sent to the clients
+    value = _await_result(value)
+    return None if value is None else _json.dumps(value, default=_to_json)
+
+
+async def _run_blocking(function, *args, **kwargs):
+    return await _asyncio.get_running_loop().run_in_executor(None, lambda: function(*args, **kwargs))
+
+
+async def get_device_state_async(device_name):
+    return await _run_blocking(get_device_state, device_name)
+
+
+async def action_async(device_id, channel_id, action_name, parameters):
+    return await _run_blocking(action, device_id, channel_id, action_name, parameters)
+
+
+async def action_batch_async(actions, atomic=False, best_effort=False):
+    return await _run_blocking(action_batch, actions, atomic, best_effort)
+
+
+async def request_async(device_id, channel_id, action_name, parameters):
+    return await _run_blocking(request, device_id, channel_id, action_name, parameters)
+
+
+async def send_status_update_async(partial_state=None, full=False, flush=False):
+    # publishing never blocks for long, so it's done right on the loop
+    send_status_update(partial_state, full, flush)
+
+
+async def wait_for_state_async(device_name, predicate=None, timeout=None):
+    return await _run_blocking(wait_for_state, device_name, predicate, timeout)
+
+
+def periodic(interval):
+    """Drift-free replacement for `while is_running: ...; await asyncio.sleep(interval)`:
+
+        async for _ in periodic(0.1):
+            ...
+
+    Stops once the device gets disposed; overruns of the interval are reported.
+    """
+
+    def on_overrun(skipped_ticks, lateness):
+        print(f"periodic({interval}): overrun by {lateness * 1e3:.1f} ms, skipped {skipped_ticks} ticks")
+
+    async def ticks():
+        async for tick in _device_loop.Periodic(interval, on_overrun):
+            if not is_running:
+                return
+            yield tick
+
+    return ticks()
+
+
+def _dispose():
+    global is_running
+    is_running = False
+    if _main_future is not None:
+        _main_future.cancel()
+    with _status_update_lock:
+        if _status_update_timer is not None:
+            _status_update_timer.cancel()
+    with _device_state_condition:
+        _device_state_condition.notify_all()
+    _stop_recording()
+
+
+def _get_state():
+    return _encode(state)
+
+
+def _on_save_snapshot():
+    return _json.dumps(on_save_snapshot(), default=_to_json)
+
+
+def get_device_state(device_name):
+    return _json.loads(_get_device_state(device_name))
+
+
+def action_batch(actions, atomic=False, best_effort=False):
+    """Runs several actions with a single call, the affected devices publish their states once afterwards.
+
+    Each action is `(device_id, channel_id, action_name, parameters)`, optionally
+    followed by the action undoing it (of the same form). The first failing
+    action ends the batch; with `atomic`, the preceding actions are undone
+    (in reverse order) before the error is raised. With `best_effort`, as
+    needed for cleanups, all actions run and their errors are raised together
+    afterwards.
+    """
+    _action_batch(_json.dumps([list(entry) for entry in actions], default=_to_json), atomic, best_effort)
+
+
+def request(device_id, channel_id, action_name, parameters):
+    result = _request(device_id, channel_id, action_name, parameters)
+    # numeric arrays arrive as NumPy arrays, everything else as JSON
+    return _json.loads(result) if isinstance(result, str) else result
+
+
+def _get_settings():
+    return _json.dumps(get_settings(), default=_to_json)
+
+
+def _load_settings(settings):
+    load_settings(_json.loads(settings))
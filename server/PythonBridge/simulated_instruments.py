@@ -0,0 +1,331 @@
+# Simulated instruments, which let the device scripts run without hardware
+# (e.g. in the standalone host). Device scripts use them when their arguments
+# contain `simulate = true`.
+import math
+import os
+import queue
+import random
+import threading
+import time
+import tty
+
+
+class SimulatedPAX1000:
+    """Thorlabs PAX1000 polarimeter with a rotating waveplate at `revolutions_per_second`.
+
+    Answers `SENS:DATA:LAT?` with the latest revolution like the instrument does:
+    the same record is returned until the next revolution has been measured.
+    The polarization slowly drifts and each revolution adds a bit of noise.
+    """
+
+    def __init__(self, revolutions_per_second=60, query_latency=0.002):
+        self.revolutions_per_second = revolutions_per_second
+        self.query_latency = query_latency
+        self.start = time.perf_counter()
+        self.is_rotating = False
+
+    def record(self, revs):
+        t = revs / self.revolutions_per_second
+        noise = random.Random(revs)
+        theta = 0.3 * math.sin(2 * math.pi * 0.05 * t) + noise.gauss(0, 2e-3)
+        eta = 0.1 + 0.05 * math.sin(2 * math.pi * 0.2 * t) + noise.gauss(0, 2e-3)
+        values = [revs, int(t * 1e3), 5, 0, 6, 5856, 29712, 1 / self.revolutions_per_second, 1.38085, theta, eta, 0.99, 1e-4]
+        return ",".join(f"{value:e}" if isinstance(value, float) else str(value) for value in values) + "\n"
+
+    def query(self, command):
+        time.sleep(self.query_latency)
+        if command == "*IDN?":
+            return "THORLABS,PAX1000IR2/M,M00000000,1.2.3\n"
+        if command == "SENS:DATA:LAT?":
+            if not self.is_rotating:
+                return self.record(0)
+            return self.record(int((time.perf_counter() - self.start) * self.revolutions_per_second))
+        raise ValueError(f"Unsupported query: {command}")
+
+    def write(self, command):
+        if command.startswith("INP:ROT:STAT"):
+            self.is_rotating = command.endswith("ON")
+
+    def close(self):
+        pass
+
+
+class SimulatedResourceManager:
+    """Stand-in for `pyvisa.ResourceManager`."""
+
+    def open_resource(self, resource_name):
+        return SimulatedPAX1000()
+
+
+class SimulatedELLxBus:
+    """Thorlabs ELLx motors (`{address: "rotation" | "linear" | "slider"}`) on a pseudo-terminal.
+
+    `port` can be opened with pyserial (and thus the `elliptec` package) like
+    the real bus. Moves take `move_time` for the full range, the motor replies
+    with its position (`PO`) once it arrived and answers `gs` with busy (`GS09`)
+    in the meantime. With `error_rate`, replies get lost at random.
+    """
+
+    # info replies: motor type, range and pulses per unit (see the ELLx protocol manual)
+    MOTORS = {
+        "rotation": {"type": 14, "range": 360, "pulses": 143360},
+        "linear": {"type": 20, "range": 60, "pulses": 1024},
+        "slider": {"type": 9, "range": 96, "pulses": 1},
+    }
+
+    def __init__(self, motors, move_time=1.0, error_rate=0.0):
+        self.move_time = move_time
+        self.error_rate = error_rate
+        self.random = random.Random(0)
+        # address -> (kind, start position, target position, move start, move end) in pulses
+        self.motors = {address: [kind, 0, 0, 0.0, 0.0] for address, kind in motors.items()}
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self.lock = threading.Lock()
+        threading.Thread(target=self._serve, name="SimulatedELLxBus", daemon=True).start()
+
+    def _full_scale(self, kind):
+        motor = self.MOTORS[kind]
+        return motor["range"] * motor["pulses"] if kind == "linear" else motor["pulses"] if kind == "rotation" else motor["range"]
+
+    def _position(self, motor, now):
+        kind, start, target, t_start, t_end = motor
+        if now >= t_end:
+            return target
+        return int(start + (target - start) * (now - t_start) / (t_end - t_start))
+
+    def _reply(self, text):
+        if self.error_rate and self.random.random() < self.error_rate:
+            return
+        with self.lock:
+            os.write(self.master, (text + "\r\n").encode())
+
+    def _serve(self):
+        buffer = b""
+        while True:
+            try:
+                buffer += os.read(self.master, 1024)
+            except OSError:
+                return
+            # commands aren't terminated: address, two-letter command and, for moves, 8 hex digits
+            while len(buffer) >= 3:
+                command = buffer[1:3].decode().lower()
+                length = 11 if command in ("ma", "mr") else 3
+                if len(buffer) < length:
+                    break
+                self._handle(buffer[:1].decode(), command, buffer[3:length].decode())
+                buffer = buffer[length:]
+
+    def _handle(self, address, command, argument):
+        motor = self.motors.get(address)
+        if motor is None:
+            return  # nobody listening at this address
+        now = time.monotonic()
+        position = self._position(motor, now)
+        kind = motor[0]
+        if command == "in":
+            info = self.MOTORS[kind]
+            self._reply(f"{address}IN{info['type']:02X}1140000020231501{info['range']:04X}{info['pulses']:08X}")
+        elif command == "gp":
+            self._reply(f"{address}PO{position & 0xFFFFFFFF:08X}")
+        elif command == "gs":
+            self._reply(f"{address}GS{'09' if now < motor[4] else '00'}")
+        elif command in ("ma", "mr"):
+            target = int.from_bytes(bytes.fromhex(argument), "big", signed=True)
+            if command == "mr":
+                target += motor[2]
+            duration = self.move_time * min(1, abs(target - position) / self._full_scale(kind)) + 0.05
+            motor[1:] = [position, target, now, now + duration]
+            threading.Timer(duration, lambda: self._reply(f"{address}PO{target & 0xFFFFFFFF:08X}")).start()
+        else:
+            self._reply(f"{address}GS03")
+
+
+class SimulatedSmarActEvent:
+    # the fields of `smaract.ctl.Event` used by the device scripts
+    def __init__(self, idx, type, i32):
+        self.idx = idx
+        self.type = type
+        self.i32 = i32
+
+
+class SimulatedSmarActCTL:
+    """Stand-in for the `smaract.ctl` module, controlling an MCS2 with `channels` linear positioners.
+
+    Every packet sent to the controller counts as a round trip (`round_trips`):
+    each blocking call, each request sent without output buffer and each
+    flushed output buffer. Closed-loop moves run at the channel's velocity
+    and end with a MOVEMENT_FINISHED event.
+    """
+
+    class Property:
+        NUMBER_OF_CHANNELS = 0x020F0017
+        POS_MOVEMENT_TYPE = 0x0302003F
+        CHANNEL_STATE = 0x0305000F
+        POSITION = 0x0305001D
+        TARGET_POSITION = 0x0305001E
+        SCAN_POSITION = 0x0305001F
+        MOVE_MODE = 0x03050087
+        MOVE_VELOCITY = 0x0305002A
+        SCAN_VELOCITY = 0x0305002B
+
+    class MoveMode:
+        CL_ABSOLUTE = 0
+        CL_RELATIVE = 1
+        SCAN_ABSOLUTE = 2
+        SCAN_RELATIVE = 3
+        STEP = 4
+
+    class MovementType:
+        LINEAR = 0
+        ROTATORY = 1
+        GONIOMETER = 2
+
+    class ChannelState:
+        ACTIVELY_MOVING = 0x0001
+        CLOSED_LOOP_ACTIVE = 0x0002
+
+    class EventType:
+        MOVEMENT_FINISHED = 0x0001
+
+    class ErrorCode:
+        TIMEOUT = 0x0009
+
+    class Error(Exception):
+        def __init__(self, func, code, message):
+            super().__init__(f"{func}: {message}")
+            self.func = func
+            self.code = code
+            self.message = message
+
+    def __init__(self, channels=3, latency=0.002):
+        self.latency = latency
+        self.round_trips = 0
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+        self.channels = [
+            {"mode": self.MoveMode.CL_ABSOLUTE, "velocity": 1_000_000_000, "scan_velocity": 65535, "start": 0, "target": 0, "t_start": 0.0, "t_end": 0.0, "timer": None}
+            for _ in range(channels)
+        ]
+        self.requests = {}
+        self.next_request = 1
+
+    def _round_trip(self):
+        self.round_trips += 1
+        time.sleep(self.latency)
+
+    def _position(self, channel, now):
+        if now >= channel["t_end"]:
+            return channel["target"]
+        return int(channel["start"] + (channel["target"] - channel["start"]) * (now - channel["t_start"]) / (channel["t_end"] - channel["t_start"]))
+
+    def _get(self, idx, pkey):
+        now = time.monotonic()
+        if pkey == self.Property.NUMBER_OF_CHANNELS:
+            return len(self.channels)
+        channel = self.channels[idx]
+        if pkey == self.Property.POS_MOVEMENT_TYPE:
+            return self.MovementType.LINEAR
+        if pkey == self.Property.CHANNEL_STATE:
+            return self.ChannelState.CLOSED_LOOP_ACTIVE | (self.ChannelState.ACTIVELY_MOVING if now < channel["t_end"] else 0)
+        if pkey == self.Property.POSITION:
+            return self._position(channel, now)
+        if pkey in (self.Property.TARGET_POSITION, self.Property.SCAN_POSITION):
+            return channel["target"]
+        if pkey == self.Property.MOVE_MODE:
+            return channel["mode"]
+        if pkey == self.Property.MOVE_VELOCITY:
+            return channel["velocity"]
+        if pkey == self.Property.SCAN_VELOCITY:
+            return channel["scan_velocity"]
+        raise self.Error("GetProperty", 0x0020, f"Unsupported property {pkey:#x}")
+
+    def Open(self, locator, config=""):
+        self._round_trip()
+        return 1
+
+    def Close(self, handle):
+        for channel in self.channels:
+            if channel["timer"] is not None:
+                channel["timer"].cancel()
+
+    def GetProperty_i32(self, handle, idx, pkey):
+        self._round_trip()
+        return self._get(idx, pkey)
+
+    GetProperty_i64 = GetProperty_i32
+
+    def SetProperty_i32(self, handle, idx, pkey, value):
+        self._round_trip()
+        channel = self.channels[idx]
+        if pkey == self.Property.MOVE_MODE:
+            channel["mode"] = value
+        elif pkey == self.Property.MOVE_VELOCITY:
+            channel["velocity"] = value
+        elif pkey == self.Property.SCAN_VELOCITY:
+            channel["scan_velocity"] = value
+
+    SetProperty_i64 = SetProperty_i32
+
+    def Move(self, handle, idx, move_value, tHandle=0):
+        self._round_trip()
+        channel = self.channels[idx]
+        now = time.monotonic()
+        with self.lock:
+            position = self._position(channel, now)
+            if channel["timer"] is not None:
+                channel["timer"].cancel()
+                self.events.put(SimulatedSmarActEvent(idx, self.EventType.MOVEMENT_FINISHED, 0x0100))  # aborted
+            if channel["mode"] == self.MoveMode.CL_ABSOLUTE:
+                target = move_value
+                duration = abs(target - position) / max(channel["velocity"], 1)
+            else:
+                # steps and scan moves are modelled as (nearly) instantaneous
+                target = position + move_value if channel["mode"] == self.MoveMode.STEP else move_value
+                duration = 0.01
+            channel.update(start=position, target=target, t_start=now, t_end=now + duration)
+            channel["timer"] = threading.Timer(duration, self._finish, (idx,))
+            channel["timer"].start()
+
+    def _finish(self, idx):
+        with self.lock:
+            self.channels[idx]["timer"] = None
+        self.events.put(SimulatedSmarActEvent(idx, self.EventType.MOVEMENT_FINISHED, 0))
+
+    def Stop(self, handle, idx, tHandle=0):
+        self._round_trip()
+        channel = self.channels[idx]
+        now = time.monotonic()
+        with self.lock:
+            if now < channel["t_end"]:
+                channel.update(target=self._position(channel, now), t_end=now)
+                if channel["timer"] is not None:
+                    channel["timer"].cancel()
+                    channel["timer"] = None
+                self.events.put(SimulatedSmarActEvent(idx, self.EventType.MOVEMENT_FINISHED, 0x0100))
+
+    def OpenOutputBuffer(self, handle):
+        return self.next_request
+
+    def CloseOutputBuffer(self, handle, tHandle):
+        self._round_trip()
+
+    def RequestReadProperty(self, handle, idx, pkey, tHandle=0):
+        if tHandle == 0:
+            self._round_trip()
+        request_id = self.next_request
+        self.next_request += 1
+        self.requests[request_id] = self._get(idx, pkey)
+        return request_id
+
+    def ReadProperty_i32(self, handle, rID):
+        return self.requests.pop(rID)
+
+    ReadProperty_i64 = ReadProperty_i32
+
+    def WaitForEvent(self, handle, timeout):
+        try:
+            return self.events.get(timeout=timeout / 1000)
+        except queue.Empty:
+            raise self.Error("WaitForEvent", self.ErrorCode.TIMEOUT, "Timeout") from None
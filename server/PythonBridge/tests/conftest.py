@@ -0,0 +1,27 @@
+# The bridge modules import each other as top-level modules (the servers put
+# the PythonBridge directory on `sys.path`), the tests do the same.
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from host import DeviceHost  # noqa: E402
+
+DEVICES_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "..", "Devices")
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def host():
+    host = DeviceHost()
+    yield host
+    host.dispose()
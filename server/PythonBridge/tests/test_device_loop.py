@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import pytest
+
+import device_loop
+from device_loop import Periodic
+
+INTERVAL = 0.05
+
+
+async def tick_times(periodic, ticks, body=None):
+    loop = asyncio.get_running_loop()
+    times = []
+    async for tick in periodic:
+        times.append(loop.time())
+        if body is not None:
+            await body(tick)
+        if tick == ticks:
+            return times
+
+
+def test_periodic_ticks_on_a_fixed_grid():
+    periodic = Periodic(INTERVAL)
+
+    async def body(tick):
+        # the time spent in the body doesn't delay the following ticks
+        time.sleep(INTERVAL / 2)
+
+    times = asyncio.run(tick_times(periodic, 5, body))
+    for i, t in enumerate(times):
+        assert t - times[0] == pytest.approx(i * INTERVAL, abs=INTERVAL / 5)
+    assert periodic.overruns == 0
+
+
+def test_periodic_skips_the_ticks_of_an_overrun():
+    overruns = []
+    periodic = Periodic(INTERVAL, lambda skipped, lateness: overruns.append((skipped, lateness)))
+
+    async def body(tick):
+        if tick == 2:
+            # into the third interval after this tick
+            time.sleep(2.5 * INTERVAL)
+
+    times = asyncio.run(tick_times(periodic, 5, body))
+    # the tick after the overrun follows right away, the one in between is skipped
+    assert len(overruns) == 1 and periodic.overruns == 1
+    skipped, lateness = overruns[0]
+    assert skipped == 1
+    assert lateness == pytest.approx(1.5 * INTERVAL, abs=INTERVAL / 5)
+    assert periodic.max_lateness == lateness
+    assert times[2] - times[1] == pytest.approx(2.5 * INTERVAL, abs=INTERVAL / 5)
+    # and the grid is kept afterwards
+    assert times[3] - times[0] == pytest.approx(4 * INTERVAL, abs=INTERVAL / 5)
+    assert times[4] - times[0] == pytest.approx(5 * INTERVAL, abs=INTERVAL / 5)
+
+
+def test_run_refuses_to_block_the_device_loop():
+    async def nested():
+        device_loop.run(asyncio.sleep(0))
+
+    with pytest.raises(RuntimeError):
+        device_loop.run(nested())
+    assert device_loop.run(asyncio.sleep(0, "done")) == "done"
@@ -0,0 +1,96 @@
+import os
+import textwrap
+import time
+
+import pytest
+
+from conftest import DEVICES_DIRECTORY, wait_until
+
+
+def test_moves_on_the_simulated_bus_are_reported_until_they_arrived(host):
+    pytest.importorskip("elliptec")
+    elliptec = host.register_device("elliptec", os.path.join(DEVICES_DIRECTORY, "Elliptec.py"), {
+        "port": "simulated",
+        "simulate": True,
+        "channels": [{"type": "rotation", "address": "A"}, {"type": "rotation", "address": "B"}],
+    })
+    wait_until(lambda: len(elliptec.get_state()["channels"]) == 2)
+    start = time.monotonic()
+    elliptec.handle_action("set_position", [1, 90.0])
+    # the move runs in the background
+    assert time.monotonic() - start < 0.1
+    wait_until(lambda: elliptec.get_state()["channels"][1]["moving"])
+    wait_until(lambda: not elliptec.get_state()["channels"][1]["moving"])
+    channel = elliptec.get_state()["channels"][1]
+    assert channel["actualPosition"] == pytest.approx(90, abs=0.01)
+    assert channel["error"] is None
+
+
+# polarimeter whose theta and eta (in °) depend linearly on the waveplates
+POLARIMETER_SCRIPT = """
+    import time
+
+    import numpy as np
+
+    state = {"status": "ok", "theta": 0.0, "eta": 0.0, "DOP": 1.0, "power": 1e-5}
+    is_running: bool
+    get_device_state: callable
+    send_status_update: callable
+
+    JACOBIAN = np.array([[0.3, -2.0], [-1.8, 0.4]])
+    ORIGIN = np.array([120.0, 125.0])
+
+    def main():
+        while is_running:
+            channels = get_device_state("elliptec")["channels"]
+            waveplates = np.array([channels[0]["actualPosition"], channels[1]["actualPosition"]])
+            # with a bit of noise, such that every sample is published
+            theta, eta = JACOBIAN @ (waveplates - ORIGIN) + 1e-3 * np.random.randn(2)
+            state["theta"] = float(np.deg2rad(theta + 1.2))
+            state["eta"] = float(np.deg2rad(eta + 0.2))
+            send_status_update()
+            time.sleep(0.05)
+    """
+
+
+@pytest.fixture
+def lock(host, tmp_path):
+    polarimeter_script = tmp_path / "polarimeter.py"
+    polarimeter_script.write_text(textwrap.dedent(POLARIMETER_SCRIPT))
+    host.register_device("elliptec", os.path.join(DEVICES_DIRECTORY, "DemoElliptec.py"))
+    host.register_device("polarimeter", str(polarimeter_script))
+    return host.register_device("polarizationLock", os.path.join(DEVICES_DIRECTORY, "PolarizationLock.py"), {
+        "polarizationDeviceName": "polarimeter",
+        "waveplateDeviceName": "elliptec",
+        "waveplateQWPChannel": 0,
+        "waveplateHWPChannel": 1,
+    })
+
+
+def test_lock_waits_for_the_waveplates_to_arrive(host, lock):
+    elliptec = host.devices["elliptec"]
+    start = time.monotonic()
+    host.action("elliptec", None, "set_position", [0, 121.0])
+    lock.scope["wait_for_waveplates"]()
+    # DemoElliptec's moves take 0.2 s
+    assert time.monotonic() - start >= 0.15
+    assert not elliptec.get_state()["channels"][0]["moving"]
+
+
+def test_jacobian_mode_locks_both_waveplates_at_once(host, lock):
+    host.action("elliptec", None, "set_position", [0, 121.0])
+    host.action("elliptec", None, "set_position", [1, 124.0])
+    host.action("polarizationLock", None, "calibrate_jacobian", [])
+    host.action("polarizationLock", None, "set_mode", ["jacobian"])
+    # the calibration is run by main()
+    nominal_jacobian = lock.get_state()["jacobian"]
+    wait_until(lambda: lock.get_state()["jacobian"] != nominal_jacobian and not lock.get_state()["calibrating"], timeout=30)
+    jacobian = lock.get_state()["jacobian"]
+    assert jacobian[0] == pytest.approx([0.3, -2.0], abs=0.1)
+    assert jacobian[1] == pytest.approx([-1.8, 0.4], abs=0.1)
+    host.action("polarizationLock", None, "start_polarization_lock", [])
+    wait_until(lambda: lock.get_state()["statistics"]["locked"], timeout=30)
+    channels = host.devices["elliptec"].get_state()["channels"]
+    # DemoElliptec arrives 0.2° short of the target
+    assert channels[0]["actualPosition"] == pytest.approx(120, abs=0.5)
+    assert channels[1]["actualPosition"] == pytest.approx(125, abs=0.5)
@@ -0,0 +1,108 @@
+import textwrap
+import time
+
+import pytest
+
+from host import DeviceHost
+
+
+def write_script(tmp_path, source):
+    path = tmp_path / "device.py"
+    path.write_text(textwrap.dedent(source))
+    return str(path)
+
+
+COUNTER_SCRIPT = """
+    state = {"count": 0}
+    send_status_update: callable
+
+    def increment(publish):
+        state["count"] += 1
+        if publish:
+            send_status_update()
+    """
+
+
+def test_get_state_is_cached_until_the_state_changes(tmp_path):
+    host = DeviceHost()
+    try:
+        device = host.register_device("counter", write_script(tmp_path, COUNTER_SCRIPT))
+        assert device.get_state() == {"count": 0}
+        assert device.get_state() is device.get_state()
+        device.scope["increment"](True)
+        assert device.get_state() == {"count": 1}
+        # without send_status_update, the change isn't seen
+        device.scope["increment"](False)
+        assert device.get_state() == {"count": 1}
+    finally:
+        host.dispose()
+
+
+def test_check_state_cache_reports_unpublished_changes(tmp_path, capsys):
+    host = DeviceHost(check_state_cache=True)
+    try:
+        device = host.register_device("counter", write_script(tmp_path, COUNTER_SCRIPT))
+        device.get_state()
+        device.scope["increment"](False)
+        assert device.get_state() == {"count": 1}
+    finally:
+        host.dispose()
+    assert "state changed without send_status_update" in capsys.readouterr().out
+
+
+PERIODIC_SCRIPT = """
+    import time
+
+    state = {"ticks": 0}
+    periodic: callable
+
+    async def main():
+        async for _ in periodic(0.05):
+            state["ticks"] += 1
+            if state["ticks"] == 2:
+                time.sleep(0.125)
+    """
+
+
+def test_periodic_reports_overruns_and_stops_with_the_device(tmp_path, capsys):
+    host = DeviceHost()
+    device = host.register_device("periodic", write_script(tmp_path, PERIODIC_SCRIPT))
+    time.sleep(0.4)
+    host.dispose()
+    ticks = device.scope["state"]["ticks"]
+    time.sleep(0.15)
+    assert device.scope["state"]["ticks"] == ticks
+    assert "periodic(0.05): overrun by" in capsys.readouterr().out
+
+
+BATCH_SCRIPT = """
+    state = {"values": {}}
+
+    def set_value(name, value):
+        if value is None:
+            raise ValueError(f"No value for {name}")
+        state["values"][name] = value
+
+    def run_batch(actions, best_effort):
+        action_batch(actions, best_effort=best_effort)
+    """
+
+
+def test_best_effort_action_batch_runs_every_action(tmp_path):
+    host = DeviceHost()
+    try:
+        device = host.register_device("values", write_script(tmp_path, BATCH_SCRIPT))
+        actions = [
+            ("values", None, "set_value", ["a", 1]),
+            ("values", None, "set_value", ["b", None]),
+            ("values", None, "set_value", ["c", 3]),
+        ]
+        with pytest.raises(ValueError):
+            device.scope["run_batch"](actions, False)
+        assert device.scope["state"]["values"] == {"a": 1}
+        with pytest.raises(ExceptionGroup) as errors:
+            device.scope["run_batch"](actions, True)
+        assert len(errors.value.exceptions) == 1
+        assert device.scope["state"]["values"] == {"a": 1, "c": 3}
+    finally:
+        host.dispose()
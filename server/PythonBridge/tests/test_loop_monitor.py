@@ -0,0 +1,105 @@
+import sys
+
+import pytest
+
+import loop_monitor
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 12), reason="sys.monitoring requires Python 3.12")
+
+iterations = 100
+# reported to by loop_monitor, which looks it up in the globals of the monitored code
+recorded = []
+
+
+def _record_loop_iteration():
+    recorded.append(None)
+
+
+def count_iterations(function):
+    assert loop_monitor.monitor(function)
+    recorded.clear()
+    function()
+    return len(recorded)
+
+
+def plain_loop():
+    for i in range(iterations):
+        pass
+
+
+def nested_loops():
+    for i in range(iterations):
+        j = 0
+        while j < 3:
+            j += 1
+        for k in range(3):
+            if k:
+                continue
+
+
+def continue_within_try():
+    # every iteration continues, some of them from within `try`
+    n = 0
+    while n < iterations:
+        n += 1
+        try:
+            if n % 3 == 0:
+                continue
+        except ValueError:
+            pass
+        continue
+
+
+def continue_within_except():
+    n = 0
+    while n < iterations:
+        n += 1
+        try:
+            if n % 2:
+                raise ValueError
+        except ValueError:
+            continue
+        continue
+
+
+def continue_after_inner_loop():
+    n = 0
+    while n < iterations:
+        n += 1
+        for i in range(3):
+            pass
+        if n % 2:
+            continue
+        n += 0
+
+
+def except_before_loop():
+    try:
+        int("not a number")
+    except ValueError:
+        pass
+    for i in range(iterations):
+        try:
+            int("not a number")
+        except ValueError:
+            continue
+
+
+def test_counts_the_iterations_of_the_outermost_loop():
+    assert count_iterations(plain_loop) == iterations
+    assert count_iterations(nested_loops) == iterations
+
+
+def test_counts_continue_within_try_and_except():
+    assert count_iterations(continue_within_try) == iterations
+    assert count_iterations(continue_within_except) == iterations
+    assert count_iterations(except_before_loop) == iterations
+
+
+def test_counts_continue_after_inner_loop():
+    # the last iteration leaves through the condition instead of jumping back
+    assert count_iterations(continue_after_inner_loop) == iterations - 1
+
+
+def test_without_loop():
+    assert not loop_monitor.monitor(_record_loop_iteration)
@@ -0,0 +1,33 @@
+import os
+import time
+
+import simulated_instruments
+from conftest import DEVICES_DIRECTORY
+from host import DeviceHost
+
+
+def test_buffered_mode_queries_twice_per_revolution(monkeypatch):
+    queries = []
+    query = simulated_instruments.SimulatedPAX1000.query
+
+    def counting_query(self, command):
+        if command == "SENS:DATA:LAT?":
+            queries.append(time.perf_counter())
+        return query(self, command)
+
+    monkeypatch.setattr(simulated_instruments.SimulatedPAX1000, "query", counting_query)
+    host = DeviceHost()
+    try:
+        device = host.register_device("polarimeter", os.path.join(DEVICES_DIRECTORY, "ThorlabsPolarimeter.py"), {"device": "simulated", "simulate": True, "mode": "buffered"})
+        # the script waits a second for the waveplate to rotate
+        time.sleep(2.5)
+        state = device.get_state()
+    finally:
+        host.dispose()
+    assert state["status"] == "ok"
+    # the simulated waveplate rotates 60 times per second
+    assert abs(state["revolutionRate"] - 60) < 10
+    # within the last second, the revolution rate is known by then
+    queries = [t for t in queries if t > queries[-1] - 1]
+    # instead of as often as the instrument answers (every 2 ms)
+    assert len(queries) <= 2 * 60 * 1.1
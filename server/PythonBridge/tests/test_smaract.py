@@ -0,0 +1,107 @@
+import os
+import textwrap
+import time
+
+import numpy as np
+import pytest
+
+from conftest import DEVICES_DIRECTORY, wait_until
+
+
+@pytest.fixture
+def smaract(host):
+    device = host.register_device("smaract", os.path.join(DEVICES_DIRECTORY, "SmaractDevice.py"), {"device": "simulated", "simulate": True}, max_status_update_rate=10)
+    wait_until(lambda: len(device.get_state()["channels"]) == 3)
+    return device
+
+
+def test_moves_are_reported_until_they_finished(smaract):
+    smaract.handle_action("move_to", [1, 2.5, "closed-loop"])
+    assert smaract.get_state()["channels"][1]["moving"]
+    wait_until(lambda: not smaract.get_state()["channels"][1]["moving"])
+    channel = smaract.get_state()["channels"][1]
+    assert channel["actualPosition"] == pytest.approx(2.5)
+    assert channel["lastMovement"]["errorCode"] == 0
+
+
+def test_positions_at_rest_are_read_rarely_and_in_batches(smaract):
+    ctl = smaract.scope["ctl"]
+    # the poll interval grows from 50 ms to 1 s
+    time.sleep(2)
+    round_trips = ctl.round_trips
+    time.sleep(2)
+    # a single round trip for all channels, about once per second
+    assert ctl.round_trips - round_trips <= 3
+
+
+def load_lock(host, tmp_path, optimum):
+    # oscilloscope whose peak is the smallest at z = `optimum`
+    het_script = tmp_path / "het.py"
+    het_script.write_text(textwrap.dedent(f"""
+        import numpy as np
+
+        state = {{"FFTAveragingDurationInMilliseconds": 10}}
+        get_device_state: callable
+
+        def setFFTAveragingDuration(duration):
+            state["FFTAveragingDurationInMilliseconds"] = duration
+
+        def GetFFT(channel, f_start, f_end):
+            z = get_device_state("smaract")["channels"][0]["actualPosition"]
+            return [0.0], [10 * np.log10(1e-6 * (1 + 40 * (z - {optimum}) ** 2))]
+        """))
+    constants_script = tmp_path / "constants.py"
+    constants_script.write_text('state = {"HeterodyneFrequency": 1e6}\n')
+    host.register_device("het", str(het_script))
+    host.register_device("constants", str(constants_script))
+    return host.register_device("smaractLock", os.path.join(DEVICES_DIRECTORY, "SmaractLock.py"), {"osciChannel": 0, "smaractZChannel": 0, "averagingDuration": 10})
+
+
+def test_fit_step_moves_towards_the_minimum(host, tmp_path):
+    lock = load_lock(host, tmp_path, 0)
+    fit_step = lock.scope["fit_step"]
+    limits = {"dither": 0.01, "minStep": 0.001, "maxStep": 0.05}
+    positions = np.array([0.99, 1.0, 1.01, 1.0])
+    # a parabola with its minimum 4 nm above the center, which is approached by `gain` (0.5)
+    assert fit_step(positions, 1 + (positions - 1.004) ** 2, 1.0, limits) == pytest.approx(0.002)
+    # far away, the step is limited
+    assert fit_step(positions, 1 + (positions - 2) ** 2, 1.0, limits) == pytest.approx(0.05)
+    # without minimum, it steps downhill
+    assert fit_step(positions, 10 - (positions - 0.9) ** 2, 1.0, limits) == pytest.approx(0.05)
+
+
+def test_lock_converges_to_the_optimum(host, tmp_path, smaract):
+    lock = load_lock(host, tmp_path, 0.2)
+    lock.handle_action("start_z_lock", [])
+    wait_until(lambda: lock.get_state()["zCenter"] is not None and abs(lock.get_state()["zCenter"] - 0.2) < 0.01, timeout=20)
+    center = lock.get_state()["zCenter"]
+    lock.handle_action("stop_z_lock", [])
+    wait_until(lambda: lock.get_state()["zCenter"] is None)
+    # not left at one of the dithered positions
+    assert smaract.get_state()["channels"][0]["targetPosition"] == pytest.approx(center)
+
+
+def test_other_devices_can_wait_for_a_move(host, tmp_path, smaract):
+    script = tmp_path / "mover.py"
+    script.write_text(textwrap.dedent("""
+        import time
+
+        action: callable
+        wait_for_state: callable
+        subscribe_device_state: callable
+
+        def move_and_wait(position):
+            # like the lock, waits on the mirrored state
+            subscribe_device_state("smaract")
+            # at 10 µm/s, the move takes 0.3 s
+            action("smaract", None, "set_velocity", [2, 10, "closed-loop"])
+            # the second move is within the rate limit's interval after the first one
+            action("smaract", None, "move_to", [1, position, "closed-loop"])
+            action("smaract", None, "move_to", [2, position, "closed-loop"])
+            start = time.monotonic()
+            wait_for_state("smaract", lambda s: not s["channels"][2]["moving"], timeout=5)
+            return time.monotonic() - start
+        """))
+    mover = host.register_device("mover", str(script))
+    # the moving state is published despite the rate limit, so this returns once the move finished
+    assert mover.scope["move_and_wait"](3.0) > 0.25
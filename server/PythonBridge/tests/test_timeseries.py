@@ -0,0 +1,94 @@
+import math
+import os
+
+import numpy as np
+import pytest
+
+from timeseries import ColumnStore, RingBuffer, RollingStatistics, decimate_min_max
+
+
+def test_ring_buffer_keeps_the_latest_samples():
+    buffer = RingBuffer(4, channels=2)
+    for t in range(6):
+        buffer.append(t, [t, -t])
+    assert len(buffer) == 4
+    times, values = buffer.get()
+    assert times.tolist() == [2, 3, 4, 5]
+    assert values[:, 1].tolist() == [-2, -3, -4, -5]
+    t, latest = buffer.latest()
+    assert t == 5 and latest.tolist() == [5, -5]
+
+
+def test_ring_buffer_selects_time_ranges_across_the_wrap_around():
+    buffer = RingBuffer(5)
+    buffer.extend(np.arange(3.0), np.arange(3.0).reshape(-1, 1))
+    buffer.extend(np.arange(3.0, 7.0), np.arange(3.0, 7.0).reshape(-1, 1))
+    times, values = buffer.get(3, 5, channel=0)
+    assert times.tolist() == [3, 4, 5]
+    assert values.tolist() == [3, 4, 5]
+    times, values = buffer.get(10, 20, channel=0)
+    assert len(times) == 0 and values.shape == (0,)
+
+
+def test_ring_buffer_extend_beyond_capacity():
+    buffer = RingBuffer(3)
+    buffer.extend(np.arange(10.0), np.arange(10.0).reshape(-1, 1))
+    assert buffer.get()[0].tolist() == [7, 8, 9]
+
+
+def test_decimate_min_max_keeps_the_extremes():
+    times = np.arange(100.0)
+    values = np.sin(times)
+    values[37] = 5
+    decimated_times, minima, maxima = decimate_min_max(times, values, 10)
+    assert len(decimated_times) == 10
+    assert maxima.max() == 5
+    assert minima.min() == values.min()
+
+
+def test_rolling_statistics_moves_with_the_window():
+    statistics = RollingStatistics(window=10)
+    for t in range(20):
+        statistics.add(t, 2.0 * t)
+    # the samples at t = 9 ... 19
+    assert len(statistics) == 11
+    assert statistics.mean == pytest.approx(28)
+    assert statistics.min == 18 and statistics.max == 38
+    assert statistics.rate == pytest.approx(2)
+
+
+def test_rolling_statistics_skips_nan_and_expires_everything():
+    statistics = RollingStatistics(window=1)
+    statistics.add(0, 1.0)
+    statistics.add(0.5, math.nan)
+    assert len(statistics) == 1 and statistics.rate is None
+    statistics.add(5, math.nan)
+    assert statistics.to_dict() == {"mean": None, "min": None, "max": None, "rate": None}
+
+
+def test_column_store_saves_chunks_and_opens_them_again(tmp_path):
+    store = ColumnStore(str(tmp_path), chunk_size=4)
+    name = ColumnStore.to_name("pressure", "channels.1.pressure")
+    for t in range(10):
+        store.append(name, float(t), float(t) * 10)
+    store.flush()
+    store = ColumnStore(str(tmp_path), chunk_size=4)
+    assert store.names() == [name]
+    times, values = store.series(name).get(3, 8)
+    assert times.tolist() == [3, 4, 5, 6, 7, 8]
+    assert values.tolist() == [30, 40, 50, 60, 70, 80]
+    trace = store.query(name, max_points=100)
+    assert trace["t"] == list(range(10))
+    with pytest.raises(KeyError):
+        store.query("unknown")
+
+
+def test_column_store_keeps_chunks_with_equal_times(tmp_path):
+    # e.g. a burst of updates within the same microsecond
+    store = ColumnStore(str(tmp_path), chunk_size=2)
+    for value in range(6):
+        store.append("device/value", 1.0, float(value))
+    series_directory = os.path.join(str(tmp_path), "device", "value")
+    assert len(os.listdir(series_directory)) == 3
+    store = ColumnStore(str(tmp_path), chunk_size=2)
+    assert store.series("device/value").get()[1].tolist() == [0, 1, 2, 3, 4, 5]
@@ -0,0 +1,69 @@
+import io
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from worker import HEADER, WorkerConnection
+
+
+def test_messages_are_framed_by_their_length():
+    output = io.BytesIO()
+    connection = WorkerConnection(None, output)
+    connection.send({"type": "state_update", "payload": "{}"})
+    connection.send({"type": "loop_iteration"})
+    data = output.getvalue()
+    (length,) = HEADER.unpack(data[:HEADER.size])
+    assert data[HEADER.size:HEADER.size + length] == b'{"type":"state_update","payload":"{}"}'
+
+    connection = WorkerConnection(io.BytesIO(data), None)
+    assert connection.receive() == {"type": "state_update", "payload": "{}"}
+    assert connection.receive() == {"type": "loop_iteration"}
+    # the server closed the pipe
+    assert connection.receive() is None
+
+
+def test_header_is_little_endian_int32():
+    assert HEADER.pack(0x01020304) == b"\x04\x03\x02\x01"
+
+
+def test_numpy_values_are_sent_as_lists():
+    output = io.BytesIO()
+    WorkerConnection(None, output).send({"value": np.arange(3), "scalar": np.float32(0.5)})
+    assert WorkerConnection(io.BytesIO(output.getvalue()), None).receive() == {"value": [0, 1, 2], "scalar": 0.5}
+
+
+def test_truncated_header_ends_the_connection():
+    assert WorkerConnection(io.BytesIO(b"\x01\x00"), None).receive() is None
+
+
+def test_calls_are_resolved_by_their_id():
+    # two connected pipes, the other end answers like the server does
+    server_read, worker_write = os.pipe()
+    worker_read, server_write = os.pipe()
+    with open(worker_read, "rb") as worker_input, open(worker_write, "wb") as worker_output, open(server_read, "rb") as server_input, open(server_write, "wb") as server_output:
+        worker = WorkerConnection(worker_input, worker_output)
+        server = WorkerConnection(server_input, server_output)
+
+        def serve():
+            for _ in range(2):
+                call = server.receive()
+                if call["method"] == "fail":
+                    server.send({"id": call["id"], "type": "error", "message": "failed"})
+                else:
+                    server.send({"id": call["id"], "type": "result", "value": call["args"]})
+
+        def read():
+            for _ in range(2):
+                worker.resolve(worker.receive())
+
+        threads = [threading.Thread(target=serve), threading.Thread(target=read)]
+        for thread in threads:
+            thread.start()
+        assert worker.call("get_device_state", "pressure") == ["pressure"]
+        with pytest.raises(RuntimeError, match="failed"):
+            worker.call("fail")
+        for thread in threads:
+            thread.join(5)
+        assert not worker.pending_calls
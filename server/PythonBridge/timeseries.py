@@ -0,0 +1,399 @@
+# Helpers for devices keeping a history of their readings:
+#
+#   history = RingBuffer(24 * 3600, channels=2)
+#   history.append(time.time(), [p1, p2])
+#   trace = decimate_min_max(*history.get(t_start, t_end, channel=0), max_points=1000)
+#
+# Missing readings are stored as NaN. During recordings, `RecordedSeries`
+# writes the readings into the recording's .npy files; `ColumnStore` keeps
+# long histories on disk.
+import collections
+import glob
+import math
+import os
+import re
+import threading
+
+import numpy as np
+
+
+class RingBuffer:
+    """Fixed-size buffer of timestamped samples, with one column per channel.
+
+    Timestamps have to be non-decreasing, such that time ranges can be looked
+    up by bisection. Appending and reading may happen on different threads.
+    """
+
+    def __init__(self, capacity, channels=1, dtype=np.float64):
+        self.capacity = capacity
+        self.times = np.empty(capacity, dtype=np.float64)
+        self.values = np.empty((capacity, channels), dtype=dtype)
+        self._start = 0
+        self._length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._length
+
+    def append(self, t, values):
+        with self._lock:
+            index = (self._start + self._length) % self.capacity
+            self.times[index] = t
+            self.values[index] = values
+            if self._length < self.capacity:
+                self._length += 1
+            else:
+                self._start = (self._start + 1) % self.capacity
+
+    def extend(self, times, values):
+        """Appends many samples at once, `values` having one row per sample."""
+        times = times[-self.capacity:]
+        values = values[-self.capacity:]
+        with self._lock:
+            first = (self._start + self._length) % self.capacity
+            count = min(len(times), self.capacity - first)
+            self.times[first:first + count] = times[:count]
+            self.values[first:first + count] = values[:count]
+            self.times[:len(times) - count] = times[count:]
+            self.values[:len(times) - count] = values[count:]
+            overflow = max(0, self._length + len(times) - self.capacity)
+            self._length = min(self._length + len(times), self.capacity)
+            self._start = (self._start + overflow) % self.capacity
+
+    def _segments(self):
+        end = self._start + self._length
+        if end <= self.capacity:
+            return [slice(self._start, end)]
+        return [slice(self._start, self.capacity), slice(0, end - self.capacity)]
+
+    def get(self, t_start=None, t_end=None, channel=None):
+        """Returns `(times, values)` of the samples with t_start <= t <= t_end in chronological order.
+
+        Only the selected range gets copied; `values` is 1D if a channel is given.
+        """
+        times = []
+        values = []
+        with self._lock:
+            for segment in self._segments():
+                segment_times = self.times[segment]
+                first = 0 if t_start is None else np.searchsorted(segment_times, t_start, "left")
+                last = len(segment_times) if t_end is None else np.searchsorted(segment_times, t_end, "right")
+                if first < last:
+                    times.append(segment_times[first:last].copy())
+                    segment_values = self.values[segment][first:last]
+                    values.append((segment_values if channel is None else segment_values[:, channel]).copy())
+        if not times:
+            return np.empty(0), np.empty((0,) if channel is not None else (0, self.values.shape[1]))
+        return np.concatenate(times), np.concatenate(values)
+
+    def latest(self):
+        with self._lock:
+            if self._length == 0:
+                return None
+            index = (self._start + self._length - 1) % self.capacity
+            return self.times[index], self.values[index].copy()
+
+
+def decimate_min_max(times, values, max_points):
+    """Reduces a trace to at most `max_points` bins, keeping the minimum and maximum of each.
+
+    Returns `(times, minima, maxima)`, with the times being those of the first
+    sample of the bins. NaN values are ignored, bins without data are NaN.
+    """
+    if len(times) <= max_points:
+        return times, values, values
+    edges = np.unique(np.linspace(0, len(times), max_points + 1, dtype=np.int64)[:-1])
+    return times[edges], np.fmin.reduceat(values, edges), np.fmax.reduceat(values, edges)
+
+
+def to_json_list(array):
+    # JSON has no NaN, missing values become null
+    return [None if math.isnan(value) else value for value in array.tolist()]
+
+
+class RollingStatistics:
+    """Mean, minimum, maximum and rate of change of the samples within the last `window` seconds.
+
+    Updated incrementally for each sample: the sums for the mean and the
+    least-squares slope are moved along with the window, minimum and maximum
+    are tracked with monotonic queues. NaN samples are skipped.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._samples = collections.deque()
+        self._minima = collections.deque()
+        self._maxima = collections.deque()
+        self._origin = None
+        self._sum_t = self._sum_v = self._sum_tt = self._sum_tv = 0.0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, t, value):
+        if math.isnan(value):
+            self._expire(t)
+            return
+        if self._origin is None:
+            # relative times keep the sums of squares well-conditioned
+            self._origin = t
+        self._samples.append((t, value))
+        self._update_sums(t - self._origin, value, 1)
+        while self._minima and self._minima[-1][1] >= value:
+            self._minima.pop()
+        self._minima.append((t, value))
+        while self._maxima and self._maxima[-1][1] <= value:
+            self._maxima.pop()
+        self._maxima.append((t, value))
+        self._expire(t)
+
+    def _update_sums(self, t, value, sign):
+        self._sum_t += sign * t
+        self._sum_v += sign * value
+        self._sum_tt += sign * t * t
+        self._sum_tv += sign * t * value
+
+    def _expire(self, now):
+        oldest = now - self.window
+        while self._samples and self._samples[0][0] < oldest:
+            t, value = self._samples.popleft()
+            self._update_sums(t - self._origin, value, -1)
+        while self._minima and self._minima[0][0] < oldest:
+            self._minima.popleft()
+        while self._maxima and self._maxima[0][0] < oldest:
+            self._maxima.popleft()
+        if not self._samples:
+            # start over without the rounding errors accumulated so far
+            self._origin = None
+            self._sum_t = self._sum_v = self._sum_tt = self._sum_tv = 0.0
+
+    @property
+    def mean(self):
+        return self._sum_v / len(self._samples) if self._samples else None
+
+    @property
+    def min(self):
+        return self._minima[0][1] if self._minima else None
+
+    @property
+    def max(self):
+        return self._maxima[0][1] if self._maxima else None
+
+    @property
+    def rate(self):
+        """Slope of the least-squares line through the window, in units per second."""
+        n = len(self._samples)
+        denominator = n * self._sum_tt - self._sum_t * self._sum_t
+        if n < 2 or denominator <= 0:
+            return None
+        return (n * self._sum_tv - self._sum_t * self._sum_v) / denominator
+
+    def to_dict(self):
+        return {"mean": self.mean, "min": self.min, "max": self.max, "rate": self.rate}
+
+
+class ChannelHistory:
+    """History and rolling statistics of a device reading several channels at once."""
+
+    def __init__(self, capacity, channels, statistics_window=60):
+        self.buffer = RingBuffer(capacity, channels)
+        self.rolling = [RollingStatistics(statistics_window) for _ in range(channels)]
+
+    def add(self, t, values):
+        self.buffer.append(t, values)
+        for statistics, value in zip(self.rolling, values):
+            statistics.add(t, value)
+
+    def statistics(self, channel):
+        return self.rolling[channel].to_dict()
+
+    def query(self, channel, t_start=None, t_end=None, max_points=1000):
+        """Min/max-decimated trace of `channel` as JSON-compatible dict.
+
+        Negative times are relative to the latest sample, e.g. `t_start=-3600` for the last hour.
+        """
+        latest = self.buffer.latest()
+        if latest is not None:
+            if t_start is not None and t_start < 0:
+                t_start += latest[0]
+            if t_end is not None and t_end < 0:
+                t_end += latest[0]
+        times, minima, maxima = decimate_min_max(*self.buffer.get(t_start, t_end, channel), int(max_points))
+        return {"t": times.tolist(), "min": to_json_list(minima), "max": to_json_list(maxima)}
+
+
+class RecordedSeries:
+    """Timestamped samples written into a recording, created in the device's `on_record(get_stream)`.
+
+    The timestamps go into the stream `t`, every column into a stream of its
+    own, e.g. `<device id>_t.npy` and `<device id>_C1.npy`.
+    """
+
+    def __init__(self, get_stream, columns):
+        self.times = get_stream("t")
+        self.columns = [get_stream(name) for name in columns]
+
+    @property
+    def is_open(self):
+        return self.times.is_open
+
+    def write(self, times, values):
+        """Writes a sample (one value per column) or many (one row per timestamp).
+
+        Returns False once the recording stopped.
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(self.columns))
+        if not self.times.write(times):
+            return False
+        for stream, column in zip(self.columns, values.T):
+            stream.write(column)
+        return True
+
+
+class ChunkedSeries:
+    """Append-only history of a single value on disk, as chunks of `(t, value)` rows in .npy files.
+
+    Full chunks are saved as `<sequence number>_<first t>_<last t>.npy` (the
+    times of consecutive chunks might be equal) and never touched again,
+    such that they can be memory-mapped while the series grows. The samples
+    of the current chunk are kept in memory and saved to `current.npy` by
+    `flush()`, which is read back when the series is opened again.
+    """
+
+    CURRENT_FILENAME = "current.npy"
+
+    def __init__(self, directory, chunk_size=4096):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self._buffer = np.empty((chunk_size, 2))
+        self._length = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        chunks = []
+        for path in glob.glob(os.path.join(directory, "*_*_*.npy")):
+            sequence_number, first, last = os.path.basename(path)[:-4].split("_")
+            chunks.append((int(sequence_number), float(first), float(last), path))
+        # (first t, last t, path) of the full chunks, in chronological order
+        self._chunks = [chunk[1:] for chunk in sorted(chunks)]
+        current_path = os.path.join(directory, self.CURRENT_FILENAME)
+        if os.path.exists(current_path):
+            current = np.load(current_path)[:chunk_size]
+            self._buffer[:len(current)] = current
+            self._length = len(current)
+
+    @property
+    def last_time(self):
+        if self._length:
+            return self._buffer[self._length - 1, 0]
+        return self._chunks[-1][1] if self._chunks else None
+
+    def append(self, t, value):
+        with self._lock:
+            last_time = self.last_time
+            # times have to be non-decreasing for the lookups by bisection
+            if last_time is not None and t < last_time:
+                t = last_time
+            self._buffer[self._length] = (t, value)
+            self._length += 1
+            self._dirty = True
+            if self._length == self.chunk_size:
+                self._save_chunk()
+
+    def _save_chunk(self):
+        chunk = self._buffer[:self._length]
+        path = os.path.join(self.directory, f"{len(self._chunks):06d}_{chunk[0, 0]:.6f}_{chunk[-1, 0]:.6f}.npy")
+        _save_atomically(path, chunk)
+        self._chunks.append((chunk[0, 0], chunk[-1, 0], path))
+        self._length = 0
+        current_path = os.path.join(self.directory, self.CURRENT_FILENAME)
+        if os.path.exists(current_path):
+            os.remove(current_path)
+        self._dirty = False
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                _save_atomically(os.path.join(self.directory, self.CURRENT_FILENAME), self._buffer[:self._length])
+                self._dirty = False
+
+    def get(self, t_start=None, t_end=None):
+        """Returns `(times, values)` of the samples with t_start <= t <= t_end; only the selected range is read."""
+        with self._lock:
+            chunks = [
+                np.load(path, mmap_mode="r")
+                for first, last, path in self._chunks
+                if (t_start is None or last >= t_start) and (t_end is None or first <= t_end)
+            ]
+            chunks.append(self._buffer[:self._length])
+            times = []
+            values = []
+            for chunk in chunks:
+                first = 0 if t_start is None else np.searchsorted(chunk[:, 0], t_start, "left")
+                last = len(chunk) if t_end is None else np.searchsorted(chunk[:, 0], t_end, "right")
+                if first < last:
+                    times.append(np.array(chunk[first:last, 0]))
+                    values.append(np.array(chunk[first:last, 1]))
+        if not times:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(times), np.concatenate(values)
+
+
+def _save_atomically(path, array):
+    # readers never see a partially written file
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        np.save(file, array)
+    os.replace(temporary_path, path)
+
+
+class ColumnStore:
+    """Named `ChunkedSeries` below `directory`, e.g. `pressure/channels.1.pressure`.
+
+    The parts of the names become directories, characters other than letters,
+    digits, `.` and `-` are replaced by `_`. Existing series are opened again.
+    """
+
+    def __init__(self, directory, chunk_size=4096):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self._series = {}
+        self._lock = threading.Lock()
+        for path in glob.glob(os.path.join(directory, "**", "*.npy"), recursive=True):
+            name = os.path.relpath(os.path.dirname(path), directory).replace(os.sep, "/")
+            if name not in self._series:
+                self._series[name] = ChunkedSeries(os.path.dirname(path), chunk_size)
+
+    @staticmethod
+    def to_name(*parts):
+        return "/".join(re.sub(r"[^\w.\-]", "_", str(part)) for part in parts)
+
+    def names(self):
+        with self._lock:
+            return sorted(self._series)
+
+    def series(self, name):
+        """The series called `name`, which gets created if necessary."""
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = ChunkedSeries(os.path.join(self.directory, *name.split("/")), self.chunk_size)
+            return series
+
+    def append(self, name, t, value):
+        self.series(name).append(t, value)
+
+    def flush(self):
+        with self._lock:
+            series = list(self._series.values())
+        for item in series:
+            item.flush()
+
+    def query(self, name, t_start=None, t_end=None, max_points=1000):
+        """Min/max-decimated trace of the series as JSON-compatible dict, see `ChannelHistory.query`."""
+        with self._lock:
+            series = self._series.get(name)
+        if series is None:
+            raise KeyError(f"Unknown series {name}")
+        times, minima, maxima = decimate_min_max(*series.get(t_start, t_end), int(max_points))
+        return {"t": times.tolist(), "min": to_json_list(minima), "max": to_json_list(maxima)}
@@ -0,0 +1,255 @@
+# Runs a single device script in its own process on behalf of
+# PythonWorkerDevice.cs, such that a stalled instrument can't hold the GIL of
+# the server's embedded interpreter.
+#
+# Messages are JSON objects framed by a little-endian int32 length and are
+# exchanged over stdin/stdout; everything the script prints goes to stderr.
+# Requests carry an `id` which the reply (`result` or `error`) refers to:
+#   server -> worker: call (get_state, action, on_save_snapshot, get_settings,
+#                     load_settings, ping, dispose), state_changed, result, error
+#   worker -> server: ready, failed, state_update, state_patch, stream_data,
+#                     loop_iteration, call (get_device_state, action,
+#                     action_batch, request, subscribe_device_state), result,
+#                     error
+import argparse
+import base64
+import itertools
+import json
+import os
+import struct
+import sys
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from host import HostedDevice
+
+HEADER = struct.Struct("<i")
+
+
+def to_json(value):
+    # NumPy scalars and arrays, everything else gets represented as string
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+class WorkerConnection:
+    def __init__(self, input, output):
+        self.input = input
+        self.output = output
+        self.write_lock = threading.Lock()
+        self.call_ids = itertools.count(1)
+        self.pending_calls = {}
+
+    def send(self, message):
+        data = json.dumps(message, separators=(",", ":"), default=to_json).encode()
+        with self.write_lock:
+            self.output.write(HEADER.pack(len(data)) + data)
+            self.output.flush()
+
+    def receive(self):
+        header = self.input.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        return json.loads(self.input.read(HEADER.unpack(header)[0]))
+
+    def call(self, method, *args):
+        call_id = next(self.call_ids)
+        future = Future()
+        self.pending_calls[call_id] = future
+        try:
+            self.send({"id": call_id, "type": "call", "method": method, "args": args})
+            return future.result()
+        finally:
+            del self.pending_calls[call_id]
+
+    def resolve(self, message):
+        future = self.pending_calls.get(message["id"])
+        if future is None:
+            return
+        if message["type"] == "result":
+            future.set_result(message.get("value"))
+        else:
+            future.set_exception(RuntimeError(message.get("message")))
+
+
+class RemoteDevice:
+    def __init__(self, connection, device_id):
+        self.connection = connection
+        self.device_id = device_id
+
+    def get_serialized_state(self):
+        return self.connection.call("get_device_state", self.device_id)
+
+    def get_state(self):
+        return json.loads(self.get_serialized_state())
+
+
+class RemoteDevices:
+    # the server checks whether the devices exist
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __contains__(self, device_id):
+        return True
+
+    def __getitem__(self, device_id):
+        return RemoteDevice(self.connection, device_id)
+
+
+class WorkerHost:
+    # Provides the parts of DeviceHost used by HostedDevice, backed by the server.
+    def __init__(self, connection):
+        self.connection = connection
+        self.devices = RemoteDevices(connection)
+        self.state_listeners = []
+        self.check_state_cache = False
+
+    def subscribe_to_state_updates(self, listener):
+        self.state_listeners.append(listener)
+
+    def on_state_update(self, device_id, method, serialized_payload):
+        message_type = "state_patch" if method == "StatePatch" else "state_update"
+        self.connection.send({"type": message_type, "payload": serialized_payload})
+
+    def on_loop_iteration(self, device_id):
+        self.connection.send({"type": "loop_iteration"})
+
+    def on_stream_data(self, device_id, array, meta):
+        # float32 samples of shape (channels, length)
+        self.connection.send({
+            "type": "stream_data",
+            "channels": array.shape[0],
+            "length": array.shape[1],
+            "data": base64.b64encode(array.astype("<f4", copy=False).tobytes()).decode(),
+            "meta": meta,
+        })
+
+    def on_state_changed(self, device_id, method, serialized_payload):
+        for listener in self.state_listeners:
+            listener(device_id, method, serialized_payload)
+
+    def action(self, device_id, channel_id, action_name, parameters):
+        self.connection.call("action", device_id, channel_id, action_name, parameters)
+
+    def action_batch(self, actions, atomic=False, best_effort=False):
+        self.connection.call("action_batch", actions, atomic, best_effort)
+
+    def request(self, device_id, channel_id, action_name, parameters):
+        return json.loads(self.connection.call("request", device_id, channel_id, action_name, parameters))
+
+
+class WorkerDevice(HostedDevice):
+    def __init__(self, connection, host, *args, **kwargs):
+        self.connection = connection
+        self.disposed = threading.Event()
+        super().__init__(host, *args, **kwargs)
+
+    def _subscribe_device_state(self, device_name):
+        self.connection.call("subscribe_device_state", device_name)
+        super()._subscribe_device_state(device_name)
+
+    def handle_call(self, method, args):
+        if method == "get_state":
+            return self.get_serialized_state()
+        if method == "action":
+            return self.handle_action(*args)
+        if method == "on_save_snapshot":
+            if "on_save_snapshot" in self.method_cache:
+                return self.method_cache["_on_save_snapshot"]()
+            return self.get_serialized_state()
+        if method == "get_settings":
+            return self.method_cache["_get_settings"]() if "get_settings" in self.method_cache else None
+        if method == "load_settings":
+            if "load_settings" in self.method_cache:
+                self.method_cache["_load_settings"](*args)
+                self._mark_state_changed()
+            return None
+        if method == "start_recording":
+            # the server writes the blocks into the .npy files of the recording
+            def open_stream(name, dtype):
+                return self.connection.call("open_recording_stream", name, dtype)
+
+            def write_block(handle, array):
+                self.connection.send({"type": "recording_block", "handle": handle, "data": base64.b64encode(array.tobytes()).decode()})
+
+            return self.start_recording(open_stream, write_block)
+        if method == "stop_recording":
+            self.stop_recording()
+            return None
+        if method == "dispose":
+            threading.Thread(target=self.dispose, daemon=True).start()
+            return None
+        raise KeyError(f"Unknown worker call {method}")
+
+    def dispose(self, timeout=1):
+        super().dispose(timeout)
+        self.disposed.set()
+
+
+def serve(connection, host, device_future):
+    # Calls are answered on a thread pool, as they might call back into the
+    # server; those arriving while the script is still executed wait for it.
+    executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="worker_call")
+
+    def handle(message):
+        try:
+            device = device_future.result()
+            connection.send({"id": message["id"], "type": "result", "value": device.handle_call(message["method"], message["args"])})
+        except Exception as e:
+            connection.send({"id": message["id"], "type": "error", "message": f"{type(e).__name__}: {e}"})
+
+    while True:
+        message = connection.receive()
+        if message is None:
+            break
+        if message["type"] == "call":
+            if message["method"] == "ping":
+                connection.send({"id": message["id"], "type": "result", "value": None})
+            else:
+                executor.submit(handle, message)
+        elif message["type"] == "state_changed":
+            host.on_state_changed(message["device_id"], message["method"], message["payload"])
+        else:
+            connection.resolve(message)
+    # the server is gone
+    if device_future.done() and device_future.exception() is None:
+        device_future.result().dispose()
+    else:
+        os._exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker process for PythonWorkerDevice.cs")
+    parser.add_argument("script")
+    parser.add_argument("--argv", type=json.loads, default=None)
+    parser.add_argument("--max-status-update-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    # the protocol owns stdout, prints of the script end up on stderr
+    connection = WorkerConnection(sys.stdin.buffer, os.fdopen(os.dup(sys.stdout.fileno()), "wb"))
+    sys.stdout = sys.stderr
+
+    host = WorkerHost(connection)
+    device_future = Future()
+    threading.Thread(target=serve, args=(connection, host, device_future), name="worker_reader", daemon=True).start()
+    try:
+        device_id = os.path.splitext(os.path.basename(args.script))[0]
+        device = WorkerDevice(connection, host, device_id, args.script, args.argv, args.max_status_update_rate)
+    except Exception as e:
+        device_future.set_exception(e)
+        connection.send({"type": "failed", "message": traceback.format_exc()})
+        return 1
+    device_future.set_result(device)
+    connection.send({"type": "ready", "profile": device.startup_profile})
+    # the worker ends once the device got disposed, either by the server or by a failing main()
+    device.disposed.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    exit_code = main()
+    # the reader thread blocks on stdin, which a regular interpreter shutdown would wait for
+    sys.stderr.flush()
+    os._exit(exit_code)
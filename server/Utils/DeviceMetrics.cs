@@ -0,0 +1,185 @@
+using System.Collections.Concurrent;
+using System.Diagnostics;
+using System.Globalization;
+using System.Text;
+
+// Histogram of durations with fixed buckets; recording is lock-free, such that it can stay enabled on the hot paths.
+public class LatencyHistogram
+{
+	// upper bounds of the buckets in seconds, the last bucket is unbounded
+	public static readonly double[] Bounds = [10e-6, 25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3, 250e-3, 500e-3, 1, 2.5, 5, 10];
+	private static readonly long[] BoundTicks = Bounds.Select(bound => (long)(bound * Stopwatch.Frequency)).ToArray();
+	private readonly long[] Counts = new long[Bounds.Length + 1];
+	private long SumTicks = 0;
+
+	public void Record(long elapsedTicks)
+	{
+		var bucket = Array.BinarySearch(BoundTicks, elapsedTicks);
+		Interlocked.Increment(ref Counts[bucket < 0 ? ~bucket : bucket]);
+		Interlocked.Add(ref SumTicks, elapsedTicks);
+	}
+
+	public void RecordSince(long startTimestamp) => Record(Stopwatch.GetTimestamp() - startTimestamp);
+
+	public long Count => GetCounts().Sum();
+
+	public double Sum => Interlocked.Read(ref SumTicks) / (double)Stopwatch.Frequency;
+
+	// Counts per bucket, the last one being the unbounded bucket.
+	public long[] GetCounts() => (long[])Counts.Clone();
+
+	// Upper bound of the bucket containing the quantile `q`, or null without data.
+	public double? Quantile(double q)
+	{
+		var counts = GetCounts();
+		var total = counts.Sum();
+		if (total == 0) return null;
+		var cumulative = 0L;
+		for (var i = 0; i < Bounds.Length; i++)
+		{
+			cumulative += counts[i];
+			if (cumulative >= q * total) return Bounds[i];
+		}
+		return double.PositiveInfinity;
+	}
+}
+
+// Metrics of a single device, see DeviceManager.Metrics.
+public class DeviceMetrics
+{
+	public readonly LatencyHistogram ActionLatency = new();
+	public readonly LatencyHistogram GetStateDuration = new();
+	public readonly LatencyHistogram SaveSnapshotDuration = new();
+	public readonly LatencyHistogram MainLoopPeriod = new();
+	// time spent waiting for and holding the GIL, by the kind of call
+	public readonly ConcurrentDictionary<string, (LatencyHistogram Wait, LatencyHistogram Hold)> Gil = new();
+	// status updates and patches published by Python devices
+	public long StatusUpdates = 0;
+	public long StatusUpdateBytes = 0;
+	private long LastLoopIteration = 0;
+	private double MeanLoopPeriod = double.NaN;
+	private double LoopPeriodVariance = 0;
+	private readonly object LoopLock = new();
+
+	// The metrics a device collects itself, which are shared with the DeviceManager.
+	public static DeviceMetrics? Of(IDeviceHandler device) => device switch
+	{
+		PythonDevice pythonDevice => pythonDevice.Metrics,
+		PythonWorkerDevice workerDevice => workerDevice.Metrics,
+		DeferredDevice deferredDevice => deferredDevice.Metrics,
+		_ => null,
+	};
+
+	// Lets a driver record into the metrics of the placeholder it replaces.
+	public static void Attach(IDeviceHandler device, DeviceMetrics metrics)
+	{
+		if (device is PythonDevice pythonDevice) pythonDevice.Metrics = metrics;
+		else if (device is PythonWorkerDevice workerDevice) workerDevice.Metrics = metrics;
+	}
+
+	public (LatencyHistogram Wait, LatencyHistogram Hold) GetGilHistograms(string call) => Gil.GetOrAdd(call, _ => (new(), new()));
+
+	public void RecordStatusUpdate(string json) => RecordStatusUpdate(Encoding.UTF8.GetByteCount(json));
+
+	// `bytes` of the encoded update, JSON or MessagePack
+	public void RecordStatusUpdate(long bytes)
+	{
+		Interlocked.Increment(ref StatusUpdates);
+		Interlocked.Add(ref StatusUpdateBytes, bytes);
+	}
+
+	// Called once per iteration of a device's main loop.
+	public void RecordLoopIteration()
+	{
+		var now = Stopwatch.GetTimestamp();
+		lock (LoopLock)
+		{
+			if (LastLoopIteration != 0)
+			{
+				var elapsed = now - LastLoopIteration;
+				MainLoopPeriod.Record(elapsed);
+				// exponentially weighted, such that the jitter follows changes of the loop
+				var period = elapsed / (double)Stopwatch.Frequency;
+				if (double.IsNaN(MeanLoopPeriod))
+				{
+					MeanLoopPeriod = period;
+				}
+				else
+				{
+					var deviation = period - MeanLoopPeriod;
+					MeanLoopPeriod += 0.05 * deviation;
+					LoopPeriodVariance = 0.95 * (LoopPeriodVariance + 0.05 * deviation * deviation);
+				}
+			}
+			LastLoopIteration = now;
+		}
+	}
+
+	// Mean period of the main loop and its standard deviation in seconds.
+	public (double Period, double Jitter)? GetLoopTiming()
+	{
+		lock (LoopLock)
+		{
+			return double.IsNaN(MeanLoopPeriod) ? null : (MeanLoopPeriod, Math.Sqrt(LoopPeriodVariance));
+		}
+	}
+}
+
+public static class PrometheusExporter
+{
+	// Writes the metrics of all devices in the Prometheus text exposition format.
+	public static string Export(IEnumerable<KeyValuePair<string, DeviceMetrics>> devices)
+	{
+		var metrics = devices.OrderBy(kvp => kvp.Key).ToList();
+		var text = new StringBuilder();
+		WriteHistograms(text, "laborchestra_action_duration_seconds", "Duration of device actions and requests.", metrics, m => [("", m.ActionLatency)]);
+		WriteHistograms(text, "laborchestra_gil_wait_seconds", "Time spent waiting for the Python GIL.", metrics, m => m.Gil.Select(kvp => ($",call=\"{kvp.Key}\"", kvp.Value.Wait)));
+		WriteHistograms(text, "laborchestra_gil_hold_seconds", "Time the Python GIL was held.", metrics, m => m.Gil.Select(kvp => ($",call=\"{kvp.Key}\"", kvp.Value.Hold)));
+		WriteHistograms(text, "laborchestra_get_state_duration_seconds", "Duration of fetching a device's state.", metrics, m => [("", m.GetStateDuration)]);
+		WriteHistograms(text, "laborchestra_save_snapshot_duration_seconds", "Duration of taking a device's snapshot.", metrics, m => [("", m.SaveSnapshotDuration)]);
+		WriteHistograms(text, "laborchestra_main_loop_period_seconds", "Period of the outermost loop of a device's main().", metrics, m => [("", m.MainLoopPeriod)]);
+		text.Append("# HELP laborchestra_main_loop_jitter_seconds Standard deviation of the main loop period.\n# TYPE laborchestra_main_loop_jitter_seconds gauge\n");
+		foreach (var (deviceId, m) in metrics)
+		{
+			if (m.GetLoopTiming() is { } timing) text.Append($"laborchestra_main_loop_jitter_seconds{{device=\"{deviceId}\"}} {Format(timing.Jitter)}\n");
+		}
+		WriteCounter(text, "laborchestra_status_updates_total", "Number of published status updates.", metrics, m => Interlocked.Read(ref m.StatusUpdates));
+		WriteCounter(text, "laborchestra_status_update_bytes_total", "Encoded bytes (JSON or MessagePack) of the published status updates.", metrics, m => Interlocked.Read(ref m.StatusUpdateBytes));
+		return text.ToString();
+	}
+
+	private static void WriteHistograms(StringBuilder text, string name, string help, List<KeyValuePair<string, DeviceMetrics>> metrics, Func<DeviceMetrics, IEnumerable<(string Labels, LatencyHistogram Histogram)>> select)
+	{
+		text.Append($"# HELP {name} {help}\n# TYPE {name} histogram\n");
+		foreach (var (deviceId, m) in metrics)
+		{
+			foreach (var (extraLabels, histogram) in select(m))
+			{
+				var counts = histogram.GetCounts();
+				var total = counts.Sum();
+				if (total == 0) continue;
+				var labels = $"device=\"{deviceId}\"{extraLabels}";
+				var cumulative = 0L;
+				for (var i = 0; i < LatencyHistogram.Bounds.Length; i++)
+				{
+					cumulative += counts[i];
+					text.Append($"{name}_bucket{{{labels},le=\"{Format(LatencyHistogram.Bounds[i])}\"}} {cumulative}\n");
+				}
+				text.Append($"{name}_bucket{{{labels},le=\"+Inf\"}} {total}\n");
+				text.Append($"{name}_sum{{{labels}}} {Format(histogram.Sum)}\n");
+				text.Append($"{name}_count{{{labels}}} {total}\n");
+			}
+		}
+	}
+
+	private static void WriteCounter(StringBuilder text, string name, string help, List<KeyValuePair<string, DeviceMetrics>> metrics, Func<DeviceMetrics, long> select)
+	{
+		text.Append($"# HELP {name} {help}\n# TYPE {name} counter\n");
+		foreach (var (deviceId, m) in metrics)
+		{
+			text.Append($"{name}{{device=\"{deviceId}\"}} {select(m)}\n");
+		}
+	}
+
+	private static string Format(double value) => value.ToString("R", CultureInfo.InvariantCulture);
+}
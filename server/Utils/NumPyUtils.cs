@@ -0,0 +1,56 @@
+using Python.Runtime;
+
+public static class NumPyUtils
+{
+	private static PyObject? NumPy;
+
+	// Converts numeric arrays (1D, or jagged 2D) into NumPy arrays by copying the memory directly into the NumPy buffers.
+	// Returns null for everything else. Has to be called while holding the GIL.
+	public static PyObject? ToNumPy(object? value)
+	{
+		return value switch
+		{
+			float[] array => FromRows(new[] { array }, "float32", false),
+			double[] array => FromRows(new[] { array }, "float64", false),
+			int[] array => FromRows(new[] { array }, "int32", false),
+			long[] array => FromRows(new[] { array }, "int64", false),
+			float[][] rows => FromRows(rows, "float32", true),
+			double[][] rows => FromRows(rows, "float64", true),
+			int[][] rows => FromRows(rows, "int32", true),
+			long[][] rows => FromRows(rows, "int64", true),
+			_ => null,
+		};
+	}
+
+	private static PyObject FromRows<T>(T[][] rows, string dtype, bool is2D) where T : unmanaged
+	{
+		var length = rows.Length == 0 ? 0 : rows[0].Length;
+		if (rows.Any(row => row.Length != length))
+		{
+			// ragged arrays become a list of 1D arrays
+			var list = new PyList();
+			foreach (var row in rows)
+			{
+				using var ndarray = FromRows(new[] { row }, dtype, false);
+				list.Append(ndarray);
+			}
+			return list;
+		}
+		NumPy ??= Py.Import("numpy");
+		using var shape = is2D ? new PyTuple([new PyInt(rows.Length), new PyInt(length)]) : new PyTuple([new PyInt(length)]);
+		using var dtypeName = new PyString(dtype);
+		var result = NumPy.InvokeMethod("empty", shape, dtypeName);
+		using var ctypes = result.GetAttr("ctypes");
+		using var pointer = ctypes.GetAttr("data");
+		var address = pointer.As<long>();
+		unsafe
+		{
+			var destination = new Span<T>((void*)address, rows.Length * length);
+			for (var i = 0; i < rows.Length; i++)
+			{
+				rows[i].CopyTo(destination.Slice(i * length, length));
+			}
+		}
+		return result;
+	}
+}
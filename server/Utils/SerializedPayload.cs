@@ -0,0 +1,69 @@
+using System.Text.Json;
+using System.Text.Json.Serialization;
+using MessagePack;
+using MessagePack.Formatters;
+
+// A value serialized by a Python device, as JSON or MessagePack (see PythonDevice.UseMessagePack).
+// It's written as is if the hub protocol matches its encoding and converted (once) otherwise;
+// server-side code which needs to look into it uses ToDynamic().
+[MessagePackFormatter(typeof(SerializedPayloadFormatter))]
+[JsonConverter(typeof(SerializedPayloadJsonConverter))]
+public class SerializedPayload
+{
+	private string? Json;
+	private byte[]? MessagePack;
+	private object? Dynamic;
+
+	private SerializedPayload(string? json, byte[]? messagePack)
+	{
+		Json = json;
+		MessagePack = messagePack;
+	}
+
+	public static SerializedPayload FromJson(string json) => new(json, null);
+
+	public static SerializedPayload FromMessagePack(byte[] data) => new(null, data);
+
+	public string ToJson() => Json ??= MessagePackSerializer.ConvertToJson(MessagePack!);
+
+	public byte[] ToMessagePack() => MessagePack ??= MessagePackSerializer.ConvertFromJson(Json!);
+
+	// ExpandoObjects (and lists of them), as the JSON states used to be handed out.
+	public object ToDynamic() => Dynamic ??= JsonSerializer.Deserialize<JsonElement>(ToJson()).ToDynamic() ?? new object();
+}
+
+public class SerializedPayloadFormatter : IMessagePackFormatter<SerializedPayload>
+{
+	public void Serialize(ref MessagePackWriter writer, SerializedPayload value, MessagePackSerializerOptions options)
+	{
+		writer.WriteRaw(value.ToMessagePack());
+	}
+
+	public SerializedPayload Deserialize(ref MessagePackReader reader, MessagePackSerializerOptions options)
+	{
+		return SerializedPayload.FromMessagePack(reader.ReadRaw().ToArray());
+	}
+}
+
+public class SerializedPayloadJsonConverter : JsonConverter<SerializedPayload>
+{
+	public override SerializedPayload Read(ref Utf8JsonReader reader, Type typeToConvert, JsonSerializerOptions options)
+	{
+		using var document = JsonDocument.ParseValue(ref reader);
+		return SerializedPayload.FromJson(document.RootElement.GetRawText());
+	}
+
+	public override void Write(Utf8JsonWriter writer, SerializedPayload value, JsonSerializerOptions options)
+	{
+		try
+		{
+			// validated, as MessagePack allows for values JSON doesn't (e.g. NaN or non-string keys)
+			writer.WriteRawValue(value.ToJson());
+		}
+		catch (Exception e) when (e is JsonException or ArgumentException)
+		{
+			Console.WriteLine($"Dropping a state which isn't valid JSON: {e.Message}");
+			writer.WriteNullValue();
+		}
+	}
+}